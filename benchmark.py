@@ -0,0 +1,544 @@
+#!/usr/bin/env python3
+"""
+Микро-бенчмарки горячих путей бота
+Запускается без подключения к Telegram API и OpenRouter
+
+Использование:
+    python benchmark.py              # все бенчмарки
+    python benchmark.py callbacks    # только выбранные
+"""
+
+import asyncio
+import contextlib
+import logging
+import sys
+import os
+import time
+import tracemalloc
+
+# Добавляем текущую директорию в путь
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+# Отключаем дублирование запросов администратору на время замеров
+os.environ.setdefault('DUPLICATE_REQUESTS', 'false')
+
+
+class FakeUser:
+    """Пользователь Telegram без сетевых вызовов"""
+    def __init__(self, user_id=100500):
+        self.id = user_id
+        self.first_name = "Бенчмарк"
+        self.username = None
+
+
+class FakeMessage:
+    """Сообщение, которое ничего не отправляет, но запоминает ответы"""
+    def __init__(self, text=""):
+        self.text = text
+        self.replies = []
+
+    async def reply_text(self, *args, **kwargs):
+        self.replies.append(kwargs.get('reply_markup'))
+        return self
+
+    async def delete(self):
+        pass
+
+
+class FakeCallbackQuery:
+    """Callback-запрос, который ничего не отправляет"""
+    def __init__(self, data, user):
+        self.data = data
+        self.from_user = user
+        self.message = FakeMessage()
+
+    async def answer(self):
+        pass
+
+    async def edit_message_text(self, *args, **kwargs):
+        pass
+
+
+class FakeUpdate:
+    def __init__(self, data=None, user=None, text=""):
+        self.effective_user = user or FakeUser()
+        self.callback_query = FakeCallbackQuery(data, self.effective_user)
+        self.message = FakeMessage(text)
+
+
+def report(name, iterations, elapsed):
+    """Печатает результат замера"""
+    per_call = elapsed / iterations * 1_000_000
+    print(f"  {name:<32} {per_call:>10.2f} мкс/вызов  ({iterations} итераций)")
+
+
+async def bench_callbacks(iterations=2000):
+    """Диспетчеризация и рендеринг всех типов callback-запросов"""
+    import handlers
+    
+    callback_types = sorted(handlers.CALLBACK_HANDLERS)
+    update = FakeUpdate()
+    
+    print("\n📊 Диспетчеризация callback_data (поиск обработчика):")
+    start = time.perf_counter()
+    for _ in range(iterations):
+        for data in callback_types:
+            handlers.resolve_callback(data)
+    report("все типы", iterations * len(callback_types), time.perf_counter() - start)
+    
+    print("\n📊 Поиск + рендеринг экрана по типам:")
+    for data in callback_types:
+        update.callback_query.data = data
+        start = time.perf_counter()
+        for _ in range(iterations):
+            handler, payload = handlers.resolve_callback(data)
+            await handler(update, None, payload)
+        report(data, iterations, time.perf_counter() - start)
+
+
+async def bench_intents(iterations=20000):
+    """Маршрутизация текстовых сообщений: цепочка if/elif против автомата"""
+    import intents
+    from test_bot import legacy_match_intent
+    
+    messages = [
+        "🌿 распознать растение",
+        "💚 обратная связь",
+        "🌱 уроки биологии",
+        "подскажи, пожалуйста, как часто поливать фикус летом на балконе?",
+        "привет",
+    ]
+    
+    print("\n📊 Маршрутизация текста (на сообщение):")
+    for label, route in (("if/elif цепочка", legacy_match_intent), ("автомат Ахо-Корасик", intents.match_intent)):
+        start = time.perf_counter()
+        for _ in range(iterations):
+            for text in messages:
+                route(text)
+        report(label, iterations * len(messages), time.perf_counter() - start)
+
+
+def allocated_bytes(func, iterations):
+    """Сколько байт новых объектов остается после каждого вызова func()"""
+    results = []
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    for _ in range(iterations):
+        results.append(func())
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    total = sum(stat.size_diff for stat in after.compare_to(before, 'filename'))
+    return total / iterations
+
+
+async def bench_keyboards(iterations=500):
+    """Аллокации на клавиатуру и на обработанное обновление до и после кеширования"""
+    import handlers
+    import keyboards
+    
+    factories = {
+        name: getattr(keyboards, name)
+        for name in dir(keyboards)
+        if name.startswith('get_') and hasattr(getattr(keyboards, name), '__wrapped__')
+    }
+    # Аргументы для клавиатур, зависящих от состояния
+    factory_args = {
+        'get_lessons_after_sample_keyboard': (True,),
+        'get_expert_actions_keyboard': (True,),
+    }
+    
+    print("\n📊 Аллокации на вызов фабрики клавиатуры (байт):")
+    for name, factory in sorted(factories.items()):
+        args = factory_args.get(name, ())
+        uncached = allocated_bytes(lambda: factory.__wrapped__(*args), iterations)
+        cached = allocated_bytes(lambda: factory(*args), iterations)
+        print(f"  {name:<36} {uncached:>8.0f} -> {cached:>6.0f}")
+    
+    # Кнопки главного меню, обработанные handle_text целиком
+    menu_buttons = [
+        "🌿 Распознать растение", "🧬 Экспертный режим", "ℹ️ О боте",
+        "🌸 Цветочный тест Люшера", "❓ Помощь", "💚 Обратная связь", "привет"
+    ]
+    
+    async def handle_updates():
+        updates = []
+        for text in menu_buttons:
+            update = FakeUpdate(text=text)
+            await handlers.handle_text(update, None)
+            updates.append(update)
+        return updates
+    
+    async def measure():
+        updates = []
+        tracemalloc.start()
+        before = tracemalloc.take_snapshot()
+        for _ in range(iterations // 10):
+            updates.append(await handle_updates())
+        after = tracemalloc.take_snapshot()
+        tracemalloc.stop()
+        total = sum(stat.size_diff for stat in after.compare_to(before, 'filename'))
+        return total / (len(updates) * len(menu_buttons))
+    
+    cached = await measure()
+    # Подменяем фабрики в хендлерах на некешированные версии
+    originals = {name: getattr(handlers, name) for name in factories if hasattr(handlers, name)}
+    build_feedback = keyboards._build_feedback_keyboard
+    try:
+        for name, factory in originals.items():
+            setattr(handlers, name, factory.__wrapped__)
+        keyboards._build_feedback_keyboard = build_feedback.__wrapped__
+        uncached = await measure()
+    finally:
+        for name, factory in originals.items():
+            setattr(handlers, name, factory)
+        keyboards._build_feedback_keyboard = build_feedback
+    
+    print("\n📊 Аллокации на обработанное текстовое обновление (байт):")
+    print(f"  {'без кеша':<36} {uncached:>8.0f}")
+    print(f"  {'с кешем':<36} {cached:>8.0f}")
+
+
+async def bench_lessons(iterations=20000):
+    """Форматирование урока на каждого подписчика против готового текста"""
+    import config
+    import lessons
+    
+    count = len(lessons.catalogue)
+    
+    print("\n📊 Текст урока для одного подписчика:")
+    start = time.perf_counter()
+    for i in range(iterations):
+        lessons.render_lesson(config.BIOLOGY_LESSONS[i % count])
+    report("форматирование f-строкой", iterations, time.perf_counter() - start)
+    
+    start = time.perf_counter()
+    for i in range(iterations):
+        lessons.catalogue.rendered(i)
+    report("готовый текст из каталога", iterations, time.perf_counter() - start)
+
+
+def random_bytes(count):
+    """Повторяемые случайные байты (random.randbytes появился только в Python 3.9)"""
+    import random
+    return random.getrandbits(count * 8).to_bytes(count, 'little')
+
+
+def sample_photo(width=2000, height=1500):
+    """JPEG, похожий на фото с телефона по размеру и сложности кодирования"""
+    import io
+    import random
+    from PIL import Image, ImageFilter
+    
+    random.seed(42)
+    noise = Image.frombytes('RGB', (width // 4, height // 4), random_bytes(width * height * 3 // 16))
+    image = noise.filter(ImageFilter.GaussianBlur(1)).resize((width, height))
+    buffer = io.BytesIO()
+    image.save(buffer, format='JPEG', quality=90)
+    return buffer.getvalue()
+
+
+@contextlib.contextmanager
+def silenced_stdout():
+    """Глушит print() распознавания, в том числе в дочерних процессах"""
+    sys.stdout.flush()
+    saved = os.dup(1)
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, 1)
+    try:
+        with open(os.devnull, 'w') as sink, contextlib.redirect_stdout(sink):
+            yield
+    finally:
+        sys.stdout.flush()
+        os.dup2(saved, 1)
+        os.close(saved)
+        os.close(devnull)
+
+
+async def bench_workers(jobs=24, model_delay=0.2, total_concurrency=4):
+    """Пропускная способность распознавания и отзывчивость процесса бота"""
+    import config
+    import fake_openrouter
+    import recognition_workers
+    
+    server = fake_openrouter.FakeOpenRouter(delay=model_delay)
+    config.OPENROUTER_BASE_URL = await server.start()
+    photo = sample_photo()
+    
+    async def run(recognize):
+        # Задержка event loop показывает, насколько тормозит обработка обновлений
+        lag = 0.0
+        running = True
+        
+        async def ticker():
+            nonlocal lag
+            while running:
+                start = time.perf_counter()
+                await asyncio.sleep(0.005)
+                lag = max(lag, time.perf_counter() - start - 0.005)
+        
+        probe = asyncio.ensure_future(ticker())
+        start = time.perf_counter()
+        await asyncio.gather(*[recognize() for _ in range(jobs)])
+        elapsed = time.perf_counter() - start
+        running = False
+        await probe
+        return elapsed, lag
+    
+    print(f"\n📊 Распознавание {jobs} фото {len(photo) // 1024} КБ, ответ модели {model_delay * 1000:.0f} мс "
+          f"(ядер CPU: {os.cpu_count()}):")
+    slots = asyncio.Semaphore(total_concurrency)
+    
+    async def in_process():
+        async with slots:
+            return await recognition_workers.recognize_in_process('plant', [photo])
+    
+    with silenced_stdout():
+        elapsed, lag = await run(in_process)
+    print(f"  {'в процессе бота':<24} {jobs / elapsed:>6.1f} фото/с   макс. задержка loop {lag * 1000:>6.1f} мс")
+    
+    for processes in (1, 2, 4):
+        pool = recognition_workers.ProcessRecognitionPool(processes, concurrency=max(1, total_concurrency // processes))
+        try:
+            with silenced_stdout():
+                # Прогрев: запуск процессов не входит в замер
+                await asyncio.gather(*[pool.recognize('plant', [photo]) for _ in range(processes)])
+                elapsed, lag = await run(lambda: pool.recognize('plant', [photo]))
+        finally:
+            await pool.close()
+        label = f"процессов: {processes}"
+        print(f"  {label:<24} {jobs / elapsed:>6.1f} фото/с   макс. задержка loop {lag * 1000:>6.1f} мс")
+    
+    await server.stop()
+
+
+class NullWriter:
+    """Сокет, который только считает записанные байты"""
+    def __init__(self):
+        self.written = 0
+
+    async def write(self, chunk):
+        self.written += len(chunk)
+
+
+async def bench_payload(photos=4, iterations=5):
+    """Пиковая память и время сборки тела запроса с изображениями"""
+    import base64
+    import json
+    import aiohttp.payload
+    import config
+    import json_body
+    
+    jpegs = [sample_photo() for _ in range(photos)]
+    
+    def content(image_url):
+        return [{"type": "text", "text": config.EXPERT_RECOGNITION_PROMPT}] + [
+            {"type": "image_url", "image_url": {"url": image_url(jpeg)}} for jpeg in jpegs
+        ]
+    
+    def inline_body():
+        # Прежний путь: base64-строки в словаре и json=payload
+        parts = content(lambda jpeg: f"data:image/jpeg;base64,{base64.b64encode(jpeg).decode('utf-8')}")
+        return aiohttp.payload.JsonPayload({"model": "m", "messages": [{"role": "user", "content": parts}]})
+    
+    def streaming_body():
+        parts = content(json_body.JPEGDataURL)
+        return json_body.JSONImagePayload({"model": "m", "messages": [{"role": "user", "content": parts}]})
+    
+    print(f"\n📊 Тело запроса: {photos} фото по {len(jpegs[0]) // 1024} КБ:")
+    for label, build in (("json=payload", inline_body), ("потоковое тело", streaming_body)):
+        peak = 0
+        elapsed = 0.0
+        for _ in range(iterations):
+            tracemalloc.start()
+            start = time.perf_counter()
+            writer = NullWriter()
+            await build().write(writer)
+            elapsed += time.perf_counter() - start
+            peak = max(peak, tracemalloc.get_traced_memory()[1])
+            tracemalloc.stop()
+        print(f"  {label:<24} пик {peak / 1024 / 1024:>6.2f} МБ   {elapsed / iterations * 1000:>6.1f} мс   "
+              f"тело {writer.written / 1024 / 1024:.2f} МБ")
+    
+    response = json.dumps({
+        "id": "gen-1", "model": "m",
+        "choices": [{"message": {"role": "assistant", "content": config.EXPERT_RECOGNITION_PROMPT * 2}}],
+        "usage": {"prompt_tokens": 3000, "completion_tokens": 1200}
+    }, ensure_ascii=False).encode()
+    decoders = [("json.loads", lambda raw: json.loads(raw))]
+    if json_body.orjson is not None:
+        decoders.append(("orjson.loads", json_body.orjson.loads))
+    print(f"\n📊 Разбор ответа модели ({len(response) // 1024} КБ):")
+    for label, decode in decoders:
+        start = time.perf_counter()
+        for _ in range(2000):
+            decode(response)
+        report(label, 2000, time.perf_counter() - start)
+
+
+def sample_scene(width=1280, height=960, plant_size=320):
+    """JPEG: небольшое растение на однородном фоне, как на типичном снимке"""
+    import io
+    import random
+    from PIL import Image, ImageDraw, ImageFilter
+    
+    random.seed(7)
+    
+    def textured(size, color, blur, weight):
+        pattern = Image.frombytes('RGB', size, random_bytes(size[0] * size[1] * 3))
+        return Image.blend(pattern.filter(ImageFilter.GaussianBlur(blur)), Image.new('RGB', size, color), weight)
+    
+    scene = textured((width // 8, height // 8), (150, 130, 110), 3, 0.7).resize((width, height))
+    mask = Image.new('L', (plant_size, plant_size))
+    ImageDraw.Draw(mask).ellipse((0, 0, plant_size - 1, plant_size - 1), fill=255)
+    scene.paste(textured((plant_size, plant_size), (40, 150, 40), 1, 0.6), (width // 2, height // 3), mask)
+    buffer = io.BytesIO()
+    scene.save(buffer, format='JPEG', quality=90)
+    return buffer.getvalue()
+
+
+async def bench_crop(iterations=20):
+    """Размер изображения в запросе с обрезкой по растению и без нее"""
+    import config
+    import utils
+    
+    budget = config.MODEL_PIXEL_BUDGETS['qwen_7b']
+    print("\n📊 Обрезка по области растения (бюджет qwen_7b):")
+    for label, photo in (("растение на фоне", sample_scene()), ("растение на весь кадр", sample_photo(1280, 960))):
+        sizes = {}
+        for crop in (False, True):
+            start = time.perf_counter()
+            for _ in range(iterations):
+                jpeg = await utils.encode_image_to_jpeg(photo, budget, crop=crop)
+            elapsed = time.perf_counter() - start
+            sizes[crop] = len(jpeg)
+            # base64 в теле запроса на треть больше JPEG
+            print(f"  {label + (' + обрезка' if crop else ''):<34} {len(jpeg) * 4 // 3 // 1024:>5} КБ в теле   "
+                  f"{elapsed / iterations * 1000:>6.1f} мс")
+        print(f"  {'экономия':<34} {(1 - sizes[True] / sizes[False]) * 100:>5.0f} %")
+
+
+def model_delay(body, base=0.1, per_image=0.15, per_token=0.0004):
+    """Время ответа модели: растет с числом изображений и длиной ответа"""
+    images = sum(1 for part in body['messages'][0]['content'] if part['type'] == 'image_url')
+    return base + per_image * images + per_token * body['max_tokens']
+
+
+async def bench_expert(photo_counts=(2, 4, 6), repeats=3):
+    """Задержка экспертного анализа: один запрос со всеми фото против map-reduce"""
+    import config
+    import degradation
+    import fake_openrouter
+    import utils
+    
+    server = fake_openrouter.FakeOpenRouter(content="🌿 Наблюдения и анализ", delay=model_delay)
+    config.OPENROUTER_BASE_URL = await server.start()
+    plan = degradation.DegradationController(lambda: 0, [5, 15, 30], [20, 40, 60]).plan("expert")
+    photo = sample_photo(1280, 960)
+    
+    saved = config.EXPERT_MAP_REDUCE
+    print("\n📊 Экспертный анализ (модель: 0.1 с + 0.15 с на фото + 0.4 мс на токен ответа):")
+    for count in photo_counts:
+        photos = [photo] * count
+        for label, map_reduce in (("один запрос", False), ("map-reduce", True)):
+            config.EXPERT_MAP_REDUCE = map_reduce
+            requests = len(server.requests)
+            start = time.perf_counter()
+            with silenced_stdout():
+                for _ in range(repeats):
+                    await utils.recognize_plant_expert_mode(photos, "Растет в тени", plan)
+            elapsed = (time.perf_counter() - start) / repeats
+            calls = (len(server.requests) - requests) // repeats
+            print(f"  {count} фото, {label:<16} {elapsed * 1000:>7.0f} мс   запросов: {calls}")
+    
+    config.EXPERT_MAP_REDUCE = saved
+    await server.stop()
+    await utils.close_http_session()
+
+
+def vision_delay(body, per_image=0.05, per_vision_token=0.0002, per_token=0.0002):
+    """Время ответа модели: накладные на изображение плюс токены изображений в пределах бюджета модели"""
+    import base64
+    import io
+    import config
+    from PIL import Image
+    
+    model_key = next(key for key, name in config.AVAILABLE_MODELS.items() if name == body['model'])
+    budget = config.MODEL_PIXEL_BUDGETS.get(model_key, max(config.MODEL_PIXEL_BUDGETS.values()))
+    vision_tokens = 0
+    images = [part for part in body['messages'][0]['content'] if part['type'] == 'image_url']
+    for part in images:
+        data = base64.b64decode(part['image_url']['url'].split(',', 1)[1])
+        width, height = Image.open(io.BytesIO(data)).size
+        # Крупное изображение модель уменьшает до своего бюджета, патч 28×28
+        vision_tokens += min(width * height, budget) // (28 * 28)
+    return per_image * len(images) + per_vision_token * vision_tokens + per_token * body['max_tokens']
+
+
+async def bench_contact_sheet(photos=4, repeats=2):
+    """Экспертный анализ: отдельные фото против одной сетки с номерами"""
+    import config
+    import degradation
+    import fake_openrouter
+    import utils
+    
+    server = fake_openrouter.FakeOpenRouter(content="🧬 Анализ", delay=vision_delay)
+    config.OPENROUTER_BASE_URL = await server.start()
+    plan = degradation.DegradationController(lambda: 0, [5, 15, 30], [20, 40, 60]).plan("expert")
+    images = [sample_photo(1600, 1200)] * photos
+    
+    saved = (config.EXPERT_CONTACT_SHEET, config.CONTACT_SHEET_PIXEL_BUDGET)
+    print(f"\n📊 Экспертный анализ {photos} фото: отдельные изображения против сетки:")
+    for model_key in ('qwen_7b', 'llama_vision', 'mistral_small'):
+        plan['models'] = [model_key]
+        config.CONTACT_SHEET_PIXEL_BUDGET = config.MODEL_PIXEL_BUDGETS[model_key]
+        for label, sheet in (("отдельные фото", False), ("сетка", True)):
+            config.EXPERT_CONTACT_SHEET = sheet
+            start = time.perf_counter()
+            with silenced_stdout():
+                for _ in range(repeats):
+                    await utils.recognize_plant_expert_mode(images, "", plan)
+            elapsed = (time.perf_counter() - start) / repeats
+            print(f"  {model_key + ', ' + label:<30} тело {server.requests[-1] / 1024:>7.0f} КБ   {elapsed * 1000:>6.0f} мс")
+    
+    config.EXPERT_CONTACT_SHEET, config.CONTACT_SHEET_PIXEL_BUDGET = saved
+    await server.stop()
+    await utils.close_http_session()
+
+
+BENCHMARKS = {
+    'callbacks': bench_callbacks,
+    'intents': bench_intents,
+    'keyboards': bench_keyboards,
+    'lessons': bench_lessons,
+    'workers': bench_workers,
+    'payload': bench_payload,
+    'crop': bench_crop,
+    'expert': bench_expert,
+    'sheet': bench_contact_sheet,
+}
+
+
+async def main(selected):
+    """Запускает выбранные бенчмарки"""
+    # Логи хендлеров искажают замеры
+    logging.disable(logging.CRITICAL)
+    
+    print("⏱️ Бенчмарки бота распознавания растений")
+    print("=" * 50)
+    
+    for name in selected or BENCHMARKS:
+        if name not in BENCHMARKS:
+            print(f"❌ Неизвестный бенчмарк: {name}. Доступные: {', '.join(BENCHMARKS)}")
+            return False
+        await BENCHMARKS[name]()
+    
+    return True
+
+
+if __name__ == "__main__":
+    try:
+        success = asyncio.run(main(sys.argv[1:]))
+        sys.exit(0 if success else 1)
+    except KeyboardInterrupt:
+        print("\n\n⏹️ Бенчмарк прерван пользователем")
+        sys.exit(1)
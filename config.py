@@ -9,12 +9,17 @@ BOT_TOKEN = os.getenv('BOT_TOKEN')
 ADMIN_ID = int(os.getenv('ADMIN_ID', 0))
 ADMIN_USERNAME = os.getenv('ADMIN_USERNAME')  # Опционально: username администратора для прямых ссылок
 
+# Собственный сервер Telegram Bot API (telegram-bot-api); пусто - облачный api.telegram.org
+BOT_API_URL = os.getenv('BOT_API_URL')                                  # Например, http://localhost:8081
+BOT_API_LOCAL_MODE = os.getenv('BOT_API_LOCAL_MODE', 'false').lower() == 'true'  # Сервер запущен с --local
+BOT_API_PATH_MAP = os.getenv('BOT_API_PATH_MAP')                        # "путь_на_сервере:путь_у_бота", если каталоги смонтированы по-разному
+
 # Настройка дублирования запросов администратору
 DUPLICATE_REQUESTS = os.getenv('DUPLICATE_REQUESTS', 'true').lower() == 'true'
 
 # Настройки OpenRouter API
 OPENROUTER_API_KEY = os.getenv('OPENROUTER_API_KEY')
-OPENROUTER_BASE_URL = "https://openrouter.ai/api/v1"
+OPENROUTER_BASE_URL = os.getenv('OPENROUTER_BASE_URL', "https://openrouter.ai/api/v1")
 
 # Доступные бесплатные vision-модели (проверенные рабочие варианты)
 AVAILABLE_MODELS = {
@@ -40,6 +45,165 @@ FALLBACK_MODELS = [
     'qwen_72b'       # Самая мощная (если есть ресурсы)
 ]
 
+# Ограничение частоты запросов на распознавание (до обращения к OpenRouter)
+THROTTLE_USER_PER_MINUTE = float(os.getenv('THROTTLE_USER_PER_MINUTE', 4))      # Запросов в минуту на пользователя
+THROTTLE_USER_BURST = float(os.getenv('THROTTLE_USER_BURST', 3))                # Сколько запросов подряд можно без ожидания
+THROTTLE_GLOBAL_PER_MINUTE = float(os.getenv('THROTTLE_GLOBAL_PER_MINUTE', 60)) # Запросов в минуту на весь бот
+THROTTLE_GLOBAL_BURST = float(os.getenv('THROTTLE_GLOBAL_BURST', 20))
+THROTTLE_EXPERT_COST = float(os.getenv('THROTTLE_EXPERT_COST', 2))              # Экспертный анализ расходует больше токенов
+DUPLICATE_PHOTO_WINDOW = float(os.getenv('DUPLICATE_PHOTO_WINDOW', 120))        # Секунд, в течение которых повтор фото отбрасывается
+
+# Очередь распознавания
+RECOGNITION_WORKERS = int(os.getenv('RECOGNITION_WORKERS', 4))            # Одновременных запросов к моделям
+RECOGNITION_QUEUE_LIMIT = int(os.getenv('RECOGNITION_QUEUE_LIMIT', 100))  # Максимум ожидающих задач
+PLANT_LANE_WEIGHT = int(os.getenv('PLANT_LANE_WEIGHT', 3))                # Доля быстрых определений при конкуренции
+EXPERT_LANE_WEIGHT = int(os.getenv('EXPERT_LANE_WEIGHT', 1))              # Доля экспертных анализов при конкуренции
+
+# Отдельные процессы для распознавания (0 - все в процессе бота)
+RECOGNITION_PROCESSES = int(os.getenv('RECOGNITION_PROCESSES', 0))
+RECOGNITION_PROCESS_CONCURRENCY = int(os.getenv('RECOGNITION_PROCESS_CONCURRENCY', 2))    # Одновременных задач на процесс
+RECOGNITION_HEARTBEAT_INTERVAL = float(os.getenv('RECOGNITION_HEARTBEAT_INTERVAL', 5))    # Сек между сигналами процесса
+RECOGNITION_HEARTBEAT_TIMEOUT = float(os.getenv('RECOGNITION_HEARTBEAT_TIMEOUT', 30))     # Без сигнала дольше - перезапуск
+
+# Долговременная очередь: задачи переживают перезапуск бота
+JOB_STORE_PATH = os.getenv('JOB_STORE_PATH', 'recognition_jobs.db')
+JOB_REPLAY_MAX_ATTEMPTS = int(os.getenv('JOB_REPLAY_MAX_ATTEMPTS', 3))  # Запусков задачи после перезапусков
+JOB_REPLAY_MAX_AGE = float(os.getenv('JOB_REPLAY_MAX_AGE', 3600))       # Более старые задачи не повторяются, сек
+
+# Шардирование: несколько экземпляров бота за диспетчером вебхуков
+SHARD_COUNT = int(os.getenv('SHARD_COUNT', 1))
+SHARD_INDEX = int(os.getenv('SHARD_INDEX', 0))                          # Номер этого экземпляра (0..SHARD_COUNT-1)
+SHARD_LISTEN = os.getenv('SHARD_LISTEN', '127.0.0.1')                   # Где шард принимает обновления от диспетчера
+SHARD_PORT = int(os.getenv('SHARD_PORT', 8100 + SHARD_INDEX))
+SHARD_URLS = [url for url in os.getenv('SHARD_URLS', '').split(',') if url]  # Вебхуки шардов по порядку (для диспетчера)
+DISPATCHER_HOST = os.getenv('DISPATCHER_HOST', '0.0.0.0')
+DISPATCHER_PORT = int(os.getenv('DISPATCHER_PORT', 8000))
+WEBHOOK_URL = os.getenv('WEBHOOK_URL')                                  # Публичный адрес диспетчера для Telegram
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET')
+
+# Ссылки на фото вместо байтов: модель скачивает фото с подписанного прокси бота
+IMAGE_URL_MODE = os.getenv('IMAGE_URL_MODE', 'false').lower() == 'true'
+IMAGE_PROXY_PUBLIC_URL = os.getenv('IMAGE_PROXY_PUBLIC_URL')            # Адрес прокси, доступный провайдеру
+IMAGE_PROXY_SECRET = os.getenv('IMAGE_PROXY_SECRET')                    # Ключ подписи ссылок
+IMAGE_PROXY_HOST = os.getenv('IMAGE_PROXY_HOST', '0.0.0.0')
+IMAGE_PROXY_PORT = int(os.getenv('IMAGE_PROXY_PORT', 8080 + SHARD_INDEX))   # У каждого шарда свой порт
+IMAGE_URL_TTL = int(os.getenv('IMAGE_URL_TTL', 300))                    # Срок действия ссылки, сек
+
+# Полезное разрешение моделей в пикселях: больший снимок модель все равно уменьшит
+MODEL_PIXEL_BUDGETS = {
+    'qwen_32b': 1280 * 28 * 28,
+    'qwen_72b': 1280 * 28 * 28,
+    'qwen_7b': 1280 * 28 * 28,
+    'claude_haiku': 1568 * 728,
+    'llama_vision': 1120 * 1120,
+    'pixtral': 1024 * 1024,
+    'mistral_small': 1540 * 1540
+}
+PHOTO_PIXEL_BUDGET = int(os.getenv('PHOTO_PIXEL_BUDGET', 0))  # Переопределяет бюджет моделей (0 - по модели)
+
+# Изображения, присланные файлом
+DOCUMENT_MAX_BYTES = int(os.getenv('DOCUMENT_MAX_BYTES', 20 * 1024 * 1024))       # Больше облачный Bot API не отдает
+DOCUMENT_SPOOL_MEMORY = int(os.getenv('DOCUMENT_SPOOL_MEMORY', 1024 * 1024))      # Файлы крупнее пишутся во временный файл на диске
+IMAGE_MAX_DECODE_PIXELS = int(os.getenv('IMAGE_MAX_DECODE_PIXELS', 16_000_000))   # Предел декодируемых пикселей (JPEG - после уменьшения)
+EXPERT_PIXEL_BUDGET = int(os.getenv('EXPERT_PIXEL_BUDGET', 2560 * 1920))          # Размер файла-фото для экспертного анализа
+
+# Проверка качества фото до обращения к модели
+QUALITY_GATE = os.getenv('QUALITY_GATE', 'false').lower() == 'true'
+QUALITY_ANALYSIS_SIDE = int(os.getenv('QUALITY_ANALYSIS_SIDE', 512))        # Сторона уменьшенной копии для анализа
+QUALITY_MIN_SIDE = int(os.getenv('QUALITY_MIN_SIDE', 200))                  # Меньшая сторона фото, пикселей
+QUALITY_MIN_BRIGHTNESS = float(os.getenv('QUALITY_MIN_BRIGHTNESS', 30))     # Средняя яркость 0..255
+QUALITY_MAX_BRIGHTNESS = float(os.getenv('QUALITY_MAX_BRIGHTNESS', 230))
+QUALITY_MIN_SHARPNESS = float(os.getenv('QUALITY_MIN_SHARPNESS', 20))       # Дисперсия лапласиана, ниже - размыто
+
+# Обрезка фото по области растения перед отправкой модели (обычное распознавание)
+SALIENT_CROP = os.getenv('SALIENT_CROP', 'false').lower() == 'true'
+SALIENT_CROP_ANALYSIS_SIDE = int(os.getenv('SALIENT_CROP_ANALYSIS_SIDE', 128))   # Сторона миниатюры для карты заметности
+SALIENT_CROP_TAIL = float(os.getenv('SALIENT_CROP_TAIL', 0.05))                  # Доля заметности, отсекаемая с каждого края
+SALIENT_CROP_MARGIN = float(os.getenv('SALIENT_CROP_MARGIN', 0.1))               # Запас вокруг рамки, доля ее размера
+SALIENT_CROP_MAX_AREA = float(os.getenv('SALIENT_CROP_MAX_AREA', 0.7))           # Рамка больше этой доли кадра - не обрезаем
+SALIENT_CROP_MIN_CONTRAST = float(os.getenv('SALIENT_CROP_MIN_CONTRAST', 1.3))   # Минимальная плотность заметности в рамке относительно кадра
+
+# Признаки неуверенного ответа: тогда фото распознается повторно в полном размере
+LOW_CONFIDENCE_MARKERS = [
+    'более качественное фото',
+    'более четкое фото',
+    'фото получше',
+    'фото лучшего качества',
+    'плохо видно',
+    'не удается определить',
+    'сложно определить',
+    'трудно определить',
+    'не могу точно определить',
+    'не могу определить'
+]
+
+# Каскад для обычного распознавания: быстрая модель определяет вид и оценивает уверенность,
+# крупные модели получают фото только в сомнительных случаях
+CASCADE_MODE = os.getenv('CASCADE_MODE', 'false').lower() == 'true'
+CASCADE_FAST_MODELS = [key for key in os.getenv('CASCADE_FAST_MODELS', 'qwen_7b').split(',') if key]
+CASCADE_CONFIDENCE_THRESHOLD = float(os.getenv('CASCADE_CONFIDENCE_THRESHOLD', 80))  # Ниже (0-100) - эскалация
+CASCADE_MIN_MARGIN = float(os.getenv('CASCADE_MIN_MARGIN', 20))                      # Отрыв от альтернативы, иначе вид неоднозначен
+CASCADE_IDENTIFY_MAX_TOKENS = int(os.getenv('CASCADE_IDENTIFY_MAX_TOKENS', 120))     # Ответ этапа определения - короткий JSON
+
+# Экспертный анализ map-reduce: фото описываются параллельно быстрой моделью,
+# затем наблюдения сводятся в определение текстовым запросом без изображений
+EXPERT_MAP_REDUCE = os.getenv('EXPERT_MAP_REDUCE', 'false').lower() == 'true'
+EXPERT_MAP_MIN_PHOTOS = int(os.getenv('EXPERT_MAP_MIN_PHOTOS', 2))              # С одним фото выгоднее обычный запрос
+EXPERT_MAP_MODELS = [key for key in os.getenv('EXPERT_MAP_MODELS', 'qwen_7b,mistral_small').split(',') if key]
+EXPERT_MAP_CONCURRENCY = int(os.getenv('EXPERT_MAP_CONCURRENCY', 4))            # Одновременных запросов на один анализ
+EXPERT_OBSERVATION_MAX_TOKENS = int(os.getenv('EXPERT_OBSERVATION_MAX_TOKENS', 250))
+
+# Сетка фото для экспертного анализа: все фото одним изображением с номерами плиток
+EXPERT_CONTACT_SHEET = os.getenv('EXPERT_CONTACT_SHEET', 'false').lower() == 'true'
+CONTACT_SHEET_MIN_PHOTOS = int(os.getenv('CONTACT_SHEET_MIN_PHOTOS', 2))
+CONTACT_SHEET_PIXEL_BUDGET = int(os.getenv('CONTACT_SHEET_PIXEL_BUDGET', 0))  # Пикселей во всей сетке (0 - бюджет модели)
+CONTACT_SHEET_GAP = int(os.getenv('CONTACT_SHEET_GAP', 8))                     # Промежуток между плитками (px)
+
+# Кеш описаний видов: модель по фото только определяет вид, описание берется из кеша
+SPECIES_CACHE = os.getenv('SPECIES_CACHE', 'false').lower() == 'true'
+SPECIES_CACHE_PATH = os.getenv('SPECIES_CACHE_PATH', 'species_cache.db')
+SPECIES_CACHE_MAX_AGE = float(os.getenv('SPECIES_CACHE_MAX_AGE', 30 * 86400))  # Описания старше генерируются заново, сек
+
+# Лимиты запросов к каждой модели (model_limiter): Retry-After, X-RateLimit-*, паузы после ошибок
+MODEL_RATE_PER_MINUTE = float(os.getenv('MODEL_RATE_PER_MINUTE', 0))        # Начальный лимит на модель (0 - до первых заголовков)
+MODEL_RATE_BURST = float(os.getenv('MODEL_RATE_BURST', 3))                  # Запросов к модели подряд без ожидания
+MODEL_RATE_WINDOW = float(os.getenv('MODEL_RATE_WINDOW', 60))               # Окно X-RateLimit-Limit (сек)
+MODEL_MAX_WAIT = float(os.getenv('MODEL_MAX_WAIT', 5))                      # Дольше модель не ждем, берем следующую
+MODEL_RETRIES = int(os.getenv('MODEL_RETRIES', 1))                          # Повторов временной ошибки на той же модели
+MODEL_BACKOFF_BASE = float(os.getenv('MODEL_BACKOFF_BASE', 1))              # Первая пауза после временной ошибки (сек)
+MODEL_BACKOFF_MAX = float(os.getenv('MODEL_BACKOFF_MAX', 60))
+MODEL_RATE_LIMIT_COOLDOWN = float(os.getenv('MODEL_RATE_LIMIT_COOLDOWN', 30))  # Пауза после 429 без Retry-After (сек)
+
+# Учет токенов (token_ledger) и подбор max_tokens по наблюдаемой длине ответов
+TOKEN_LEDGER_WINDOW = int(os.getenv('TOKEN_LEDGER_WINDOW', 500))                        # Последних ответов на тип задачи
+ADAPTIVE_MAX_TOKENS = os.getenv('ADAPTIVE_MAX_TOKENS', 'false').lower() == 'true'
+ADAPTIVE_MAX_TOKENS_QUANTILE = float(os.getenv('ADAPTIVE_MAX_TOKENS_QUANTILE', 0.95))    # Квантиль длины ответа
+ADAPTIVE_MAX_TOKENS_HEADROOM = float(os.getenv('ADAPTIVE_MAX_TOKENS_HEADROOM', 1.25))    # Запас сверх квантиля
+ADAPTIVE_MAX_TOKENS_MIN_SAMPLES = int(os.getenv('ADAPTIVE_MAX_TOKENS_MIN_SAMPLES', 50))  # До этого - базовый лимит
+ADAPTIVE_MAX_TOKENS_FLOOR = int(os.getenv('ADAPTIVE_MAX_TOKENS_FLOOR', 200))
+ADAPTIVE_MAX_TOKENS_MAX_TRUNCATED = float(os.getenv('ADAPTIVE_MAX_TOKENS_MAX_TRUNCATED', 0.02))  # Доля обрезанных ответов, выше - базовый лимит
+
+# Пул соединений к OpenRouter (одна сессия aiohttp на процесс)
+OPENROUTER_POOL_SIZE = int(os.getenv('OPENROUTER_POOL_SIZE', 20))
+
+# Уточняющие вопросы о последнем распознанном растении (текстовый запрос без фото)
+FOLLOWUP_TTL = float(os.getenv('FOLLOWUP_TTL', 900))                  # Контекст забывается через N секунд без вопросов
+FOLLOWUP_MAX_TURNS = int(os.getenv('FOLLOWUP_MAX_TURNS', 3))          # Последних вопросов в истории
+FOLLOWUP_ANSWER_CHARS = int(os.getenv('FOLLOWUP_ANSWER_CHARS', 2000)) # Длина сохраняемого ответа о растении
+FOLLOWUP_MAX_TOKENS = int(os.getenv('FOLLOWUP_MAX_TOKENS', 400))
+FOLLOWUP_MODELS = [key for key in os.getenv('FOLLOWUP_MODELS', 'qwen_7b,mistral_small,qwen_32b').split(',') if key]
+THROTTLE_FOLLOWUP_COST = float(os.getenv('THROTTLE_FOLLOWUP_COST', 0.5))  # Текстовый вопрос дешевле распознавания
+
+# Быстрые модели, которые идут первыми под нагрузкой
+FAST_MODELS = ['qwen_7b']
+
+# Деградация под нагрузкой: пороги входа на уровни 1, 2, 3
+DEGRADATION_QUEUE_THRESHOLDS = [int(x) for x in os.getenv('DEGRADATION_QUEUE_THRESHOLDS', '5,15,30').split(',')]     # Глубина очереди
+DEGRADATION_LATENCY_THRESHOLDS = [float(x) for x in os.getenv('DEGRADATION_LATENCY_THRESHOLDS', '20,40,60').split(',')]  # p95 задержки, сек
+DEGRADATION_RECOVERY_RATIO = float(os.getenv('DEGRADATION_RECOVERY_RATIO', 0.5))  # Выход с уровня ниже этой доли порога
+DEGRADATION_MIN_DWELL = float(os.getenv('DEGRADATION_MIN_DWELL', 30))             # Секунд на уровне перед понижением
+DEGRADED_MAX_TOKENS_RATIO = float(os.getenv('DEGRADED_MAX_TOKENS_RATIO', 0.6))    # Доля max_tokens под нагрузкой
+
 # Функция для смены модели
 def change_model(model_key):
     """Смена модели для распознавания растений/грибов
@@ -78,6 +242,38 @@ PLANT_RECOGNITION_PROMPT = """Ты - дружелюбный эксперт по
 
 Ответ должен быть информативным, но не слишком длинным (максимум 300 слов)."""
 
+# Этап определения вида (каскад): только название и уверенность
+PLANT_IDENTIFY_PROMPT = """Определи растение на фото. Ответь ТОЛЬКО одним JSON-объектом без пояснений:
+{"name": "русское название", "latin": "латинское название", "confidence": уверенность от 0 до 100, "alternatives": [{"name": "другой возможный вид", "confidence": уверенность от 0 до 100}]}
+
+Если растения на фото нет или его не разглядеть, укажи "name": "" и "confidence": 0."""
+
+# Описание уже определенного вида (текстовый запрос без фото)
+PLANT_DESCRIPTION_PROMPT = """Ты - дружелюбный эксперт по растениям. Пользователь сфотографировал растение, это {name} ({latin}).
+
+Пожалуйста, предоставь:
+1. 🌿 Название растения (на русском языке)
+2. 🌱 Краткое описание внешнего вида
+3. 💡 Интересные факты о растении
+4. 🌍 Где обычно растет
+5. 🌸 Период цветения (если применимо)
+6. 🏠 Можно ли выращивать дома
+
+Будь дружелюбным, используй эмодзи и пиши простым языком.
+
+Ответ должен быть информативным, но не слишком длинным (максимум 300 слов)."""
+
+# Уточняющий вопрос о растении, которое бот уже распознал
+FOLLOWUP_PROMPT = """Ты - дружелюбный эксперт по растениям. Ты уже распознал растение на фото пользователя и ответил так:
+
+{answer}
+
+Предыдущие вопросы пользователя об этом растении:
+{history}
+Новый вопрос: {question}
+
+Ответь на вопрос об этом растении кратко (до 120 слов), просто и с эмодзи. Если вопрос касается безопасности (ядовитость, съедобность), будь осторожен и посоветуй проверить у специалиста."""
+
 # Настройки для экспертного режима распознавания растений
 EXPERT_RECOGNITION_PROMPT = """Ты - элитный ботаник-систематик с международным признанием в области таксономии растений. Твоя задача - провести МАКСИМАЛЬНО ДЕТАЛЬНЫЙ анализ растения с научной точностью.
 
@@ -125,6 +321,50 @@ EXPERT_RECOGNITION_PROMPT = """Ты - элитный ботаник-систем
 
 РАБОТАЙ КАК НАСТОЯЩИЙ УЧЕНЫЙ: методично, точно, с научным обоснованием каждого вывода."""
 
+# Этап map: наблюдения по одному фото для экспертного анализа map-reduce
+EXPERT_OBSERVATION_PROMPT = """Ты - ботаник. Опиши, что видно на фото растения, по органам. Не определяй вид, только наблюдения.
+
+• ГАБИТУС: жизненная форма, высота (если можно оценить)
+• ЛИСТЬЯ: расположение, форма, край, жилкование, опушение
+• СТЕБЕЛЬ/СТВОЛ: тип, сечение, поверхность
+• ЦВЕТКИ/СОЦВЕТИЯ: тип, строение, окраска
+• ПЛОДЫ/СЕМЕНА: тип, форма, окраска
+• ОКРУЖЕНИЕ: место произрастания
+
+Пропускай органы, которых не видно. Кратко, не больше 120 слов."""
+
+# Этап reduce: добавляется к экспертному промпту вместо фотографий
+EXPERT_SYNTHESIS_PROMPT = """
+
+📋 НАБЛЮДЕНИЯ ПО ФОТОГРАФИЯМ ({count} шт.): сами фото ты не видишь, их уже описал другой ботаник. Проведи анализ по этим наблюдениям, сопоставь признаки с разных фото.
+
+{observations}"""
+
+# Добавляется к экспертному промпту, когда фото собраны в сетку
+CONTACT_SHEET_PROMPT = """
+
+🧩 {count} ФОТОГРАФИЙ СОБРАНЫ В ОДНО ИЗОБРАЖЕНИЕ-СЕТКУ: номер фото (1-{count}, слева направо и сверху вниз) указан в левом верхнем углу каждого фото. Проанализируй все фото в комплексе и при описании признаков ссылайся на номера фото."""
+
+# Короткие варианты промптов для работы под нагрузкой
+PLANT_RECOGNITION_PROMPT_SHORT = """Ты - дружелюбный эксперт по растениям. Определи растение на фото и кратко ответь:
+1. 🌿 Название (русское и латинское)
+2. 🌱 Как выглядит
+3. 🌍 Где растет
+4. 🏠 Можно ли выращивать дома
+
+Пиши просто, с эмодзи, не больше 120 слов. Если растение плохо видно, попроси фото получше."""
+
+EXPERT_RECOGNITION_PROMPT_SHORT = """Ты - ботаник-систематик. Определи растение по фото как можно точнее.
+
+ФОРМАТ ОТВЕТА:
+🔬 **КЛЮЧЕВЫЕ ПРИЗНАКИ** (кратко)
+🌿 **СИСТЕМАТИКА** (семейство → род → вид)
+🎯 **ОПРЕДЕЛЕНИЕ** (русское + латинское название)
+📊 **АЛЬТЕРНАТИВЫ** (1-2 варианта с %)
+📈 **УВЕРЕННОСТЬ** (%)
+
+Учти дополнительный текст пользователя и все фото. Будь краток: не больше 250 слов."""
+
 # Эмодзи для бота
 EMOJIS = {
     'welcome': '🌱',
@@ -176,6 +416,10 @@ ERROR_MESSAGES = {
     'no_text': "Пожалуйста, отправь фотографию, а не текст! 🌿"
 }
 
+# Внешний JSON-файл с уроками (опционально, заменяет BIOLOGY_LESSONS)
+# Файл можно менять без перезапуска: он перечитывается перед рассылкой и по команде /reload_lessons
+LESSONS_FILE = os.getenv('LESSONS_FILE')
+
 # Коллекция ежедневных мини-уроков по биологии
 BIOLOGY_LESSONS = [
     {
@@ -0,0 +1,85 @@
+"""Контекст для уточняющих вопросов о последнем распознанном растении
+
+После распознавания в памяти остается текст ответа (без фото), и
+вопросы вроде «оно ядовито для кошек?» отправляются модели дешевым
+текстовым запросом вместо повторного анализа фото. Контекст живет
+FOLLOWUP_TTL секунд с последнего вопроса, история ограничена
+FOLLOWUP_MAX_TURNS последними вопросами.
+"""
+
+import time
+from collections import deque
+import config
+
+class _Context:
+    __slots__ = ('answer', 'turns', 'updated')
+
+    def __init__(self, answer, max_turns, now):
+        self.answer = answer
+        self.turns = deque(maxlen=max_turns)
+        self.updated = now
+
+class ConversationStore:
+    """Контексты пользователей в памяти процесса"""
+
+    def __init__(self, ttl=900, max_turns=3, max_answer_chars=2000, clock=time.monotonic):
+        """
+        Args:
+            ttl: Через сколько секунд без вопросов контекст забывается
+            max_turns: Сколько последних вопросов с ответами хранится
+            max_answer_chars: Длина сохраняемого ответа о растении
+            clock: Источник времени (для тестов)
+        """
+        self.ttl = ttl
+        self.max_turns = max_turns
+        self.max_answer_chars = max_answer_chars
+        self.clock = clock
+        self._contexts = {}
+
+    @classmethod
+    def from_config(cls):
+        return cls(
+            ttl=config.FOLLOWUP_TTL,
+            max_turns=config.FOLLOWUP_MAX_TURNS,
+            max_answer_chars=config.FOLLOWUP_ANSWER_CHARS
+        )
+
+    def start(self, user_id, answer):
+        """Запоминает ответ о растении, предыдущий контекст пользователя заменяется"""
+        now = self.clock()
+        self._purge(now)
+        self._contexts[user_id] = _Context(answer[:self.max_answer_chars], self.max_turns, now)
+
+    def get(self, user_id):
+        """Действующий контекст пользователя или None"""
+        context = self._contexts.get(user_id)
+        if context is None:
+            return None
+        if self.clock() - context.updated > self.ttl:
+            del self._contexts[user_id]
+            return None
+        return context
+
+    def add_turn(self, user_id, question, answer):
+        context = self.get(user_id)
+        if context is not None:
+            context.turns.append((question, answer))
+            context.updated = self.clock()
+
+    def clear(self, user_id):
+        self._contexts.pop(user_id, None)
+
+    def __len__(self):
+        return len(self._contexts)
+
+    def _purge(self, now):
+        expired = [user_id for user_id, context in self._contexts.items() if now - context.updated > self.ttl]
+        for user_id in expired:
+            del self._contexts[user_id]
+
+def followup_prompt(context, question):
+    """Текстовый промпт уточняющего вопроса с ответом о растении и историей"""
+    history = "".join(f"\nВопрос: {q}\nОтвет: {a}\n" for q, a in context.turns)
+    return config.FOLLOWUP_PROMPT.format(answer=context.answer, history=history or "\n(вопросов еще не было)\n", question=question)
+
+store = ConversationStore.from_config()
@@ -0,0 +1,146 @@
+"""Деградация качества ответов под нагрузкой
+
+Контроллер следит за глубиной очереди распознавания и p95 задержки
+ответов моделей. Под нагрузкой он ступенчато упрощает запросы:
+
+    уровень 1 - меньше max_tokens и короткие варианты промптов;
+    уровень 2 - вдобавок быстрые модели (FAST_MODELS) идут первыми;
+    уровень 3 - вдобавок экспертный анализ заменяется быстрым определением.
+
+Повышение уровня происходит сразу, понижение - по одной ступени, когда
+нагрузка опустилась ниже порога выхода и на текущем уровне прошло не
+меньше DEGRADATION_MIN_DWELL секунд (гистерезис). Каждое решение
+пишется в лог и считается в metrics.
+"""
+
+import logging
+import time
+from collections import deque
+import config
+import metrics
+import recognition_queue
+import token_ledger
+
+logger = logging.getLogger(__name__)
+
+MAX_LEVEL = 3
+
+# Базовые лимиты ответа по типу задачи
+BASE_MAX_TOKENS = {'plant': 1000, 'expert': 1500}
+
+class DegradationController:
+    """Выбирает модель, длину ответа и промпт с учетом текущей нагрузки"""
+    
+    def __init__(self, depth_source, queue_thresholds, latency_thresholds,
+                 recovery_ratio=0.5, min_dwell=30, latency_window=50, clock=time.monotonic):
+        """
+        Args:
+            depth_source: Функция, возвращающая текущую глубину очереди
+            queue_thresholds: Глубина очереди для входа на уровни 1, 2, 3
+            latency_thresholds: p95 задержки (сек) для входа на уровни 1, 2, 3
+            recovery_ratio: Доля порога, ниже которой можно спуститься на уровень
+            min_dwell: Минимальное время на уровне перед понижением (сек)
+            latency_window: Сколько последних задержек учитывать
+        """
+        self._depth_source = depth_source
+        self.queue_thresholds = list(queue_thresholds)
+        self.latency_thresholds = list(latency_thresholds)
+        self.recovery_ratio = recovery_ratio
+        self.min_dwell = min_dwell
+        self._latencies = deque(maxlen=latency_window)
+        self._clock = clock
+        self.level = 0
+        self._level_since = clock()
+    
+    @classmethod
+    def from_config(cls):
+        return cls(
+            depth_source=lambda: recognition_queue.scheduler.depth(),
+            queue_thresholds=config.DEGRADATION_QUEUE_THRESHOLDS,
+            latency_thresholds=config.DEGRADATION_LATENCY_THRESHOLDS,
+            recovery_ratio=config.DEGRADATION_RECOVERY_RATIO,
+            min_dwell=config.DEGRADATION_MIN_DWELL
+        )
+    
+    def observe_latency(self, seconds):
+        """Запоминает задержку ответа модели"""
+        self._latencies.append(seconds)
+    
+    def take_latencies(self):
+        """Забирает накопленные задержки (для передачи из процесса-воркера)"""
+        taken = list(self._latencies)
+        self._latencies.clear()
+        return taken
+    
+    def latency_p95(self):
+        """95-й перцентиль недавних задержек (0, если данных нет)"""
+        if not self._latencies:
+            return 0.0
+        ordered = sorted(self._latencies)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))]
+    
+    @staticmethod
+    def _level_for(value, thresholds, scale=1.0):
+        return sum(1 for threshold in thresholds if value >= threshold * scale)
+    
+    def evaluate(self):
+        """Пересчитывает уровень деградации и возвращает его"""
+        depth = self._depth_source()
+        p95 = self.latency_p95()
+        target = max(self._level_for(depth, self.queue_thresholds),
+                     self._level_for(p95, self.latency_thresholds))
+        target = min(target, MAX_LEVEL)
+        
+        now = self._clock()
+        if target > self.level:
+            self._set_level(target, now, depth, p95)
+        elif target < self.level and now - self._level_since >= self.min_dwell:
+            # Спускаемся, только если нагрузка ниже порога выхода текущего уровня
+            recovered = max(self._level_for(depth, self.queue_thresholds, self.recovery_ratio),
+                            self._level_for(p95, self.latency_thresholds, self.recovery_ratio))
+            if recovered < self.level:
+                self._set_level(self.level - 1, now, depth, p95)
+        return self.level
+    
+    def _set_level(self, level, now, depth, p95):
+        logger.warning(f"Уровень деградации {self.level} -> {level} (очередь {depth}, p95 {p95:.1f} с)")
+        metrics.increment('degradation_level_changes')
+        self.level = level
+        self._level_since = now
+    
+    def plan(self, task_type):
+        """Параметры запроса для типа задачи при текущей нагрузке
+
+        Returns:
+            dict: task_type, max_tokens, models (ключи AVAILABLE_MODELS), short_prompt, level
+        """
+        level = self.evaluate()
+        
+        if task_type == 'expert' and level >= 3:
+            task_type = 'plant'
+        
+        # Лимит по наблюдаемой длине ответов (token_ledger), не больше базового
+        max_tokens = token_ledger.ledger.max_tokens(task_type, BASE_MAX_TOKENS.get(task_type, BASE_MAX_TOKENS['plant']))
+        if level >= 1:
+            max_tokens = int(max_tokens * config.DEGRADED_MAX_TOKENS_RATIO)
+        
+        models = list(config.FALLBACK_MODELS)
+        if level >= 2:
+            fast = [key for key in config.FAST_MODELS if key in config.AVAILABLE_MODELS]
+            models = fast + [key for key in models if key not in fast]
+        
+        decision = {
+            'task_type': task_type,
+            'max_tokens': max_tokens,
+            'models': models,
+            'short_prompt': level >= 1,
+            'level': level
+        }
+        
+        metrics.increment(f'degradation_decisions_level_{level}')
+        if level:
+            logger.info(f"Деградация уровня {level}: {task_type}, max_tokens={max_tokens}, первая модель {models[0]}")
+        
+        return decision
+
+controller = DegradationController.from_config()
@@ -0,0 +1,68 @@
+"""Локальная замена OpenRouter для тестов и бенчмарков
+
+Отвечает на POST /chat/completions в формате OpenRouter, не обращаясь
+к сети. Бот направляется на нее через OPENROUTER_BASE_URL; процессы,
+запущенные после start(), получают адрес через переменную окружения.
+"""
+
+import asyncio
+import json
+import os
+from aiohttp import web
+
+class FakeOpenRouter:
+    """HTTP-сервер с ответами в формате chat/completions"""
+
+    def __init__(self, content="Роза", delay=0.0, reject_image_urls=False, statuses=()):
+        """
+        Args:
+            content: Текст ответа модели или функция (тело запроса) -> текст
+            delay: Задержка ответа (сек), имитирует время генерации, или функция (тело запроса) -> секунды
+            reject_image_urls: Отвечать 400 на изображения-ссылки (не data:)
+            statuses: Ответы-ошибки на первые запросы по порядку: статус или
+                (статус, заголовки); затем - обычные ответы
+        """
+        self.content = content
+        self.delay = delay
+        self.reject_image_urls = reject_image_urls
+        self.statuses = list(statuses)
+        self.requests = []
+        self.models = []
+        self.last_body = None
+        self.base_url = None
+        self._runner = None
+
+    async def _completions(self, request):
+        payload = await request.read()
+        self.requests.append(len(payload))
+        self.last_body = json.loads(payload)
+        self.models.append(self.last_body['model'])
+        if self.reject_image_urls and b'"url":"http' in payload:
+            return web.json_response({'error': {'message': 'image URLs are not supported'}}, status=400)
+        if self.statuses:
+            status = self.statuses.pop(0)
+            status, headers = status if isinstance(status, tuple) else (status, {})
+            return web.json_response({'error': {'code': status, 'message': 'fake error'}}, status=status, headers=headers)
+        await asyncio.sleep(self.delay(self.last_body) if callable(self.delay) else self.delay)
+        content = self.content(self.last_body) if callable(self.content) else self.content
+        # Токены оцениваются грубо, по 4 байта на токен
+        usage = {'prompt_tokens': len(payload) // 4, 'completion_tokens': max(1, len(content.encode()) // 4)}
+        return web.json_response({'choices': [{'message': {'content': content}}], 'usage': usage})
+
+    async def start(self):
+        """Запускает сервер на свободном порту и возвращает базовый URL"""
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.router.add_post('/chat/completions', self._completions)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, '127.0.0.1', 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.base_url = f"http://127.0.0.1:{port}"
+        os.environ['OPENROUTER_BASE_URL'] = self.base_url
+        return self.base_url
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
@@ -1,17 +1,79 @@
+import asyncio
 import logging
-from telegram import Update
+import math
+from telegram import Document, Update
 from telegram.ext import ContextTypes
 import config
+import conversation
+import degradation
+import image_proxy
+import imaging
+import intents
+import job_store
+import lessons
+import metrics
+import recognition_queue
+import recognition_workers
+import sharding
+import species_cache
+import throttling
+import token_ledger
 import utils
 from keyboards import *
 
+def throttle_rejection_text(reason, retry_after):
+    """Короткий ответ на запрос, не прошедший ограничение частоты"""
+    if reason == 'duplicate':
+        return "🔁 Это фото уже было отправлено совсем недавно. Пришли другое фото растения! 📸"
+    
+    seconds = max(1, math.ceil(retry_after))
+    if reason == 'global_rate':
+        return f"🌿 Сейчас очень много запросов. Попробуй еще раз через {seconds} сек. 🙏"
+    return f"⏳ Не так быстро! Следующий запрос можно отправить через {seconds} сек."
+
+# Ответы на фото, не прошедшие локальную проверку качества
+QUALITY_ISSUE_TEXT = {
+    'small': "🔍 Фото слишком маленькое - на нем не разглядеть растение.",
+    'dark': "🌑 Фото слишком темное - растение почти не видно.",
+    'bright': "☀️ Фото пересвечено - детали растения потерялись.",
+    'blurry': "🌫 Фото размыто - по нему не определить растение.",
+}
+
+QUEUE_FULL_TEXT = "🌿 Сейчас очень много запросов, очередь заполнена. Попробуй еще раз через пару минут! 🙏"
+
+def queue_position_updater(edit, header, running_line):
+    """Колбэк для планировщика, показывающий место в очереди в статусном сообщении
+
+    Args:
+        edit: Функция (текст) -> корутина редактирования статусного сообщения
+        header: Неизменная часть статуса
+        running_line: Строка, которая показывается во время обработки
+    """
+    queued = False
+    
+    async def on_position(position):
+        nonlocal queued
+        if position:
+            queued = True
+            await edit(f"{header}\n🕐 Место в очереди: {position}")
+        elif queued:
+            await edit(f"{header}\n{running_line}")
+    
+    return on_position
+
 async def handle_expert_photo(update: Update, context: ContextTypes.DEFAULT_TYPE, photo):
     """Обработчик фотографий в экспертном режиме"""
     user = update.effective_user
     
+    # Новое фото делает выполняющийся анализ устаревшим
+    utils.cancel_recognition(user.id)
+    
     # Скачиваем фото
-    file = await context.bot.get_file(photo.file_id)
-    image_bytes = await file.download_as_bytearray()
+    try:
+        image_bytes = await load_attachment(context.bot, photo, 'expert')
+    except imaging.ImageRejectedError as e:
+        await update.message.reply_text(str(e), reply_markup=get_expert_actions_keyboard())
+        return
     
     # Дублируем запрос администратору
     await utils.duplicate_photo_request(context, user, image_bytes)
@@ -19,16 +81,6 @@ async def handle_expert_photo(update: Update, context: ContextTypes.DEFAULT_TYPE
     # Добавляем фото к данным пользователя
     photo_count = utils.add_expert_photo(user.id, image_bytes)
     
-    # Создаем клавиатуру для управления экспертным режимом
-    keyboard = [
-        [InlineKeyboardButton("📸 Добавить еще фото", callback_data="add_more_photos")],
-        [InlineKeyboardButton("✍️ Добавить описание", callback_data="add_description")],
-        [InlineKeyboardButton("🧬 Начать анализ", callback_data="start_expert_analysis_now")],
-        [InlineKeyboardButton("🗑️ Очистить все", callback_data="clear_expert_data")],
-        [InlineKeyboardButton("🏠 Главное меню", callback_data="main_menu")]
-    ]
-    expert_keyboard = InlineKeyboardMarkup(keyboard)
-    
     expert_data = utils.get_expert_data(user.id)
     additional_text_status = "✅ Есть описание" if expert_data and expert_data['additional_text'] else "❌ Нет описания"
     
@@ -41,7 +93,7 @@ async def handle_expert_photo(update: Update, context: ContextTypes.DEFAULT_TYPE
         f"• Добавить текстовое описание (место находки, особенности и т.д.)\n"
         f"• Начать экспертный анализ с имеющимися данными\n\n"
         f"💡 **Совет:** Больше фото и дополнительная информация = точнее результат!",
-        reply_markup=expert_keyboard,
+        reply_markup=get_expert_actions_keyboard(),
         parse_mode='Markdown'
     )
 
@@ -59,24 +111,59 @@ async def handle_expert_analysis(query):
         )
         return
     
+    # Проверяем лимиты до обращения к API
+    admitted, reason, retry_after = throttling.recognition_throttle.admit(user_id, cost=config.THROTTLE_EXPERT_COST)
+    if not admitted:
+        await query.edit_message_text(
+            throttle_rejection_text(reason, retry_after),
+            reply_markup=get_expert_actions_keyboard(bool(expert_data['additional_text']))
+        )
+        return
+    
     # Показываем статус анализа
-    await query.edit_message_text(
+    status_header = (
         f"🧬 **Начинаю экспертный анализ...**\n\n"
         f"📊 **Данные для анализа:**\n"
         f"📸 Фотографий: {len(expert_data['photos'])}\n"
         f"✍️ Описание: {'✅ Есть' if expert_data['additional_text'] else '❌ Нет'}\n\n"
-        f"🔬 Выполняю научную идентификацию...\n"
-        f"⏳ Это может занять некоторое время...",
+        f"🔬 Выполняю научную идентификацию..."
+    )
+    running_line = "⏳ Это может занять некоторое время..."
+    await query.edit_message_text(
+        f"{status_header}\n{running_line}",
         parse_mode='Markdown'
     )
     
+    job_id = None
     try:
-        # Запускаем экспертный анализ
-        recognition_info, error = await utils.recognize_plant_expert_mode(
-            expert_data['photos'], 
-            expert_data['additional_text']
+        # Сохраняем задачу, чтобы ответить даже после перезапуска бота
+        job_id = await job_store.store.add_async(
+            'expert', user_id, query.message.chat_id, expert_data['photos'],
+            status_message_id=query.message.message_id,
+            additional_text=expert_data['additional_text']
         )
         
+        # Запускаем экспертный анализ через очередь распознавания
+        outcome = await utils.run_recognition(user_id, recognition_queue.scheduler.submit(
+            'expert', user_id,
+            lambda: recognition_workers.recognize('expert', expert_data['photos'], expert_data['additional_text'], user_id),
+            on_position=queue_position_updater(
+                lambda text: query.edit_message_text(text, parse_mode='Markdown'),
+                status_header, running_line
+            )
+        ))
+        
+        if outcome is None:
+            # Анализ заменен более новым действием - убираем осиротевший статус
+            logger.info(f"Экспертный анализ пользователя {user_id} отменен")
+            try:
+                await query.message.delete()
+            except Exception:
+                pass
+            return
+        
+        recognition_info, error = outcome
+        
         if recognition_info:
             # Форматируем и отправляем результат
             formatted_response = utils.format_expert_response(recognition_info)
@@ -88,6 +175,8 @@ async def handle_expert_analysis(query):
             
             # Очищаем данные после успешного анализа
             utils.clear_expert_data(user_id)
+            # Дальше на вопросы о растении можно отвечать по тексту анализа
+            conversation.store.start(user_id, recognition_info)
             
             # Отправляем клавиатуру для нового анализа
             await query.message.reply_text(
@@ -106,6 +195,17 @@ async def handle_expert_analysis(query):
                 parse_mode='Markdown'
             )
             
+    except recognition_queue.QueueFullError:
+        await query.edit_message_text(
+            QUEUE_FULL_TEXT,
+            reply_markup=get_expert_actions_keyboard(bool(expert_data['additional_text']))
+        )
+    
+    except asyncio.CancelledError:
+        # Бот останавливается: задача остается в базе и будет повторена
+        job_id = None
+        raise
+    
     except Exception as e:
         logger.error(f"Ошибка экспертного анализа для пользователя {user_id}: {e}")
         await query.edit_message_text(
@@ -114,6 +214,10 @@ async def handle_expert_analysis(query):
             reply_markup=get_expert_mode_keyboard(),
             parse_mode='Markdown'
         )
+    
+    finally:
+        if job_id is not None:
+            await job_store.store.complete_async(job_id)
 
 # Настройка логирования
 logging.basicConfig(
@@ -122,484 +226,81 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Обработчик команды /start"""
-    user = update.effective_user
-    welcome_message = utils.get_random_message(config.WELCOME_MESSAGES)
-    
-    full_message = f"{welcome_message}\n\nПривет, {user.first_name}! 👋\n\nЯ - твой дружелюбный помощник по растениям! 🌱\n\nОтправь мне фотографию любого растения, и я расскажу тебе о нем все самое интересное! 📸\n\nИспользуй кнопки ниже для навигации:"
-    
-    await update.message.reply_text(
-        full_message,
-        reply_markup=get_main_keyboard(),
-        parse_mode='Markdown'
-    )
-    
-    # Проверяем количество запросов и отправляем промо при необходимости
-    await utils.check_and_send_promo(update, context, user.id)
-    
-    logger.info(f"Пользователь {user.id} ({user.username}) запустил бота")
-
-async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Обработчик команды /help"""
-    help_text = """❓ **Как я могу помочь?**
+# Тексты экранов (общие для команд, текстовых кнопок и callback-запросов)
+INTRO_TEXT = "Я - твой дружелюбный помощник по растениям! 🌱\n\nОтправь мне фотографию любого растения, и я расскажу тебе о нем все самое интересное! 📸"
 
-Я - эксперт по растениям! Вот что я умею:
+HELP_PHOTO_TEXT = """📸 **Как отправить фото растения:**
 
-🌿 **Распознавать растения** по фотографиям
-💡 **Рассказывать интересные факты** о каждом растении
-🌍 **Объяснять**, где растет растение
-🌸 **Информировать** о периоде цветения
-🏠 **Давать советы** по выращиванию дома
+1. **Сделай новое фото:**
+   • Нажми на скрепку 📎
+   • Выбери "Камера" 📱
+   • Сфотографируй растение
+   • Отправь фото
 
-**Как использовать:**
-1. 📸 Отправь мне фотографию растения
-2. 🔍 Я проанализирую изображение
-3. 🌱 Получи подробную информацию!
+2. **Выбери из галереи:**
+   • Нажми на скрепку 📎
+   • Выбери "Галерея" 🖼️
+   • Найди фото растения
+   • Отправь фото
 
-Выбери, что тебя интересует:"""
-    
-    await update.message.reply_text(
-        help_text,
-        reply_markup=get_help_keyboard(),
-        parse_mode='Markdown'
-    )
-    
-    # Проверяем количество запросов и отправляем промо при необходимости
-    user = update.effective_user
-    await utils.check_and_send_promo(update, context, user.id)
+**Советы для лучшего распознавания:**
+• 📱 Фото должно быть четким
+• 🌿 Растение должно занимать большую часть кадра
+• ☀️ Хорошее освещение
+• 🔍 Фокус на растении, а не на фоне"""
 
-async def about_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Обработчик команды /about"""
-    about_text = """ℹ️ **О боте "Растения-Эксперт"**
+HELP_TIPS_TEXT = """🌱 **Советы по фотографированию растений:**
 
-Я создан, чтобы помочь тебе узнать больше о мире растений! 🌱
+**Для лучшего распознавания:**
 
-**Мои возможности:**
-• 🔍 Точное распознавание растений по фото
-• 📚 Обширная база знаний о растениях
-• 💡 Интересные факты и советы
-• 🌍 Информация о местах произрастания
-• 🏠 Рекомендации по домашнему выращиванию
+📸 **Качество фото:**
+• Используй хорошее освещение ☀️
+• Фото должно быть четким и не размытым
+• Избегай теней и бликов
 
-**Технологии:**
-• 🤖 Искусственный интеллект Qwen
-• 📸 Анализ изображений
-• 🌐 OpenRouter API
+🌿 **Композиция:**
+• Растение должно занимать 70-80% кадра
+• Покажи листья, цветы, стебель
+• Убери отвлекающие предметы с фона
 
-Выбери, что хочешь узнать подробнее:"""
-    
-    await update.message.reply_text(
-        about_text,
-        reply_markup=get_about_keyboard(),
-        parse_mode='Markdown'
-    )
-    
-    # Проверяем количество запросов и отправляем промо при необходимости
-    user = update.effective_user
-    await utils.check_and_send_promo(update, context, user.id)
+🔍 **Детали:**
+• Сфотографируй характерные части растения
+• Если есть цветы - обязательно включи их
+• Покажи форму листьев
 
-async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Обработчик фотографий растений и экспертного режима"""
-    user = update.effective_user
-    
-    # Определяем режим распознавания
-    recognition_mode = utils.get_user_recognition_mode(user.id)
-    
-    # Получаем фото с лучшим качеством
-    photo = update.message.photo[-1]
-    
-    if recognition_mode == "expert":
-        # Экспертный режим - обрабатываем множественные фото
-        await handle_expert_photo(update, context, photo)
-        return
-    
-    # Обычный режим распознавания растений
-    processing_message = utils.get_random_message(config.PHOTO_MESSAGES)
-    
-    status_message = await update.message.reply_text(
-        f"{processing_message}\n\n⏳ Обрабатываю изображение...",
-        reply_markup=get_main_menu_inline()
-    )
-    
-    try:
-        # Скачиваем фото
-        file = await context.bot.get_file(photo.file_id)
-        image_bytes = await file.download_as_bytearray()
-        
-        # Дублируем запрос администратору
-        await utils.duplicate_photo_request(context, user, image_bytes)
-        
-        # Распознаем растение
-        recognition_info, error = await utils.recognize_plant_with_qwen(image_bytes)
-        formatted_response = utils.format_plant_response(recognition_info) if recognition_info else None
-        log_message = "растение"
-        
-        if recognition_info:
-            # Отправляем результат
-            await update.message.reply_text(
-                formatted_response,
-                reply_markup=get_main_keyboard(),
-                parse_mode='Markdown'
-            )
-            
-            # Проверяем количество запросов и отправляем промо при необходимости
-            await utils.check_and_send_promo(update, context, user.id)
-            
-            logger.info(f"Пользователь {user.id} успешно распознал {log_message}")
-        else:
-            # Отправляем сообщение об ошибке
-            error_message = f"❌ {error}\n\nПопробуйте отправить более четкое фото растения! 📸"
-            
-            await update.message.reply_text(
-                error_message,
-                reply_markup=get_restart_keyboard()
-            )
-            
-            logger.warning(f"Ошибка распознавания {log_message} для пользователя {user.id}: {error}")
-        
-        # Очищаем режим после обработки фото
-        utils.clear_user_recognition_mode(user.id)
-    
-    except Exception as e:
-        logger.error(f"Ошибка при обработке фото пользователя {user.id}: {e}")
-        await update.message.reply_text(
-            "❌ Произошла ошибка при обработке фото. Попробуйте еще раз! 🔄",
-            reply_markup=get_restart_keyboard()
-        )
-        # Очищаем режим при ошибке
-        utils.clear_user_recognition_mode(user.id)
-    
-    finally:
-        # Удаляем статусное сообщение
-        try:
-            await status_message.delete()
-        except:
-            pass
+**Примеры хороших фото:**
+• Крупный план листа или цветка
+• Общий вид растения на нейтральном фоне
+• Фото в естественном освещении"""
 
-async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Обработчик текстовых сообщений"""
-    user = update.effective_user
-    text = update.message.text.lower()
-    
-    # Дублируем текстовый запрос администратору
-    await utils.duplicate_text_request(context, user, update.message.text)
-    
-    # Проверяем, ожидается ли текст в экспертном режиме
-    expert_data = utils.get_expert_data(user.id)
-    if expert_data and expert_data.get('waiting_for_text'):
-        # Сохраняем дополнительное описание
-        utils.set_expert_additional_text(user.id, update.message.text)
-        utils.set_expert_waiting_state(user.id, waiting_for_text=False)
-        
-        # Создаем клавиатуру для продолжения
-        keyboard = [
-            [InlineKeyboardButton("📸 Добавить еще фото", callback_data="add_more_photos")],
-            [InlineKeyboardButton("✍️ Изменить описание", callback_data="add_description")], 
-            [InlineKeyboardButton("🧬 Начать анализ", callback_data="start_expert_analysis_now")],
-            [InlineKeyboardButton("🗑️ Очистить все", callback_data="clear_expert_data")],
-            [InlineKeyboardButton("🏠 Главное меню", callback_data="main_menu")]
-        ]
-        expert_keyboard = InlineKeyboardMarkup(keyboard)
-        
-        photo_count = len(expert_data['photos'])
-        await update.message.reply_text(
-            f"✅ **Описание сохранено!**\n\n"
-            f"📸 **Фотографий:** {photo_count}\n"
-            f"✍️ **Описание:** ✅ Есть\n\n"
-            f"📝 **Ваше описание:**\n_{update.message.text}_\n\n"
-            f"Теперь можете добавить еще фото или начать анализ!",
-            reply_markup=expert_keyboard,
-            parse_mode='Markdown'
-        )
-        return
-    
-    if "распознать растение" in text or "растение" in text:
-        utils.set_user_recognition_mode(user.id, "plant")
-        await update.message.reply_text(
-            "🌿 Отлично! Отправь мне фотографию растения, и я его распознаю!\n\n📸 Просто сделай фото или выбери из галереи.",
-            reply_markup=get_main_menu_inline()
-        )
-        # Проверяем количество запросов и отправляем промо при необходимости
-        await utils.check_and_send_promo(update, context, user.id)
-    
-    elif "экспертный режим" in text or "экспертный" in text:
-        # Показываем информацию об экспертном режиме
-        expert_info_text = """🧬 **Экспертный режим распознавания**
+HELP_FEATURES_TEXT = """🔍 **Что я умею:**
 
-🎯 **Возможности экспертного режима:**
+🌿 **Распознавание растений:**
+• Определяю название растения
+• Описываю внешний вид
+• Рассказываю интересные факты
 
-• 📸 **Множественные фотографии** - отправьте несколько ракурсов растения
-• ✍️ **Дополнительная информация** - добавьте описание места находки, особенности
-• 🔬 **Научный анализ** - детальная морфологическая диагностика  
-• 📊 **Варианты определения** - получите несколько возможных видов с вероятностями
-• 🧠 **Экспертные рассуждения** - увидите логику определения
+🌍 **Географическая информация:**
+• Где растет растение в природе
+• Климатические условия
+• Тип почвы и среды обитания
 
-**Преимущества:**
-• Значительно выше точность определения
-• Систематический подход к анализу
-• Учет экологических факторов
-• Профессиональные рекомендации
+🌸 **Биологические особенности:**
+• Период цветения
+• Сезонность роста
+• Особенности ухода
 
-Готовы к научному подходу? 🔬"""
+🏠 **Домашнее выращивание:**
+• Можно ли выращивать дома
+• Требования к уходу
+• Советы по содержанию
 
-        await update.message.reply_text(
-            expert_info_text,
-            reply_markup=get_expert_mode_keyboard(),
-            parse_mode='Markdown'
-        )
-        # Проверяем количество запросов и отправляем промо при необходимости
-        await utils.check_and_send_promo(update, context, user.id)
-    
-    elif "цветочный тест люшера" in text or "цветочный тест" in text:
-        flower_test_text = """🌸 **Цветочный тест Люшера**
+💡 **Дополнительные возможности:**
+• Работаю с любыми растениями
+• Понимаю фото на разных языках
+• Даю дружелюбные ответы с эмодзи"""
 
-Ого! Узнал что за цветочек на фото, а хочешь узнать что за цветочек ты сам? 😉
-
-🌺 Этот психологический тест поможет тебе:
-• Узнать о своих скрытых качествах
-• Понять свое эмоциональное состояние
-• Открыть новые стороны личности
-
-Тест основан на выборе цветов, которые тебе больше всего нравятся. Каждый цвет расскажет что-то важное о тебе!
-
-Готов узнать, какой ты цветочек? 🌸"""
-        
-        await update.message.reply_text(
-            flower_test_text,
-            reply_markup=get_flower_test_keyboard(),
-            parse_mode='Markdown'
-        )
-        # Проверяем количество запросов и отправляем промо при необходимости
-        await utils.check_and_send_promo(update, context, user.id)
-    
-    elif "о боте" in text or "информация" in text:
-        await about_command(update, context)
-        # Проверяем количество запросов и отправляем промо при необходимости
-        await utils.check_and_send_promo(update, context, user.id)
-    
-    elif "помощь" in text or "help" in text:
-        await help_command(update, context)
-        # Проверяем количество запросов и отправляем промо при необходимости
-        await utils.check_and_send_promo(update, context, user.id)
-    
-    elif "обратная связь" in text or "отзыв" in text:
-        feedback_text = """💚 **Обратная связь**
-
-Мне очень важно твое мнение! Расскажи, как я работаю:
-
-• ⭐ Оцени мою работу
-• 💬 Предложи улучшения
-• 🐛 Сообщи об ошибках
-• 👨‍💼 Связаться с администратором
-• 🤝 Заказать похожего бота
-• 💝 Поддержать проект
-
-Выбери, что хочешь сделать:"""
-        
-        await update.message.reply_text(
-            feedback_text,
-            reply_markup=get_feedback_keyboard(),
-            parse_mode='Markdown'
-        )
-        # Проверяем количество запросов и отправляем промо при необходимости
-        await utils.check_and_send_promo(update, context, user.id)
-    
-    elif any(word in text for word in ["поддержка", "админ", "администратор", "связаться", "помощь с ботом"]):
-        admin_link, message_text = utils.get_admin_link_with_text("support")
-        contact_text = f"""👨‍💼 **Связь с администратором**
-
-🔗 **Нажми на ссылку**, чтобы написать админу:
-[Написать администратору]({admin_link})
-
-📝 **Готовый текст:**
-```
-{message_text}
-```
-
-💬 Скопируй текст и отправь администратору!"""
-        
-        await update.message.reply_text(
-            contact_text,
-            reply_markup=get_feedback_keyboard(),
-            parse_mode='Markdown'
-        )
-        # Проверяем количество запросов и отправляем промо при необходимости
-        await utils.check_and_send_promo(update, context, user.id)
-    
-    elif any(word in text for word in ["заказать бота", "создать бота", "разработка", "бизнес"]):
-        admin_link, message_text = utils.get_admin_link_with_text("order_bot")
-        order_text = f"""🤝 **Заказ бота**
-
-Хотите похожего бота? Обратитесь к разработчику!
-
-🔗 **Написать о заказе:**
-[Связаться с администратором]({admin_link})
-
-📝 **Готовый текст:**
-```
-{message_text}
-```
-
-🚀 Давайте обсудим ваш проект!"""
-        
-        await update.message.reply_text(
-            order_text,
-            reply_markup=get_feedback_keyboard(),
-            parse_mode='Markdown'
-        )
-        # Проверяем количество запросов и отправляем промо при необходимости
-        await utils.check_and_send_promo(update, context, user.id)
-    
-    elif any(word in text for word in ["поддержать", "донат", "спасибо", "благодарность"]):
-        admin_link, message_text = utils.get_admin_link_with_text("support_project")
-        support_text = f"""💝 **Поддержка проекта**
-
-Благодарим за желание поддержать проект! 🙏
-
-🔗 **Связаться с создателем:**
-[Написать администратору]({admin_link})
-
-📝 **Готовый текст:**
-```
-{message_text}
-```
-
-Ваша поддержка помогает развивать проект! 💚"""
-        
-        await update.message.reply_text(
-            support_text,
-            reply_markup=get_feedback_keyboard(),
-            parse_mode='Markdown'
-        )
-        # Проверяем количество запросов и отправляем промо при необходимости
-        await utils.check_and_send_promo(update, context, user.id)
-    
-    elif any(word in text for word in ["уроки биологии", "уроки", "биология", "ежедневные уроки"]):
-        await lessons_command(update, context)
-    
-    else:
-        await update.message.reply_text(
-            "🤔 Не совсем понимаю, что ты хочешь.\n\nОтправь мне фотографию растения для распознавания, или используй кнопки меню! 🌿",
-            reply_markup=get_main_keyboard()
-        )
-        # Проверяем количество запросов и отправляем промо при необходимости
-        await utils.check_and_send_promo(update, context, user.id)
-
-async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Обработчик callback запросов от инлайн кнопок"""
-    query = update.callback_query
-    await query.answer()
-    
-    # Дублируем callback запрос администратору
-    await utils.duplicate_callback_request(context, query.from_user, query.data)
-    
-    if query.data == "main_menu":
-        welcome_message = utils.get_random_message(config.WELCOME_MESSAGES)
-        user = update.effective_user
-        
-        full_message = f"{welcome_message}\n\nПривет, {user.first_name}! 👋\n\nЯ - твой дружелюбный помощник по растениям! 🌱\n\nОтправь мне фотографию любого растения, и я расскажу тебе о нем все самое интересное! 📸\n\nВыбери что тебя интересует:"
-        
-        await query.edit_message_text(
-            full_message,
-            reply_markup=get_main_keyboard_inline(),
-            parse_mode='Markdown'
-        )
-    
-    elif query.data == "help_photo":
-        help_photo_text = """📸 **Как отправить фото растения:**
-
-1. **Сделай новое фото:**
-   • Нажми на скрепку 📎
-   • Выбери "Камера" 📱
-   • Сфотографируй растение
-   • Отправь фото
-
-2. **Выбери из галереи:**
-   • Нажми на скрепку 📎
-   • Выбери "Галерея" 🖼️
-   • Найди фото растения
-   • Отправь фото
-
-**Советы для лучшего распознавания:**
-• 📱 Фото должно быть четким
-• 🌿 Растение должно занимать большую часть кадра
-• ☀️ Хорошее освещение
-• 🔍 Фокус на растении, а не на фоне"""
-        
-        await query.edit_message_text(
-            help_photo_text,
-            reply_markup=get_photo_tips_keyboard(),
-            parse_mode='Markdown'
-        )
-    
-    elif query.data == "help_tips":
-        tips_text = """🌱 **Советы по фотографированию растений:**
-
-**Для лучшего распознавания:**
-
-📸 **Качество фото:**
-• Используй хорошее освещение ☀️
-• Фото должно быть четким и не размытым
-• Избегай теней и бликов
-
-🌿 **Композиция:**
-• Растение должно занимать 70-80% кадра
-• Покажи листья, цветы, стебель
-• Убери отвлекающие предметы с фона
-
-🔍 **Детали:**
-• Сфотографируй характерные части растения
-• Если есть цветы - обязательно включи их
-• Покажи форму листьев
-
-**Примеры хороших фото:**
-• Крупный план листа или цветка
-• Общий вид растения на нейтральном фоне
-• Фото в естественном освещении"""
-        
-        await query.edit_message_text(
-            tips_text,
-            reply_markup=get_photo_tips_keyboard(),
-            parse_mode='Markdown'
-        )
-    
-    elif query.data == "help_features":
-        features_text = """🔍 **Что я умею:**
-
-🌿 **Распознавание растений:**
-• Определяю название растения
-• Описываю внешний вид
-• Рассказываю интересные факты
-
-🌍 **Географическая информация:**
-• Где растет растение в природе
-• Климатические условия
-• Тип почвы и среды обитания
-
-🌸 **Биологические особенности:**
-• Период цветения
-• Сезонность роста
-• Особенности ухода
-
-🏠 **Домашнее выращивание:**
-• Можно ли выращивать дома
-• Требования к уходу
-• Советы по содержанию
-
-💡 **Дополнительные возможности:**
-• Работаю с любыми растениями
-• Понимаю фото на разных языках
-• Даю дружелюбные ответы с эмодзи"""
-        
-        await query.edit_message_text(
-            features_text,
-            reply_markup=get_help_keyboard(),
-            parse_mode='Markdown'
-        )
-    
-    elif query.data == "about_features":
-        about_features_text = """🌟 **Мои возможности:**
+ABOUT_FEATURES_TEXT = """🌟 **Мои возможности:**
 
 🌿 **Точное распознавание:**
 • Определяю более 10,000 видов растений
@@ -625,15 +326,8 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
 • Простые объяснения
 • Красивые эмодзи
 • Позитивный настрой"""
-        
-        await query.edit_message_text(
-            about_features_text,
-            reply_markup=get_about_keyboard(),
-            parse_mode='Markdown'
-        )
-    
-    elif query.data == "about_tech":
-        tech_text = """🔧 **Технологии:**
+
+ABOUT_TECH_TEXT = """🔧 **Технологии:**
 
 🤖 **Искусственный интеллект:**
 • Модель Qwen 2.5 7B Instruct
@@ -659,15 +353,8 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
 • Защищенные API ключи
 • Валидация входных данных
 • Приватность пользователей"""
-        
-        await query.edit_message_text(
-            tech_text,
-            reply_markup=get_about_keyboard(),
-            parse_mode='Markdown'
-        )
-    
-    elif query.data == "about_examples":
-        examples_text = """💡 **Примеры работы:**
+
+ABOUT_EXAMPLES_TEXT = """💡 **Примеры работы:**
 
 🌹 **Роза:**
 • Название: Роза (Rosa)
@@ -692,26 +379,10 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
 • Где растет: Поля, сады, обочины дорог
 • Цветение: Лето-осень
 • Дома: Можно выращивать на балконе"""
-        
-        await query.edit_message_text(
-            examples_text,
-            reply_markup=get_about_keyboard(),
-            parse_mode='Markdown'
-        )
-    
 
-    
-    elif query.data == "new_photo" or query.data == "new_photo_plant":
-        utils.set_user_recognition_mode(query.from_user.id, "plant")
-        await query.edit_message_text(
-            "📱 **Новое фото растения:**\n\nОтлично! Готов к новому распознаванию! 🌿\n\nОтправь мне фотографию растения, и я его изучу! 📸\n\nПомни советы:\n• Четкое фото\n• Хорошее освещение\n• Растение в центре кадра\n\nЖду твое фото! 💚",
-            reply_markup=get_main_menu_inline(),
-            parse_mode='Markdown'
-        )
-    
-    elif query.data == "expert_mode":
-        # Показываем информацию об экспертном режиме
-        expert_info_text = """🧬 **Экспертный режим распознавания**
+NEW_PHOTO_TEXT = "📱 **Новое фото растения:**\n\nОтлично! Готов к новому распознаванию! 🌿\n\nОтправь мне фотографию растения, и я его изучу! 📸\n\nПомни советы:\n• Четкое фото\n• Хорошее освещение\n• Растение в центре кадра\n\nЖду твое фото! 💚"
+
+EXPERT_MODE_INFO_TEXT = """🧬 **Экспертный режим распознавания**
 
 🎯 **Возможности экспертного режима:**
 
@@ -729,34 +400,23 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 Готовы к научному подходу? 🔬"""
 
-        await query.edit_message_text(
-            expert_info_text,
-            reply_markup=get_expert_mode_keyboard(),
-            parse_mode='Markdown'
-        )
-    
-    elif query.data == "start_expert_analysis":
-        utils.set_user_recognition_mode(query.from_user.id, "expert")
-        await query.edit_message_text(
-            "🧬 **Экспертный режим активирован!**\n\n"
-            "📸 **Шаг 1:** Отправьте первое фото растения\n\n"
-            "💡 **Рекомендации для максимальной точности:**\n"
-            "• Общий вид растения (габитус)\n"
-            "• Крупный план листьев\n" 
-            "• Цветки/соцветия (если есть)\n"
-            "• Плоды/семена (если есть)\n"
-            "• Место произрастания\n\n"
-            "После загрузки фото вы сможете:\n"
-            "✍️ Добавить описание находки\n"
-            "📸 Загрузить дополнительные фотографии\n"
-            "🔬 Начать научный анализ\n\n"
-            "🎯 Начинайте загрузку фотографий!",
-            reply_markup=get_main_menu_inline(),
-            parse_mode='Markdown'
-        )
-    
-    elif query.data == "flower_test":
-        flower_test_text = """🌸 **Цветочный тест Люшера**
+START_EXPERT_ANALYSIS_TEXT = (
+    "🧬 **Экспертный режим активирован!**\n\n"
+    "📸 **Шаг 1:** Отправьте первое фото растения\n\n"
+    "💡 **Рекомендации для максимальной точности:**\n"
+    "• Общий вид растения (габитус)\n"
+    "• Крупный план листьев\n"
+    "• Цветки/соцветия (если есть)\n"
+    "• Плоды/семена (если есть)\n"
+    "• Место произрастания\n\n"
+    "После загрузки фото вы сможете:\n"
+    "✍️ Добавить описание находки\n"
+    "📸 Загрузить дополнительные фотографии\n"
+    "🔬 Начать научный анализ\n\n"
+    "🎯 Начинайте загрузку фотографий!"
+)
+
+FLOWER_TEST_TEXT = """🌸 **Цветочный тест Люшера**
 
 Ого! Узнал что за цветочек на фото, а хочешь узнать что за цветочек ты сам? 😉
 
@@ -765,242 +425,866 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
 • Понять свое эмоциональное состояние
 • Открыть новые стороны личности
 
-Тест основан на выборе цветов, которые тебе больше всего нравятся. Каждый цвет расскажет что-то важное о тебе!
+Тест основан на выборе цветов, которые тебе больше всего нравятся. Каждый цвет расскажет что-то важное о тебе!
+
+Готов узнать, какой ты цветочек? 🌸"""
+
+ADD_MORE_PHOTOS_TEXT = (
+    "📸 **Добавление фотографий**\n\n"
+    "Отправьте дополнительные фотографии растения.\n\n"
+    "💡 **Полезные ракурсы:**\n"
+    "• Разные части растения (листья, стебель, цветы)\n"
+    "• Детальные снимки характерных признаков\n"
+    "• Место произрастания (биотоп)\n\n"
+    "Каждое новое фото будет автоматически добавлено к анализу!"
+)
+
+ADD_DESCRIPTION_TEXT = (
+    "✍️ **Дополнительное описание**\n\n"
+    "Отправьте текстовое сообщение с дополнительной информацией:\n\n"
+    "📝 **Что указать:**\n"
+    "• Место находки (лес, поле, сад, болото)\n"
+    "• Время года и условия\n"
+    "• Размеры растения\n"
+    "• Особые признаки или запах\n"
+    "• Любые другие наблюдения\n\n"
+    "Напишите ваше описание следующим сообщением 👇"
+)
+
+EXPERT_DATA_CLEARED_TEXT = (
+    "🗑️ **Данные очищены**\n\n"
+    "Все фотографии и описания удалены.\n"
+    "Можете начать заново!"
+)
+
+EXPERT_HELP_TEXT = """🧬 **Что такое экспертный режим?**
+
+🎯 **Это продвинутый режим** для максимально точного определения растений с использованием научных методов ботаники.
+
+**🔬 Научный подход:**
+• Морфологический анализ всех органов
+• Систематическая классификация
+• Учет экологических факторов
+• Сравнение с ботаническими базами данных
+
+**📸 Множественные фото помогают:**
+• Увидеть растение под разными углами
+• Рассмотреть детали строения
+• Определить размеры и пропорции
+• Оценить условия произрастания
+
+**✍️ Текстовое описание дает:**
+• Информацию о биотопе
+• Данные о размерах
+• Особенности, не видные на фото
+• Дополнительный контекст
+
+**💡 Результат:** Значительно более точное и научно обоснованное определение!"""
+
+FEEDBACK_TEXT = """💚 **Обратная связь**
+
+Мне очень важно твое мнение! Расскажи, как я работаю:
+
+• ⭐ Оцени мою работу
+• 💬 Предложи улучшения
+• 🐛 Сообщи об ошибках
+• 👨‍💼 Связаться с администратором
+• 🤝 Заказать похожего бота
+• 💝 Поддержать проект
+
+Выбери, что хочешь сделать:"""
+
+SUBSCRIBE_SUCCESS_TEXT = """✅ **Подписка активирована!**
+
+🎉 Поздравляю! Теперь ты будешь получать ежедневные мини-уроки по биологии!
+
+📅 **Что дальше:**
+• Первый урок придет завтра в 10:00
+• Каждый день новая тема
+• Уроки будут интересными и простыми
+
+🔬 А пока можешь получить пробный урок прямо сейчас! 👇"""
+
+UNSUBSCRIBE_TEXT = """❌ **Подписка отменена**
+
+Жаль, что ты решил отписаться от уроков биологии! 😢
+
+🔄 **В любое время ты можешь:**
+• Снова подписаться на уроки
+• Получить разовый урок
+• Изучать растения через фотографии
+
+Буду рад видеть тебя снова! 💚"""
+
+LESSONS_SUBSCRIBED_TEXT = """🧬 **Ежедневные уроки биологии**
+
+✅ Ты подписан на ежедневные мини-уроки!
+
+📅 **Как это работает:**
+• Каждый день в 10:00 ты получаешь новый урок
+• Уроки простые и интересные
+• Каждый урок с фактами и вопросами для размышления
+
+🎯 **Что можно сделать:**"""
+
+LESSONS_UNSUBSCRIBED_TEXT = """🧬 **Ежедневные уроки биологии**
+
+Хочешь каждый день узнавать что-то новое о мире биологии? 🌱
+
+📚 **Что ты получишь:**
+• Короткие и понятные уроки
+• Интересные факты о живой природе
+• Вопросы для размышления
+• Дружелюбный и простой язык
+
+⏰ **Время отправки:** каждый день в 10:00
+
+Присоединяйся к изучению удивительного мира биологии! 🔬"""
+
+
+async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Обработчик команды /start"""
+    user = update.effective_user
+    welcome_message = utils.get_random_message(config.WELCOME_MESSAGES)
+    
+    full_message = f"{welcome_message}\n\nПривет, {user.first_name}! 👋\n\n{INTRO_TEXT}\n\nИспользуй кнопки ниже для навигации:"
+    
+    await update.message.reply_text(
+        full_message,
+        reply_markup=get_main_keyboard(),
+        parse_mode='Markdown'
+    )
+    
+    # Проверяем количество запросов и отправляем промо при необходимости
+    await utils.check_and_send_promo(update, context, user.id)
+    
+    logger.info(f"Пользователь {user.id} ({user.username}) запустил бота")
+
+async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Обработчик команды /help"""
+    help_text = """❓ **Как я могу помочь?**
+
+Я - эксперт по растениям! Вот что я умею:
+
+🌿 **Распознавать растения** по фотографиям
+💡 **Рассказывать интересные факты** о каждом растении
+🌍 **Объяснять**, где растет растение
+🌸 **Информировать** о периоде цветения
+🏠 **Давать советы** по выращиванию дома
+
+**Как использовать:**
+1. 📸 Отправь мне фотографию растения
+2. 🔍 Я проанализирую изображение
+3. 🌱 Получи подробную информацию!
+
+Выбери, что тебя интересует:"""
+    
+    await update.message.reply_text(
+        help_text,
+        reply_markup=get_help_keyboard(),
+        parse_mode='Markdown'
+    )
+    
+    # Проверяем количество запросов и отправляем промо при необходимости
+    user = update.effective_user
+    await utils.check_and_send_promo(update, context, user.id)
+
+async def about_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Обработчик команды /about"""
+    about_text = """ℹ️ **О боте "Растения-Эксперт"**
+
+Я создан, чтобы помочь тебе узнать больше о мире растений! 🌱
+
+**Мои возможности:**
+• 🔍 Точное распознавание растений по фото
+• 📚 Обширная база знаний о растениях
+• 💡 Интересные факты и советы
+• 🌍 Информация о местах произрастания
+• 🏠 Рекомендации по домашнему выращиванию
+
+**Технологии:**
+• 🤖 Искусственный интеллект Qwen
+• 📸 Анализ изображений
+• 🌐 OpenRouter API
+
+Выбери, что хочешь узнать подробнее:"""
+    
+    await update.message.reply_text(
+        about_text,
+        reply_markup=get_about_keyboard(),
+        parse_mode='Markdown'
+    )
+    
+    # Проверяем количество запросов и отправляем промо при необходимости
+    user = update.effective_user
+    await utils.check_and_send_promo(update, context, user.id)
+
+async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Обработчик фотографий растений и экспертного режима"""
+    user = update.effective_user
+    
+    # Определяем режим распознавания
+    recognition_mode = utils.get_user_recognition_mode(user.id)
+    
+    # Фото в полном размере
+    full_photo = update.message.photo[-1]
+    
+    if recognition_mode == "expert":
+        # Экспертный режим - обрабатываем множественные фото в полном размере
+        await handle_expert_photo(update, context, full_photo)
+        return
+    
+    # Для обычного распознавания достаточно размера, который модель не будет уменьшать
+    photo = utils.select_photo_size(update.message.photo, utils.photo_pixel_budget("plant"))
+    await recognize_plant_photo(update, context, photo, full_photo)
+
+async def handle_document(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Обработчик изображений, присланных файлом (без сжатия)"""
+    user = update.effective_user
+    document = update.message.document
+    
+    # Размер известен из сообщения - слишком большой файл даже не скачиваем
+    if document.file_size and document.file_size > config.DOCUMENT_MAX_BYTES:
+        await update.message.reply_text(imaging.document_too_large_text(), reply_markup=get_main_menu_inline())
+        return
+    
+    if utils.get_user_recognition_mode(user.id) == "expert":
+        await handle_expert_photo(update, context, document)
+        return
+    
+    await recognize_plant_photo(update, context, document, document)
+
+async def load_attachment(bot, attachment, kind):
+    """Байты фото (PhotoSize) или изображения, присланного файлом (Document)"""
+    if isinstance(attachment, Document):
+        pixel_budget = utils.photo_pixel_budget(kind) if kind == 'plant' else config.EXPERT_PIXEL_BUDGET
+        return await imaging.load_document(bot, attachment, pixel_budget, kind)
+    return await utils.download_photo(bot, attachment.file_id, kind)
+
+async def recognize_plant_photo(update, context, photo, full_photo):
+    """Обычное распознавание растения
+
+    Args:
+        photo: Фото (или документ), которое отправляется модели
+        full_photo: Полный размер для повтора при неуверенном ответе
+    """
+    user = update.effective_user
+    
+    # Проверяем лимиты до скачивания фото и обращения к API
+    admitted, reason, retry_after = throttling.recognition_throttle.admit(user.id, full_photo.file_unique_id)
+    if not admitted:
+        await update.message.reply_text(
+            throttle_rejection_text(reason, retry_after),
+            reply_markup=get_main_menu_inline()
+        )
+        return
+    
+    # Новое фото заменяет еще не завершенное распознавание
+    utils.cancel_recognition(user.id)
+    
+    # Обычный режим распознавания растений
+    processing_message = utils.get_random_message(config.PHOTO_MESSAGES)
+    
+    running_line = "⏳ Обрабатываю изображение..."
+    status_message = await update.message.reply_text(
+        f"{processing_message}\n\n{running_line}",
+        reply_markup=get_main_menu_inline()
+    )
+    
+    async def load_image(size):
+        if image_proxy.enabled() and recognition_workers.pool is None and not isinstance(size, Document):
+            # Модель получит ссылку на фото, скачивать его не нужно
+            return image_proxy.RemoteImage(size.file_id, context.bot, 'plant')
+        return await load_attachment(context.bot, size, 'plant')
+    
+    quality_issue = None
+    
+    async def recognize_plant():
+        nonlocal quality_issue
+        if config.QUALITY_GATE and not isinstance(image, image_proxy.RemoteImage):
+            # Заведомо непригодное фото не отправляем модели
+            quality_issue = await recognition_workers.check_quality(image)
+            if quality_issue:
+                return None, None
+        result = await recognition_workers.recognize('plant', [image], user_id=user.id)
+        if photo is not full_photo and result[0] and utils.is_low_confidence(result[0]):
+            # Модель сомневается - повторяем по фото в полном размере
+            logger.info(f"Неуверенное распознавание для пользователя {user.id}, повтор в полном размере")
+            metrics.increment('plant_full_size_retries')
+            result = await recognition_workers.recognize('plant', [await load_image(full_photo)], user_id=user.id)
+        return result
+    
+    metrics.increment('plant_recognitions')
+    job_id = None
+    try:
+        image = await load_image(photo)
+        
+        # Дублируем запрос администратору (фото - по file_id, без повторной загрузки)
+        await utils.duplicate_photo_request(context, user, image if isinstance(full_photo, Document) else full_photo.file_id)
+        
+        # Сохраняем задачу, чтобы ответить даже после перезапуска бота
+        job_id = await job_store.store.add_async(
+            'plant', user.id, update.message.chat_id, [image],
+            status_message_id=status_message.message_id,
+            reply_to_message_id=update.message.message_id
+        )
+        
+        # Распознаем растение через очередь распознавания
+        outcome = await utils.run_recognition(user.id, recognition_queue.scheduler.submit(
+            'plant', user.id,
+            recognize_plant,
+            on_position=queue_position_updater(
+                lambda text: status_message.edit_text(text, reply_markup=get_main_menu_inline()),
+                f"{processing_message}\n", running_line
+            )
+        ))
+        
+        if outcome is None:
+            # Распознавание заменено более новым действием, ответ никто не ждет
+            logger.info(f"Распознавание для пользователя {user.id} отменено")
+            return
+        
+        if quality_issue:
+            metrics.increment('quality_gate_avoided_calls')
+            metrics.increment(f'quality_gate_{quality_issue}')
+            logger.info(f"Фото пользователя {user.id} не прошло проверку качества: {quality_issue}")
+            await update.message.reply_text(
+                f"{QUALITY_ISSUE_TEXT[quality_issue]}\n\n{HELP_TIPS_TEXT}",
+                reply_markup=get_photo_tips_keyboard(),
+                parse_mode='Markdown'
+            )
+            # Исправленное фото можно прислать сразу
+            throttling.recognition_throttle.forget(user.id, full_photo.file_unique_id)
+            utils.clear_user_recognition_mode(user.id)
+            return
+        
+        recognition_info, error = outcome
+        formatted_response = utils.format_plant_response(recognition_info) if recognition_info else None
+        log_message = "растение"
+        
+        if recognition_info:
+            # Отправляем результат
+            await update.message.reply_text(
+                formatted_response,
+                reply_markup=get_main_keyboard(),
+                parse_mode='Markdown'
+            )
+            
+            # Дальше на вопросы о растении можно отвечать по тексту ответа
+            conversation.store.start(user.id, recognition_info)
+            
+            # Проверяем количество запросов и отправляем промо при необходимости
+            await utils.check_and_send_promo(update, context, user.id)
+            
+            logger.info(f"Пользователь {user.id} успешно распознал {log_message}")
+        else:
+            # Отправляем сообщение об ошибке
+            error_message = f"❌ {error}\n\nПопробуйте отправить более четкое фото растения! 📸"
+            
+            await update.message.reply_text(
+                error_message,
+                reply_markup=get_restart_keyboard()
+            )
+            
+            logger.warning(f"Ошибка распознавания {log_message} для пользователя {user.id}: {error}")
+            # Повтор того же фото после ошибки - не спам
+            throttling.recognition_throttle.forget(user.id, full_photo.file_unique_id)
+        
+        # Очищаем режим после обработки фото
+        utils.clear_user_recognition_mode(user.id)
+    
+    except recognition_queue.QueueFullError:
+        await update.message.reply_text(QUEUE_FULL_TEXT, reply_markup=get_restart_keyboard())
+        throttling.recognition_throttle.forget(user.id, full_photo.file_unique_id)
+        utils.clear_user_recognition_mode(user.id)
+    
+    except imaging.ImageRejectedError as e:
+        await update.message.reply_text(str(e), reply_markup=get_restart_keyboard())
+        throttling.recognition_throttle.forget(user.id, full_photo.file_unique_id)
+    
+    except asyncio.CancelledError:
+        # Бот останавливается: задача остается в базе и будет повторена
+        job_id = None
+        raise
+    
+    except Exception as e:
+        logger.error(f"Ошибка при обработке фото пользователя {user.id}: {e}")
+        throttling.recognition_throttle.forget(user.id, full_photo.file_unique_id)
+        await update.message.reply_text(
+            "❌ Произошла ошибка при обработке фото. Попробуйте еще раз! 🔄",
+            reply_markup=get_restart_keyboard()
+        )
+        # Очищаем режим при ошибке
+        utils.clear_user_recognition_mode(user.id)
+    
+    finally:
+        if job_id is not None:
+            await job_store.store.complete_async(job_id)
+        
+        # Удаляем статусное сообщение
+        try:
+            await status_message.delete()
+        except:
+            pass
+
+async def replay_recognition_jobs(application):
+    """Повторно запускает распознавания, прерванные перезапуском бота"""
+    jobs = await job_store.store.pending_async()
+    if jobs:
+        logger.info(f"Повторный запуск незавершенных распознаваний: {len(jobs)}")
+    for job in jobs:
+        application.create_task(replay_recognition_job(application.bot, job))
+
+async def replay_recognition_job(bot, job):
+    """Выполняет сохраненную задачу и отвечает в исходный чат"""
+    chat_id = job['chat_id']
+    # Фото, сохраненные ссылкой на файл в Telegram
+    photos = [image_proxy.RemoteImage(photo, bot) if isinstance(photo, str) else photo for photo in job['photos']]
+    try:
+        outcome = await utils.run_recognition(
+            job['user_id'], recognition_queue.scheduler.submit(
+                job['kind'], job['user_id'],
+                lambda: recognition_workers.recognize(job['kind'], photos, job['additional_text'], job['user_id'])
+            )
+        )
+        if outcome is None:
+            logger.info(f"Повторное распознавание для пользователя {job['user_id']} отменено")
+        elif job['kind'] == 'expert':
+            recognition_info, error = outcome
+            if recognition_info:
+                text = utils.format_expert_response(recognition_info)
+            else:
+                text = f"❌ **Ошибка анализа**\n\n{error}"
+            await bot.edit_message_text(
+                text, chat_id=chat_id, message_id=job['status_message_id'],
+                reply_markup=None if recognition_info else get_expert_mode_keyboard(),
+                parse_mode='Markdown'
+            )
+            if recognition_info:
+                await bot.send_message(
+                    chat_id,
+                    "🎯 **Анализ завершен!**\n\n"
+                    "Хотите провести новый экспертный анализ?",
+                    reply_markup=get_main_keyboard()
+                )
+        else:
+            recognition_info, error = outcome
+            if recognition_info:
+                await bot.send_message(
+                    chat_id, utils.format_plant_response(recognition_info),
+                    reply_to_message_id=job['reply_to_message_id'],
+                    allow_sending_without_reply=True,
+                    reply_markup=get_main_keyboard(),
+                    parse_mode='Markdown'
+                )
+            else:
+                await bot.send_message(
+                    chat_id, f"❌ {error}\n\nПопробуйте отправить более четкое фото растения! 📸",
+                    reply_to_message_id=job['reply_to_message_id'],
+                    allow_sending_without_reply=True,
+                    reply_markup=get_restart_keyboard()
+                )
+    except recognition_queue.QueueFullError:
+        # Очередь занята свежими запросами - попробуем при следующем старте
+        logger.warning(f"Очередь заполнена, задача {job['id']} отложена")
+        return
+    except Exception as e:
+        logger.error(f"Ошибка повторного распознавания задачи {job['id']}: {e}")
+        return
+    
+    await job_store.store.complete_async(job['id'])
+    metrics.increment(f"jobs_replayed_{job['kind']}")
+    
+    # Статус обычного или отмененного распознавания больше не нужен
+    if (job['kind'] == 'plant' or outcome is None) and job['status_message_id']:
+        try:
+            await bot.delete_message(chat_id, job['status_message_id'])
+        except Exception:
+            pass
+
+async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Обработчик текстовых сообщений"""
+    user = update.effective_user
+    text = update.message.text.lower()
+    
+    # Дублируем текстовый запрос администратору
+    await utils.duplicate_text_request(context, user, update.message.text)
+    
+    # Проверяем, ожидается ли текст в экспертном режиме
+    expert_data = utils.get_expert_data(user.id)
+    if expert_data and expert_data.get('waiting_for_text'):
+        # Сохраняем дополнительное описание
+        utils.set_expert_additional_text(user.id, update.message.text)
+        utils.set_expert_waiting_state(user.id, waiting_for_text=False)
+        
+        photo_count = len(expert_data['photos'])
+        await update.message.reply_text(
+            f"✅ **Описание сохранено!**\n\n"
+            f"📸 **Фотографий:** {photo_count}\n"
+            f"✍️ **Описание:** ✅ Есть\n\n"
+            f"📝 **Ваше описание:**\n_{update.message.text}_\n\n"
+            f"Теперь можете добавить еще фото или начать анализ!",
+            reply_markup=get_expert_actions_keyboard(has_description=True),
+            parse_mode='Markdown'
+        )
+        return
+    
+    intent = intents.match_intent(text)
+    
+    # Вопрос о только что распознанном растении - текстовый запрос без фото
+    followup = conversation.store.get(user.id)
+    if followup is not None and (intent is None or '?' in text):
+        await answer_followup(update, followup)
+        return
+    
+    handler = TEXT_INTENT_HANDLERS.get(intent, _unknown_text_intent)
+    await handler(update, context)
+
+async def answer_followup(update, followup):
+    """Отвечает на уточняющий вопрос о последнем распознанном растении"""
+    user = update.effective_user
+    question = update.message.text
+    
+    admitted, reason, retry_after = throttling.recognition_throttle.admit(user.id, cost=config.THROTTLE_FOLLOWUP_COST)
+    if not admitted:
+        await update.message.reply_text(throttle_rejection_text(reason, retry_after), reply_markup=get_main_keyboard())
+        return
+    
+    metrics.increment('followup_questions')
+    with token_ledger.attributed_to(user.id):
+        answer, error, _ = await utils.complete_text(
+            conversation.followup_prompt(followup, question),
+            config.FOLLOWUP_MAX_TOKENS, config.FOLLOWUP_MODELS, task_type="followup"
+        )
+    if not answer:
+        logger.warning(f"Не удалось ответить на вопрос пользователя {user.id}: {error}")
+        await update.message.reply_text(
+            "❌ Не получилось ответить на вопрос. Попробуй спросить еще раз или отправь новое фото! 📸",
+            reply_markup=get_main_keyboard()
+        )
+        return
+    
+    conversation.store.add_turn(user.id, question, answer)
+    await update.message.reply_text(answer, reply_markup=get_main_keyboard())
+
+# Обработчики намерений текстовых сообщений (см. intents.INTENT_KEYWORDS)
+TEXT_INTENT_HANDLERS = {}
+
+def text_intent_handler(intent):
+    """Регистрирует обработчик намерения текстового сообщения"""
+    def decorator(func):
+        TEXT_INTENT_HANDLERS[intent] = func
+        return func
+    return decorator
+
+@text_intent_handler('plant')
+async def _plant_intent(update, context):
+    user = update.effective_user
+    utils.set_user_recognition_mode(user.id, "plant")
+    await update.message.reply_text(
+        "🌿 Отлично! Отправь мне фотографию растения, и я его распознаю!\n\n📸 Просто сделай фото или выбери из галереи.",
+        reply_markup=get_main_menu_inline()
+    )
+    # Проверяем количество запросов и отправляем промо при необходимости
+    await utils.check_and_send_promo(update, context, user.id)
+
+@text_intent_handler('expert')
+async def _expert_intent(update, context):
+    # Показываем информацию об экспертном режиме
+    await update.message.reply_text(
+        EXPERT_MODE_INFO_TEXT,
+        reply_markup=get_expert_mode_keyboard(),
+        parse_mode='Markdown'
+    )
+    # Проверяем количество запросов и отправляем промо при необходимости
+    await utils.check_and_send_promo(update, context, update.effective_user.id)
+
+@text_intent_handler('flower_test')
+async def _flower_test_intent(update, context):
+    await update.message.reply_text(
+        FLOWER_TEST_TEXT,
+        reply_markup=get_flower_test_keyboard(),
+        parse_mode='Markdown'
+    )
+    # Проверяем количество запросов и отправляем промо при необходимости
+    await utils.check_and_send_promo(update, context, update.effective_user.id)
+
+@text_intent_handler('about')
+async def _about_intent(update, context):
+    await about_command(update, context)
+    # Проверяем количество запросов и отправляем промо при необходимости
+    await utils.check_and_send_promo(update, context, update.effective_user.id)
+
+@text_intent_handler('help')
+async def _help_intent(update, context):
+    await help_command(update, context)
+    # Проверяем количество запросов и отправляем промо при необходимости
+    await utils.check_and_send_promo(update, context, update.effective_user.id)
+
+@text_intent_handler('feedback')
+async def _feedback_intent(update, context):
+    await update.message.reply_text(
+        FEEDBACK_TEXT,
+        reply_markup=get_feedback_keyboard(),
+        parse_mode='Markdown'
+    )
+    # Проверяем количество запросов и отправляем промо при необходимости
+    await utils.check_and_send_promo(update, context, update.effective_user.id)
+
+async def _reply_with_admin_contact(update, context, message_type, template):
+    """Отвечает ссылкой на администратора и готовым текстом обращения"""
+    admin_link, message_text = utils.get_admin_link_with_text(message_type)
+    
+    await update.message.reply_text(
+        template.format(admin_link=admin_link, message_text=message_text),
+        reply_markup=get_feedback_keyboard(),
+        parse_mode='Markdown'
+    )
+    # Проверяем количество запросов и отправляем промо при необходимости
+    await utils.check_and_send_promo(update, context, update.effective_user.id)
+
+@text_intent_handler('contact_admin')
+async def _contact_admin_intent(update, context):
+    await _reply_with_admin_contact(update, context, "support", """👨‍💼 **Связь с администратором**
 
-Готов узнать, какой ты цветочек? 🌸"""
-        
-        await query.edit_message_text(
-            flower_test_text,
-            reply_markup=get_flower_test_keyboard(),
-            parse_mode='Markdown'
-        )
-    
-    # Обработчики экспертного режима
-    elif query.data == "add_more_photos":
-        await query.edit_message_text(
-            "📸 **Добавление фотографий**\n\n"
-            "Отправьте дополнительные фотографии растения.\n\n"
-            "💡 **Полезные ракурсы:**\n"
-            "• Разные части растения (листья, стебель, цветы)\n"
-            "• Детальные снимки характерных признаков\n"
-            "• Место произрастания (биотоп)\n\n"
-            "Каждое новое фото будет автоматически добавлено к анализу!",
-            reply_markup=get_main_menu_inline(),
-            parse_mode='Markdown'
-        )
-    
-    elif query.data == "add_description":
-        utils.set_expert_waiting_state(query.from_user.id, waiting_for_text=True)
-        await query.edit_message_text(
-            "✍️ **Дополнительное описание**\n\n"
-            "Отправьте текстовое сообщение с дополнительной информацией:\n\n"
-            "📝 **Что указать:**\n"
-            "• Место находки (лес, поле, сад, болото)\n"
-            "• Время года и условия\n"
-            "• Размеры растения\n"
-            "• Особые признаки или запах\n"
-            "• Любые другие наблюдения\n\n"
-            "Напишите ваше описание следующим сообщением 👇",
-            reply_markup=get_main_menu_inline(),
-            parse_mode='Markdown'
-        )
-    
-    elif query.data == "start_expert_analysis_now":
-        await handle_expert_analysis(query)
-    
-    elif query.data == "clear_expert_data":
-        utils.clear_expert_data(query.from_user.id)
-        await query.edit_message_text(
-            "🗑️ **Данные очищены**\n\n"
-            "Все фотографии и описания удалены.\n"
-            "Можете начать заново!",
-            reply_markup=get_expert_mode_keyboard(),
-            parse_mode='Markdown'
-        )
-    
-    elif query.data == "expert_info":
-        expert_help_text = """🧬 **Что такое экспертный режим?**
+🔗 **Нажми на ссылку**, чтобы написать админу:
+[Написать администратору]({admin_link})
 
-🎯 **Это продвинутый режим** для максимально точного определения растений с использованием научных методов ботаники.
+📝 **Готовый текст:**
+```
+{message_text}
+```
 
-**🔬 Научный подход:**
-• Морфологический анализ всех органов
-• Систематическая классификация
-• Учет экологических факторов
-• Сравнение с ботаническими базами данных
+💬 Скопируй текст и отправь администратору!""")
 
-**📸 Множественные фото помогают:**
-• Увидеть растение под разными углами
-• Рассмотреть детали строения
-• Определить размеры и пропорции
-• Оценить условия произрастания
+@text_intent_handler('order_bot')
+async def _order_bot_intent(update, context):
+    await _reply_with_admin_contact(update, context, "order_bot", """🤝 **Заказ бота**
 
-**✍️ Текстовое описание дает:**
-• Информацию о биотопе
-• Данные о размерах
-• Особенности, не видные на фото
-• Дополнительный контекст
+Хотите похожего бота? Обратитесь к разработчику!
 
-**💡 Результат:** Значительно более точное и научно обоснованное определение!"""
+🔗 **Написать о заказе:**
+[Связаться с администратором]({admin_link})
 
-        await query.edit_message_text(
-            expert_help_text,
-            reply_markup=get_expert_mode_keyboard(),
-            parse_mode='Markdown'
-        )
-    
-    elif query.data == "restart":
-        welcome_message = utils.get_random_message(config.WELCOME_MESSAGES)
-        user = update.effective_user
-        
-        full_message = f"{welcome_message}\n\nПривет, {user.first_name}! 👋\n\nЯ - твой дружелюбный помощник по растениям! 🌱\n\nОтправь мне фотографию любого растения, и я расскажу тебе о нем все самое интересное! 📸\n\nИспользуй кнопки ниже для навигации:"
-        
-        await query.edit_message_text(
-            full_message,
-            reply_markup=get_main_keyboard_inline(),
-            parse_mode='Markdown'
-        )
-    
+📝 **Готовый текст:**
+```
+{message_text}
+```
 
-    
-    elif query.data == "subscribe_lessons":
-        # Для callback запросов нужно обработать подписку напрямую
-        user = query.from_user
-        user_id = user.id
-        
-        # Подписываем пользователя
-        utils.subscribe_to_biology_lessons(user_id)
-        
-        success_text = """✅ **Подписка активирована!**
+🚀 Давайте обсудим ваш проект!""")
 
-🎉 Поздравляю! Теперь ты будешь получать ежедневные мини-уроки по биологии!
+@text_intent_handler('support_project')
+async def _support_project_intent(update, context):
+    await _reply_with_admin_contact(update, context, "support_project", """💝 **Поддержка проекта**
 
-📅 **Что дальше:**
-• Первый урок придет завтра в 10:00
-• Каждый день новая тема
-• Уроки будут интересными и простыми
+Благодарим за желание поддержать проект! 🙏
 
-🔬 А пока можешь получить пробный урок прямо сейчас! 👇"""
-        
-        await query.edit_message_text(
-            success_text,
-            reply_markup=get_lessons_subscribed_keyboard(),
-            parse_mode='Markdown'
-        )
-        
-        logger.info(f"Пользователь {user_id} подписался на уроки биологии через callback")
-    
-    elif query.data == "unsubscribe_lessons":
-        # Для callback запросов нужно обработать отписку напрямую
-        user = query.from_user
-        user_id = user.id
-        
-        # Отписываем пользователя
-        utils.unsubscribe_from_biology_lessons(user_id)
-        
-        unsubscribe_text = """❌ **Подписка отменена**
+🔗 **Связаться с создателем:**
+[Написать администратору]({admin_link})
 
-Жаль, что ты решил отписаться от уроков биологии! 😢
+📝 **Готовый текст:**
+```
+{message_text}
+```
 
-🔄 **В любое время ты можешь:**
-• Снова подписаться на уроки
-• Получить разовый урок
-• Изучать растения через фотографии
+Ваша поддержка помогает развивать проект! 💚""")
 
-Буду рад видеть тебя снова! 💚"""
-        
-        await query.edit_message_text(
-            unsubscribe_text,
-            reply_markup=get_lessons_unsubscribed_keyboard(),
-            parse_mode='Markdown'
-        )
-        
-        logger.info(f"Пользователь {user_id} отписался от уроков биологии через callback")
+@text_intent_handler('lessons')
+async def _lessons_intent(update, context):
+    await lessons_command(update, context)
+
+async def _unknown_text_intent(update, context):
+    await update.message.reply_text(
+        "🤔 Не совсем понимаю, что ты хочешь.\n\nОтправь мне фотографию растения для распознавания, или используй кнопки меню! 🌿",
+        reply_markup=get_main_keyboard()
+    )
+    # Проверяем количество запросов и отправляем промо при необходимости
+    await utils.check_and_send_promo(update, context, update.effective_user.id)
+
+# Реестр обработчиков callback-запросов.
+# Точные значения callback_data ищутся в словаре за O(1), параметризованные
+# (вида "prefix:payload") - по списку зарегистрированных префиксов.
+CALLBACK_HANDLERS = {}
+CALLBACK_PREFIX_HANDLERS = []
+
+def callback_handler(*names, prefix=None):
+    """Регистрирует обработчик для одного или нескольких значений callback_data
+
+    Args:
+        names: Точные значения callback_data
+        prefix: Префикс для параметризованных callback_data (остаток передается как payload)
+    """
+    def decorator(func):
+        for name in names:
+            CALLBACK_HANDLERS[name] = func
+        if prefix:
+            CALLBACK_PREFIX_HANDLERS.append((prefix, func))
+        return func
+    return decorator
+
+def resolve_callback(data):
+    """Находит обработчик для callback_data, возвращает (handler, payload)"""
+    handler = CALLBACK_HANDLERS.get(data)
+    if handler:
+        return handler, None
+    for prefix, prefix_handler in CALLBACK_PREFIX_HANDLERS:
+        if data.startswith(prefix):
+            return prefix_handler, data[len(prefix):]
+    return None, None
+
+def _screen(text, reply_markup):
+    """Заранее подготовленный экран: текст + клавиатура"""
+    return {'text': text, 'reply_markup': reply_markup, 'parse_mode': 'Markdown'}
+
+# Статические экраны рендерятся один раз при импорте модуля
+STATIC_SCREENS = {
+    "help_photo": _screen(HELP_PHOTO_TEXT, get_photo_tips_keyboard()),
+    "help_tips": _screen(HELP_TIPS_TEXT, get_photo_tips_keyboard()),
+    "help_features": _screen(HELP_FEATURES_TEXT, get_help_keyboard()),
+    "about_features": _screen(ABOUT_FEATURES_TEXT, get_about_keyboard()),
+    "about_tech": _screen(ABOUT_TECH_TEXT, get_about_keyboard()),
+    "about_examples": _screen(ABOUT_EXAMPLES_TEXT, get_about_keyboard()),
+    "new_photo": _screen(NEW_PHOTO_TEXT, get_main_menu_inline()),
+    "expert_mode": _screen(EXPERT_MODE_INFO_TEXT, get_expert_mode_keyboard()),
+    "start_expert_analysis": _screen(START_EXPERT_ANALYSIS_TEXT, get_main_menu_inline()),
+    "flower_test": _screen(FLOWER_TEST_TEXT, get_flower_test_keyboard()),
+    "add_more_photos": _screen(ADD_MORE_PHOTOS_TEXT, get_main_menu_inline()),
+    "add_description": _screen(ADD_DESCRIPTION_TEXT, get_main_menu_inline()),
+    "clear_expert_data": _screen(EXPERT_DATA_CLEARED_TEXT, get_expert_mode_keyboard()),
+    "expert_info": _screen(EXPERT_HELP_TEXT, get_expert_mode_keyboard()),
+    "feedback_suggest": _screen(FEEDBACK_TEXT, get_feedback_keyboard()),
+    "subscribe_lessons": _screen(SUBSCRIBE_SUCCESS_TEXT, get_lessons_subscribed_keyboard()),
+    "unsubscribe_lessons": _screen(UNSUBSCRIBE_TEXT, get_lessons_unsubscribed_keyboard()),
+    "lessons_subscribed": _screen(LESSONS_SUBSCRIBED_TEXT, get_lessons_subscribed_keyboard()),
+    "lessons_unsubscribed": _screen(LESSONS_UNSUBSCRIBED_TEXT, get_lessons_unsubscribed_keyboard()),
+}
+
+async def show_static_screen(query, screen_name):
+    """Показывает заранее подготовленный экран"""
+    await query.edit_message_text(**STATIC_SCREENS[screen_name])
+
+@callback_handler("help_photo", "help_tips", "help_features", "about_features",
+                  "about_tech", "about_examples", "expert_mode", "flower_test",
+                  "add_more_photos", "expert_info", "feedback_suggest")
+async def _static_screen_callback(update, context, payload):
+    query = update.callback_query
+    await show_static_screen(query, query.data)
+
+@callback_handler("main_menu", "restart")
+async def _main_menu_callback(update, context, payload):
+    query = update.callback_query
+    utils.cancel_recognition(query.from_user.id)
+    conversation.store.clear(query.from_user.id)
+    welcome_message = utils.get_random_message(config.WELCOME_MESSAGES)
+    user = update.effective_user
     
-    elif query.data == "sample_lesson":
-        # Для callback запросов нужно обработать получение урока напрямую
-        user = query.from_user
-        user_id = user.id
-        
-        # Получаем следующий урок для пользователя
-        lesson = utils.get_next_lesson_for_user(user_id)
-        formatted_lesson = utils.format_biology_lesson(lesson)
-        
-        await query.edit_message_text(
-            formatted_lesson,
-            reply_markup=get_lessons_after_sample_keyboard(utils.is_subscribed_to_biology_lessons(user_id)),
-            parse_mode='Markdown'
-        )
-        
-        logger.info(f"Пользователь {user_id} получил пробный урок биологии через callback")
+    if query.data == "main_menu":
+        full_message = f"{welcome_message}\n\nПривет, {user.first_name}! 👋\n\n{INTRO_TEXT}\n\nВыбери что тебя интересует:"
+    else:
+        full_message = f"{welcome_message}\n\nПривет, {user.first_name}! 👋\n\n{INTRO_TEXT}\n\nИспользуй кнопки ниже для навигации:"
     
-    elif query.data == "feedback_suggest":
-        feedback_text = """💚 **Обратная связь**
+    await query.edit_message_text(
+        full_message,
+        reply_markup=get_main_keyboard_inline(),
+        parse_mode='Markdown'
+    )
 
-Мне очень важно твое мнение! Расскажи, как я работаю:
+@callback_handler("new_photo", "new_photo_plant")
+async def _new_photo_callback(update, context, payload):
+    query = update.callback_query
+    utils.set_user_recognition_mode(query.from_user.id, "plant")
+    await show_static_screen(query, "new_photo")
 
-• ⭐ Оцени мою работу
-• 💬 Предложи улучшения
-• 🐛 Сообщи об ошибках
-• 👨‍💼 Связаться с администратором
-• 🤝 Заказать похожего бота
-• 💝 Поддержать проект
+@callback_handler("start_expert_analysis")
+async def _start_expert_analysis_callback(update, context, payload):
+    query = update.callback_query
+    utils.set_user_recognition_mode(query.from_user.id, "expert")
+    await show_static_screen(query, "start_expert_analysis")
 
-Выбери, что хочешь сделать:"""
-        
-        await query.edit_message_text(
-            feedback_text,
-            reply_markup=get_feedback_keyboard(),
-            parse_mode='Markdown'
-        )
-    
-    elif query.data == "lessons_menu":
-        # Для callback запросов нужно показать меню уроков напрямую
-        user = query.from_user
-        user_id = user.id
-        
-        # Проверяем статус подписки
-        is_subscribed = utils.is_subscribed_to_biology_lessons(user_id)
-        
-        if is_subscribed:
-            lessons_text = """🧬 **Ежедневные уроки биологии**
+# Обработчики экспертного режима
+@callback_handler("add_description")
+async def _add_description_callback(update, context, payload):
+    query = update.callback_query
+    utils.set_expert_waiting_state(query.from_user.id, waiting_for_text=True)
+    await show_static_screen(query, "add_description")
 
-✅ Ты подписан на ежедневные мини-уроки!
+@callback_handler("start_expert_analysis_now")
+async def _start_expert_analysis_now_callback(update, context, payload):
+    await handle_expert_analysis(update.callback_query)
 
-📅 **Как это работает:**
-• Каждый день в 10:00 ты получаешь новый урок
-• Уроки простые и интересные
-• Каждый урок с фактами и вопросами для размышления
+@callback_handler("clear_expert_data")
+async def _clear_expert_data_callback(update, context, payload):
+    query = update.callback_query
+    utils.cancel_recognition(query.from_user.id)
+    utils.clear_expert_data(query.from_user.id)
+    await show_static_screen(query, "clear_expert_data")
 
-🎯 **Что можно сделать:**"""
-            
-            await query.edit_message_text(
-                lessons_text,
-                reply_markup=get_lessons_subscribed_keyboard(),
-                parse_mode='Markdown'
-            )
-        else:
-            lessons_text = """🧬 **Ежедневные уроки биологии**
+@callback_handler("subscribe_lessons")
+async def _subscribe_lessons_callback(update, context, payload):
+    query = update.callback_query
+    user_id = query.from_user.id
+    
+    # Подписываем пользователя
+    utils.subscribe_to_biology_lessons(user_id)
+    await show_static_screen(query, "subscribe_lessons")
+    
+    logger.info(f"Пользователь {user_id} подписался на уроки биологии через callback")
 
-Хочешь каждый день узнавать что-то новое о мире биологии? 🌱
+@callback_handler("unsubscribe_lessons")
+async def _unsubscribe_lessons_callback(update, context, payload):
+    query = update.callback_query
+    user_id = query.from_user.id
+    
+    # Отписываем пользователя
+    utils.unsubscribe_from_biology_lessons(user_id)
+    await show_static_screen(query, "unsubscribe_lessons")
+    
+    logger.info(f"Пользователь {user_id} отписался от уроков биологии через callback")
 
-📚 **Что ты получишь:**
-• Короткие и понятные уроки
-• Интересные факты о живой природе
-• Вопросы для размышления
-• Дружелюбный и простой язык
+@callback_handler("sample_lesson")
+async def _sample_lesson_callback(update, context, payload):
+    query = update.callback_query
+    user_id = query.from_user.id
+    
+    # Получаем готовый текст следующего урока для пользователя
+    formatted_lesson = utils.get_next_lesson_text(user_id)
+    
+    await query.edit_message_text(
+        formatted_lesson,
+        reply_markup=get_lessons_after_sample_keyboard(utils.is_subscribed_to_biology_lessons(user_id)),
+        parse_mode='Markdown'
+    )
+    
+    logger.info(f"Пользователь {user_id} получил пробный урок биологии через callback")
 
-⏰ **Время отправки:** каждый день в 10:00
+@callback_handler("lessons_menu")
+async def _lessons_menu_callback(update, context, payload):
+    query = update.callback_query
+    user_id = query.from_user.id
+    
+    # Проверяем статус подписки
+    if utils.is_subscribed_to_biology_lessons(user_id):
+        await show_static_screen(query, "lessons_subscribed")
+    else:
+        await show_static_screen(query, "lessons_unsubscribed")
+    
+    logger.info(f"Пользователь {user_id} открыл меню уроков биологии через callback")
+
+async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Обработчик callback запросов от инлайн кнопок"""
+    query = update.callback_query
+    await query.answer()
+    
+    # Дублируем callback запрос администратору
+    await utils.duplicate_callback_request(context, query.from_user, query.data)
+    
+    handler, payload = resolve_callback(query.data)
+    if handler is None:
+        logger.warning(f"Неизвестный callback: {query.data}")
+        return
+    
+    await handler(update, context, payload)
 
-Присоединяйся к изучению удивительного мира биологии! 🔬"""
-            
-            await query.edit_message_text(
-                lessons_text,
-                reply_markup=get_lessons_unsubscribed_keyboard(),
-                parse_mode='Markdown'
-            )
-        
-        logger.info(f"Пользователь {user_id} открыл меню уроков биологии через callback")
 
 async def lessons_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик команды /lessons - управление ежедневными уроками биологии"""
@@ -1011,39 +1295,14 @@ async def lessons_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     is_subscribed = utils.is_subscribed_to_biology_lessons(user_id)
     
     if is_subscribed:
-        lessons_text = """🧬 **Ежедневные уроки биологии**
-
-✅ Ты подписан на ежедневные мини-уроки!
-
-📅 **Как это работает:**
-• Каждый день в 10:00 ты получаешь новый урок
-• Уроки простые и интересные
-• Каждый урок с фактами и вопросами для размышления
-
-🎯 **Что можно сделать:**"""
-        
         await update.message.reply_text(
-            lessons_text,
+            LESSONS_SUBSCRIBED_TEXT,
             reply_markup=get_lessons_subscribed_keyboard(),
             parse_mode='Markdown'
         )
     else:
-        lessons_text = """🧬 **Ежедневные уроки биологии**
-
-Хочешь каждый день узнавать что-то новое о мире биологии? 🌱
-
-📚 **Что ты получишь:**
-• Короткие и понятные уроки
-• Интересные факты о живой природе
-• Вопросы для размышления
-• Дружелюбный и простой язык
-
-⏰ **Время отправки:** каждый день в 10:00
-
-Присоединяйся к изучению удивительного мира биологии! 🔬"""
-        
         await update.message.reply_text(
-            lessons_text,
+            LESSONS_UNSUBSCRIBED_TEXT,
             reply_markup=get_lessons_unsubscribed_keyboard(),
             parse_mode='Markdown'
         )
@@ -1061,19 +1320,9 @@ async def subscribe_lessons(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # Подписываем пользователя
     utils.subscribe_to_biology_lessons(user_id)
     
-    success_text = """✅ **Подписка активирована!**
-
-🎉 Поздравляю! Теперь ты будешь получать ежедневные мини-уроки по биологии!
-
-📅 **Что дальше:**
-• Первый урок придет завтра в 10:00
-• Каждый день новая тема
-• Уроки будут интересными и простыми
-
-🔬 А пока можешь получить пробный урок прямо сейчас! 👇"""
     
     await update.message.reply_text(
-        success_text,
+        SUBSCRIBE_SUCCESS_TEXT,
         reply_markup=get_lessons_subscribed_keyboard(),
         parse_mode='Markdown'
     )
@@ -1088,19 +1337,9 @@ async def unsubscribe_lessons(update: Update, context: ContextTypes.DEFAULT_TYPE
     # Отписываем пользователя
     utils.unsubscribe_from_biology_lessons(user_id)
     
-    unsubscribe_text = """❌ **Подписка отменена**
-
-Жаль, что ты решил отписаться от уроков биологии! 😢
-
-🔄 **В любое время ты можешь:**
-• Снова подписаться на уроки
-• Получить разовый урок
-• Изучать растения через фотографии
-
-Буду рад видеть тебя снова! 💚"""
     
     await update.message.reply_text(
-        unsubscribe_text,
+        UNSUBSCRIBE_TEXT,
         reply_markup=get_lessons_unsubscribed_keyboard(),
         parse_mode='Markdown'
     )
@@ -1112,9 +1351,8 @@ async def get_sample_lesson(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
     user_id = user.id
     
-    # Получаем следующий урок для пользователя
-    lesson = utils.get_next_lesson_for_user(user_id)
-    formatted_lesson = utils.format_biology_lesson(lesson)
+    # Получаем готовый текст следующего урока для пользователя
+    formatted_lesson = utils.get_next_lesson_text(user_id)
     
     await update.message.reply_text(
         formatted_lesson,
@@ -1129,19 +1367,22 @@ async def get_sample_lesson(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def send_daily_lessons(context: ContextTypes.DEFAULT_TYPE):
     """Отправляет ежедневные уроки всем подписанным пользователям"""
-    subscribed_users = utils.get_subscribed_users()
+    # Каждый шард рассылает только своим пользователям, чтобы никто не получил урок дважды
+    subscribed_users = [user_id for user_id in utils.get_subscribed_users() if sharding.owns_user(user_id)]
     
     if not subscribed_users:
         logger.info("Нет подписанных пользователей для отправки уроков")
         return
     
+    # Подхватываем изменения файла уроков без перезапуска
+    lessons.catalogue.reload()
+    
     logger.info(f"Отправка ежедневных уроков {len(subscribed_users)} пользователям")
     
     for user_id in subscribed_users:
         try:
-            # Получаем следующий урок для пользователя
-            lesson = utils.get_next_lesson_for_user(user_id)
-            formatted_lesson = utils.format_biology_lesson(lesson)
+            # Получаем готовый текст следующего урока для пользователя
+            formatted_lesson = utils.get_next_lesson_text(user_id)
             
             # Отправляем урок
             await context.bot.send_message(
@@ -1155,6 +1396,34 @@ async def send_daily_lessons(context: ContextTypes.DEFAULT_TYPE):
         except Exception as e:
             logger.error(f"Ошибка отправки урока пользователю {user_id}: {e}")
 
+async def reload_lessons_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Обработчик команды /reload_lessons - перечитывает файл уроков (только для администратора)"""
+    user = update.effective_user
+    if user.id != config.ADMIN_ID:
+        return
+    
+    if not config.LESSONS_FILE:
+        await update.message.reply_text("ℹ️ LESSONS_FILE не задан, используются встроенные уроки.")
+        return
+    
+    if lessons.catalogue.reload(force=True):
+        await update.message.reply_text(f"✅ Уроки перезагружены: {len(lessons.catalogue)} шт.")
+    else:
+        await update.message.reply_text("❌ Не удалось перезагрузить уроки, подробности в логе. Продолжаю с текущим набором.")
+
+async def tokens_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Обработчик команды /tokens - расход токенов по задачам, моделям и пользователям (только для администратора)"""
+    user = update.effective_user
+    if user.id != config.ADMIN_ID:
+        return
+    
+    report = token_ledger.ledger.report(degradation.BASE_MAX_TOKENS)
+    if config.SPECIES_CACHE:
+        stats = await species_cache.cache.stats_async()
+        report += (f"\n\nКеш видов: {stats['species']} видов, попаданий {stats['hit_rate']:.0%}, "
+                   f"сэкономлено {stats['tokens_saved']} ток. ответа")
+    await update.message.reply_text(report)
+
 async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик ошибок"""
     logger.error(f"Ошибка в боте: {context.error}")
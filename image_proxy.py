@@ -0,0 +1,107 @@
+"""Ссылки на фото пользователей вместо загрузки байтов в модель
+
+В режиме IMAGE_URL_MODE бот не скачивает фото для обычного
+распознавания, а передает модели короткоживущую подписанную ссылку на
+собственный прокси. Прокси проверяет подпись и срок действия и отдает
+файл из Telegram, поэтому токен бота провайдеру не раскрывается.
+Модели, отказавшиеся от ссылки, получают байты, как раньше.
+"""
+
+import hashlib
+import hmac
+import logging
+import time
+from aiohttp import web
+import config
+import metrics
+import utils
+
+logger = logging.getLogger(__name__)
+
+# HTTP-статусы, которыми модель отклоняет ссылку на изображение
+URL_REJECTED_STATUSES = (400, 415, 422)
+
+# Модели, отклонившие ссылку: до перезапуска им отправляются байты
+url_rejected_models = set()
+
+def enabled():
+    """Включен ли режим ссылок и хватает ли для него настроек"""
+    return bool(config.IMAGE_URL_MODE and config.IMAGE_PROXY_PUBLIC_URL and config.IMAGE_PROXY_SECRET)
+
+def _signature(file_id, expires):
+    message = f"{file_id}:{expires}".encode()
+    return hmac.new(config.IMAGE_PROXY_SECRET.encode(), message, hashlib.sha256).hexdigest()
+
+def signed_url(file_id, now=None):
+    """Подписанная ссылка на фото, действующая IMAGE_URL_TTL секунд"""
+    expires = int((now or time.time()) + config.IMAGE_URL_TTL)
+    base_url = config.IMAGE_PROXY_PUBLIC_URL.rstrip('/')
+    return f"{base_url}/images/{file_id}?expires={expires}&signature={_signature(file_id, expires)}"
+
+def verify(file_id, expires, signature, now=None):
+    """Проверяет подпись и срок действия ссылки"""
+    try:
+        expires = int(expires)
+    except (TypeError, ValueError):
+        return False
+    if expires < (now or time.time()):
+        return False
+    return hmac.compare_digest(signature or '', _signature(file_id, expires))
+
+class RemoteImage:
+    """Фото в Telegram, которое скачивается только по необходимости"""
+
+    __slots__ = ('file_id', 'bot', 'kind', '_data')
+
+    def __init__(self, file_id, bot, kind=None):
+        self.file_id = file_id
+        self.bot = bot
+        self.kind = kind
+        self._data = None
+
+    def url(self):
+        return signed_url(self.file_id)
+
+    async def read(self):
+        """Байты фото (скачиваются один раз)"""
+        if self._data is None:
+            self._data = bytes(await utils.download_photo(self.bot, self.file_id, self.kind))
+        return self._data
+
+def create_image_proxy_app(bot):
+    """Веб-приложение, отдающее фото по подписанным ссылкам"""
+
+    async def serve_image(request):
+        file_id = request.match_info['file_id']
+        if not verify(file_id, request.query.get('expires'), request.query.get('signature')):
+            metrics.increment('image_proxy_forbidden')
+            return web.Response(status=403)
+
+        try:
+            data = await RemoteImage(file_id, bot).read()
+        except Exception as e:
+            logger.warning(f"Не удалось получить фото {file_id} для модели: {e}")
+            return web.Response(status=404)
+
+        metrics.increment('image_proxy_served')
+        metrics.increment('image_proxy_bytes', len(data))
+        return web.Response(body=data, content_type='image/jpeg')
+
+    app = web.Application()
+    app.router.add_get('/images/{file_id}', serve_image)
+    return app
+
+async def start(application):
+    """Запускает прокси изображений в процессе бота"""
+    if not enabled():
+        return
+    runner = web.AppRunner(create_image_proxy_app(application.bot), access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, config.IMAGE_PROXY_HOST, config.IMAGE_PROXY_PORT).start()
+    application.bot_data['image_proxy_runner'] = runner
+    logger.info(f"Прокси изображений на {config.IMAGE_PROXY_HOST}:{config.IMAGE_PROXY_PORT}")
+
+async def stop(application):
+    runner = application.bot_data.pop('image_proxy_runner', None)
+    if runner is not None:
+        await runner.cleanup()
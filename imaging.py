@@ -0,0 +1,299 @@
+"""Изображения, присланные файлом (без сжатия Telegram)
+
+Оригинал с камеры может весить 20 МБ и иметь 50 Мп. Чтобы память на
+один документ не зависела от размера оригинала:
+
+    - файл пишется потоком во временный файл (SpooledTemporaryFile
+      держит в памяти только небольшие файлы), а в режиме --local
+      локального сервера Bot API читается прямо с диска;
+    - формат и размеры проверяются по заголовку, без декодирования;
+    - JPEG декодируется сразу в уменьшенном масштабе (draft, 1/2..1/8),
+      а число реально декодируемых пикселей ограничено IMAGE_MAX_DECODE_PIXELS.
+
+На выходе - JPEG под бюджет пикселей модели, как у обычных фото.
+
+Здесь же - дешевая проверка качества фото (photo_quality_issue) до
+обращения к модели: слишком маленькие, темные, пересвеченные и
+размытые фото отклоняются локально, и поиск области растения на
+снимке (salient_crop_box) для обрезки перед отправкой модели.
+
+Для экспертного анализа несколько фото можно собрать в одно
+изображение-сетку с номерами (contact_sheet): модели, берущие плату за
+каждое изображение или ограничивающие их число, получают одно.
+"""
+
+import asyncio
+import io
+import logging
+import math
+import tempfile
+import aiohttp
+import numpy as np
+from PIL import Image, ImageDraw, ImageFont, ImageOps
+import config
+import metrics
+import utils
+
+logger = logging.getLogger(__name__)
+
+# Форматы, которые принимают модели после перекодирования в JPEG
+DOCUMENT_FORMATS = ('JPEG', 'PNG', 'WEBP')
+
+# Кусок потокового скачивания
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+class ImageRejectedError(Exception):
+    """Файл не подходит для распознавания; текст исключения - ответ пользователю"""
+
+async def spool_file(bot, file_id, kind=None):
+    """Открывает файл из Telegram, не загружая его целиком в память
+
+    Returns:
+        Файловый объект (закрывает вызывающий)
+    """
+    file = await bot.get_file(file_id)
+    local_path = utils.local_bot_api_path(bot, file.file_path) if config.BOT_API_LOCAL_MODE and file.file_path else None
+    if local_path:
+        metrics.increment('telegram_local_reads')
+        return await asyncio.get_running_loop().run_in_executor(None, open, local_path, 'rb')
+
+    spool = tempfile.SpooledTemporaryFile(max_size=config.DOCUMENT_SPOOL_MEMORY)
+    size = 0
+    try:
+        async with aiohttp.ClientSession() as session:
+            async with session.get(file.file_path) as response:
+                response.raise_for_status()
+                async for chunk in response.content.iter_chunked(DOWNLOAD_CHUNK_SIZE):
+                    size += len(chunk)
+                    if size > config.DOCUMENT_MAX_BYTES:
+                        raise ImageRejectedError(document_too_large_text())
+                    spool.write(chunk)
+    except BaseException:
+        spool.close()
+        raise
+
+    metrics.increment('telegram_download_bytes', size)
+    if kind:
+        metrics.increment(f'{kind}_download_bytes', size)
+    spool.seek(0)
+    return spool
+
+def decode_reduced(fileobj, pixel_budget):
+    """Декодирует изображение сразу в уменьшенном размере
+
+    Args:
+        fileobj: Файл с изображением
+        pixel_budget: Сколько пикселей нужно на выходе
+
+    Returns:
+        bytes: JPEG не больше pixel_budget пикселей
+    """
+    try:
+        image = Image.open(fileobj)  # читает только заголовок
+    except (Image.DecompressionBombError, OSError, ValueError):
+        raise ImageRejectedError("❌ Не удалось открыть файл как изображение. Отправь фото в формате JPEG, PNG или WEBP.") from None
+
+    with image:
+        if image.format not in DOCUMENT_FORMATS:
+            raise ImageRejectedError(f"❌ Формат {image.format} не поддерживается. Отправь фото в формате JPEG, PNG или WEBP.")
+
+        width, height = image.size
+        scale = min(1.0, math.sqrt(pixel_budget / (width * height)))
+        target = (max(1, int(width * scale)), max(1, int(height * scale)))
+
+        # JPEG декодируется в масштабе 1/2..1/8, остальные форматы - целиком
+        image.draft('RGB', target)
+        if image.size[0] * image.size[1] > config.IMAGE_MAX_DECODE_PIXELS:
+            metrics.increment('documents_rejected_pixels')
+            raise ImageRejectedError(
+                f"❌ Изображение слишком большое ({width}×{height}). "
+                f"Отправь его как фото или уменьши размер файла."
+            )
+
+        image.thumbnail(target)
+        # В отличие от сжатых фото, файлы не повернуты по EXIF
+        image = ImageOps.exif_transpose(image)
+        if image.mode != 'RGB':
+            image = image.convert('RGB')
+
+        buffer = io.BytesIO()
+        image.save(buffer, format='JPEG', quality=90)
+        return buffer.getvalue()
+
+def document_too_large_text():
+    limit = config.DOCUMENT_MAX_BYTES // (1024 * 1024)
+    return f"❌ Файл больше {limit} МБ. Отправь фото поменьше или обычным фото, а не файлом."
+
+async def load_document(bot, document, pixel_budget, kind=None):
+    """Скачивает изображение-документ и уменьшает его под бюджет пикселей
+
+    Raises:
+        ImageRejectedError: Файл слишком большой или не является поддерживаемым изображением
+    """
+    if document.file_size and document.file_size > config.DOCUMENT_MAX_BYTES:
+        raise ImageRejectedError(document_too_large_text())
+
+    fileobj = await spool_file(bot, document.file_id, kind)
+    try:
+        data = await asyncio.get_running_loop().run_in_executor(None, decode_reduced, fileobj, pixel_budget)
+    finally:
+        fileobj.close()
+
+    metrics.increment('documents_decoded')
+    return data
+
+def photo_quality_issue(image_bytes):
+    """Проверка качества фото на уменьшенной серой копии
+
+    Резкость - дисперсия лапласиана, экспозиция - средняя яркость.
+
+    Returns:
+        str: 'small', 'dark', 'bright', 'blurry' или None, если фото годится
+    """
+    try:
+        image = Image.open(io.BytesIO(image_bytes))
+    except (Image.DecompressionBombError, OSError, ValueError):
+        return None  # решение остается за моделью
+
+    with image:
+        if min(image.size) < config.QUALITY_MIN_SIDE:
+            return 'small'
+        side = config.QUALITY_ANALYSIS_SIDE
+        image.draft('L', (side, side))
+        gray = image.convert('L')
+    gray.thumbnail((side, side))
+    pixels = np.asarray(gray, dtype=np.float32)
+
+    brightness = pixels.mean()
+    if brightness < config.QUALITY_MIN_BRIGHTNESS:
+        return 'dark'
+    if brightness > config.QUALITY_MAX_BRIGHTNESS:
+        return 'bright'
+
+    laplacian = (
+        pixels[:-2, 1:-1] + pixels[2:, 1:-1] + pixels[1:-1, :-2] + pixels[1:-1, 2:]
+        - 4 * pixels[1:-1, 1:-1]
+    )
+    if laplacian.var() < config.QUALITY_MIN_SHARPNESS:
+        return 'blurry'
+    return None
+
+def _mass_bounds(profile, tail):
+    """Индексы, между которыми лежит все, кроме tail массы профиля с каждого края"""
+    cumulative = np.cumsum(profile) / profile.sum()
+    low = int(np.searchsorted(cumulative, tail))
+    high = int(np.searchsorted(cumulative, 1 - tail)) + 1
+    return low, min(high, len(profile))
+
+def salient_crop_box(image):
+    """Рамка вокруг растения на снимке
+
+    Карта заметности строится на миниатюре: преобладание зеленого плюс
+    энергия градиента. Рамка охватывает основную массу карты и
+    расширяется на SALIENT_CROP_MARGIN с каждой стороны.
+
+    Returns:
+        tuple: (left, top, right, bottom) в пикселях image или None, если
+        растение не выделяется на фоне или обрезка почти ничего не дает
+    """
+    thumb = image.convert('RGB') if image.mode != 'RGB' else image.copy()
+    thumb.thumbnail((config.SALIENT_CROP_ANALYSIS_SIDE, config.SALIENT_CROP_ANALYSIS_SIDE))
+    rgb = np.asarray(thumb, dtype=np.float32)
+    red, green, blue = rgb[..., 0], rgb[..., 1], rgb[..., 2]
+
+    greenness = np.clip(2 * green - red - blue, 0, None)
+    gradient_y, gradient_x = np.gradient(rgb.mean(axis=2))
+    energy = np.hypot(gradient_x, gradient_y)
+    saliency = greenness / (greenness.max() or 1) + energy / (energy.max() or 1)
+    # Все, что не выше среднего по кадру, считается фоном
+    saliency = np.clip(saliency - saliency.mean(), 0, None)
+    total = saliency.sum()
+    if not total:
+        return None
+
+    left, right = _mass_bounds(saliency.sum(axis=0), config.SALIENT_CROP_TAIL)
+    top, bottom = _mass_bounds(saliency.sum(axis=1), config.SALIENT_CROP_TAIL)
+    height, width = saliency.shape
+    area = (right - left) * (bottom - top) / (width * height)
+    if area > config.SALIENT_CROP_MAX_AREA:
+        return None
+    # Насколько плотнее заметность внутри рамки, чем в среднем по кадру
+    contrast = saliency[top:bottom, left:right].sum() / total / area
+    if contrast < config.SALIENT_CROP_MIN_CONTRAST:
+        return None
+
+    margin_x = (right - left) * config.SALIENT_CROP_MARGIN
+    margin_y = (bottom - top) * config.SALIENT_CROP_MARGIN
+    scale_x = image.width / width
+    scale_y = image.height / height
+    return (
+        max(0, int((left - margin_x) * scale_x)),
+        max(0, int((top - margin_y) * scale_y)),
+        min(image.width, int(round((right + margin_x) * scale_x))),
+        min(image.height, int(round((bottom + margin_y) * scale_y)))
+    )
+
+def contact_sheet(photos, pixel_budget):
+    """Собирает фото в одну сетку с номерами в левом верхнем углу каждого фото
+
+    Сетка почти квадратная (3 фото - 2×2, 5 фото - 3×2), пропорции
+    плиток - медианные пропорции фото, фото вписываются в плитку без обрезки.
+
+    Args:
+        photos: Байты изображений
+        pixel_budget: Пикселей во всей сетке
+
+    Returns:
+        bytes: JPEG сетки или None, если ни одно фото не удалось декодировать
+    """
+    images = []
+    for number, photo in enumerate(photos, 1):
+        try:
+            images.append((number, Image.open(io.BytesIO(photo))))  # читает только заголовок
+        except (Image.DecompressionBombError, OSError, ValueError):
+            logger.warning(f"Фото {number} не попало в сетку: не открывается")
+    if not images:
+        return None
+
+    aspect = float(np.median([image.width / image.height for _, image in images]))
+    columns = math.ceil(math.sqrt(len(photos)))
+    rows = math.ceil(len(photos) / columns)
+    gap = config.CONTACT_SHEET_GAP
+    tile_width = int(math.sqrt(pixel_budget * aspect / (columns * rows))) - gap
+    tile_height = int(tile_width / aspect)
+    if min(tile_width, tile_height) < 16:
+        return None
+
+    sheet = Image.new('RGB', (columns * (tile_width + gap) - gap, rows * (tile_height + gap) - gap), (32, 32, 32))
+    draw = ImageDraw.Draw(sheet)
+    font = ImageFont.load_default(size=max(12, min(tile_width, tile_height) // 10))
+    padding = max(2, min(tile_width, tile_height) // 60)
+    placed = 0
+    for number, image in images:
+        try:
+            with image:
+                image.draft('RGB', (tile_width, tile_height))
+                tile = image.convert('RGB')
+            tile.thumbnail((tile_width, tile_height))
+        except (Image.DecompressionBombError, OSError, ValueError) as e:
+            # Заголовок читается, а сами данные обрезаны или повреждены
+            logger.warning(f"Фото {number} не попало в сетку: {e}")
+            continue
+        placed += 1
+        row, column = divmod(number - 1, columns)
+        left = column * (tile_width + gap) + (tile_width - tile.width) // 2
+        top = row * (tile_height + gap) + (tile_height - tile.height) // 2
+        sheet.paste(tile, (left, top))
+
+        # Номер на фото - на него ссылается промпт
+        label = str(number)
+        x, y = left + 2 * padding, top + 2 * padding
+        box = draw.textbbox((x, y), label, font=font)
+        draw.rectangle((box[0] - padding, box[1] - padding, box[2] + padding, box[3] + padding), fill=(255, 255, 255))
+        draw.text((x, y), label, font=font, fill=(0, 0, 0))
+    if not placed:
+        return None
+
+    buffer = io.BytesIO()
+    sheet.save(buffer, format='JPEG', quality=85)
+    return buffer.getvalue()
@@ -0,0 +1,92 @@
+"""Маршрутизация текстовых сообщений по ключевым словам
+
+Все ключевые слова собираются при импорте в один автомат Ахо-Корасик,
+поэтому сообщение разбирается за один проход независимо от количества слов.
+Если в сообщении найдено несколько намерений, побеждает то, у которого
+меньше приоритет (порядок в INTENT_KEYWORDS).
+"""
+
+# Намерения в порядке приоритета (первое - самое важное)
+INTENT_KEYWORDS = [
+    ('plant', ["распознать растение", "растение"]),
+    ('expert', ["экспертный режим", "экспертный"]),
+    ('flower_test', ["цветочный тест люшера", "цветочный тест"]),
+    ('about', ["о боте", "информация"]),
+    ('help', ["помощь", "help"]),
+    ('feedback', ["обратная связь", "отзыв"]),
+    ('contact_admin', ["поддержка", "админ", "администратор", "связаться", "помощь с ботом"]),
+    ('order_bot', ["заказать бота", "создать бота", "разработка", "бизнес"]),
+    ('support_project', ["поддержать", "донат", "спасибо", "благодарность"]),
+    ('lessons', ["уроки биологии", "уроки", "биология", "ежедневные уроки"]),
+]
+
+# Приоритет "ничего не найдено" - больше любого реального
+NO_MATCH = float('inf')
+
+class KeywordAutomaton:
+    """Автомат Ахо-Корасик, возвращающий минимальный приоритет найденных слов"""
+    
+    def __init__(self, keywords):
+        """
+        Args:
+            keywords: Пары (ключевое слово, приоритет)
+        """
+        goto = [{}]
+        best = [NO_MATCH]
+        
+        for keyword, priority in keywords:
+            state = 0
+            for char in keyword:
+                next_state = goto[state].get(char)
+                if next_state is None:
+                    next_state = len(goto)
+                    goto[state][char] = next_state
+                    goto.append({})
+                    best.append(NO_MATCH)
+                state = next_state
+            best[state] = min(best[state], priority)
+        
+        # Обходом в ширину строим суффиксные ссылки и сразу превращаем бор
+        # в детерминированный автомат: переходы по суффиксной ссылке копируются
+        # в узел, а приоритеты сворачиваются, поэтому на символ текста
+        # приходится ровно один поиск в словаре
+        fail = [0] * len(goto)
+        delta = [None] * len(goto)
+        delta[0] = dict(goto[0])
+        queue = list(goto[0].values())
+        for state in queue:
+            delta[state] = dict(delta[fail[state]])
+            delta[state].update(goto[state])
+            best[state] = min(best[state], best[fail[state]])
+            for char, next_state in goto[state].items():
+                fail[next_state] = delta[fail[state]].get(char, 0)
+                queue.append(next_state)
+        
+        self._delta = delta
+        self._best = best
+    
+    def best_priority(self, text):
+        """Минимальный приоритет среди всех слов, встречающихся в тексте"""
+        delta, best_at = self._delta, self._best
+        best = NO_MATCH
+        state = 0
+        for char in text:
+            state = delta[state].get(char, 0)
+            if best_at[state] < best:
+                best = best_at[state]
+                if best == 0:
+                    break
+        return best
+
+INTENT_NAMES = [intent for intent, _ in INTENT_KEYWORDS]
+
+_automaton = KeywordAutomaton(
+    (keyword, priority)
+    for priority, (_, keywords) in enumerate(INTENT_KEYWORDS)
+    for keyword in keywords
+)
+
+def match_intent(text):
+    """Возвращает намерение для текста в нижнем регистре или None"""
+    priority = _automaton.best_priority(text)
+    return INTENT_NAMES[priority] if priority != NO_MATCH else None
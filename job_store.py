@@ -0,0 +1,177 @@
+"""Долговременная очередь задач распознавания
+
+Задача записывается в SQLite до постановки в очередь распознавания и
+удаляется, когда пользователю отправлен ответ. Если бот упал или был
+перезапущен во время анализа, незавершенные задачи остаются в базе и
+при старте выполняются заново с ответом в исходный чат.
+
+Обработчики бота работают с базой через add_async, complete_async и
+pending_async: запись многомегабайтных фото выполняется в отдельном
+потоке и не задерживает цикл событий.
+"""
+
+import asyncio
+import functools
+import logging
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+import config
+import sharding
+
+logger = logging.getLogger(__name__)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    kind TEXT NOT NULL,
+    user_id INTEGER NOT NULL,
+    chat_id INTEGER NOT NULL,
+    status_message_id INTEGER,
+    reply_to_message_id INTEGER,
+    additional_text TEXT NOT NULL DEFAULT '',
+    created_at REAL NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS job_photos (
+    job_id INTEGER NOT NULL REFERENCES jobs(id) ON DELETE CASCADE,
+    position INTEGER NOT NULL,
+    data BLOB,
+    file_id TEXT,
+    PRIMARY KEY (job_id, position)
+);
+"""
+
+class JobStore:
+    """Незавершенные задачи распознавания в SQLite"""
+
+    def __init__(self, path, max_attempts=3, max_age=3600, clock=time.time):
+        """
+        Args:
+            path: Путь к файлу базы (':memory:' для тестов)
+            max_attempts: Сколько раз задачу можно запустить после перезапуска
+            max_age: Задачи старше N секунд при старте не выполняются
+            clock: Источник времени (для тестов)
+        """
+        self.path = path
+        self.max_attempts = max_attempts
+        self.max_age = max_age
+        self.clock = clock
+        self._conn = None
+        self._executor = None
+
+    @classmethod
+    def from_config(cls):
+        return cls(
+            sharding.local_path(config.JOB_STORE_PATH),
+            max_attempts=config.JOB_REPLAY_MAX_ATTEMPTS,
+            max_age=config.JOB_REPLAY_MAX_AGE
+        )
+
+    @property
+    def conn(self):
+        # База открывается при первом обращении, а не при импорте модуля
+        if self._conn is None:
+            # Соединение используется и из потока базы (см. _in_thread)
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute("PRAGMA foreign_keys=ON")
+            self._conn.executescript(_SCHEMA)
+        return self._conn
+
+    def add(self, kind, user_id, chat_id, photos, status_message_id=None,
+            reply_to_message_id=None, additional_text=''):
+        """Сохраняет задачу до отправки ее в очередь распознавания
+
+        Args:
+            kind: 'plant' или 'expert'
+            photos: Список байтов изображений или image_proxy.RemoteImage
+                (такие фото сохраняются как file_id в Telegram)
+            status_message_id: Сообщение со статусом, которое нужно обновить
+            reply_to_message_id: Сообщение пользователя, на которое отвечаем
+
+        Returns:
+            int: ID задачи
+        """
+        with self.conn:
+            cursor = self.conn.execute(
+                "INSERT INTO jobs (kind, user_id, chat_id, status_message_id, reply_to_message_id,"
+                " additional_text, created_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (kind, user_id, chat_id, status_message_id, reply_to_message_id,
+                 additional_text or '', self.clock())
+            )
+            job_id = cursor.lastrowid
+            self.conn.executemany(
+                "INSERT INTO job_photos (job_id, position, data, file_id) VALUES (?, ?, ?, ?)",
+                [(job_id, i, None, photo.file_id) if hasattr(photo, 'file_id') else (job_id, i, bytes(photo), None)
+                 for i, photo in enumerate(photos)]
+            )
+        return job_id
+
+    def complete(self, job_id):
+        """Удаляет задачу, на которую пользователь уже получил ответ"""
+        with self.conn:
+            self.conn.execute("DELETE FROM jobs WHERE id = ?", (job_id,))
+
+    def pending(self):
+        """Незавершенные задачи для повторного запуска
+
+        Задачи, которые устарели или уже исчерпали попытки, удаляются.
+        Счетчик попыток увеличивается до запуска, чтобы задача, роняющая
+        бота, не запускалась бесконечно.
+
+        Returns:
+            list: Словари с полями задачи и списком photos (байты или file_id)
+        """
+        deadline = self.clock() - self.max_age
+        with self.conn:
+            expired = self.conn.execute(
+                "DELETE FROM jobs WHERE created_at < ? OR attempts >= ?",
+                (deadline, self.max_attempts)
+            ).rowcount
+            self.conn.execute("UPDATE jobs SET attempts = attempts + 1")
+        if expired:
+            logger.warning(f"Пропущено устаревших задач распознавания: {expired}")
+
+        columns = ('id', 'kind', 'user_id', 'chat_id', 'status_message_id',
+                   'reply_to_message_id', 'additional_text')
+        rows = self.conn.execute(f"SELECT {', '.join(columns)} FROM jobs ORDER BY id").fetchall()
+        jobs = []
+        for row in rows:
+            job = dict(zip(columns, row))
+            job['photos'] = [data if data is not None else file_id for data, file_id in self.conn.execute(
+                "SELECT data, file_id FROM job_photos WHERE job_id = ? ORDER BY position", (job['id'],)
+            )]
+            jobs.append(job)
+        return jobs
+
+    async def _in_thread(self, method, *args, **kwargs):
+        # Один поток: операции с базой выполняются по очереди
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='job-store')
+        return await asyncio.get_running_loop().run_in_executor(
+            self._executor, functools.partial(method, *args, **kwargs)
+        )
+
+    async def add_async(self, *args, **kwargs):
+        """add() в потоке базы"""
+        return await self._in_thread(self.add, *args, **kwargs)
+
+    async def complete_async(self, job_id):
+        """complete() в потоке базы"""
+        await self._in_thread(self.complete, job_id)
+
+    async def pending_async(self):
+        """pending() в потоке базы"""
+        return await self._in_thread(self.pending)
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+store = JobStore.from_config()
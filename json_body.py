@@ -0,0 +1,76 @@
+"""Потоковое тело JSON-запроса с изображениями
+
+Обычный путь (json=payload) держит в памяти base64-строку каждого
+изображения, затем json.dumps делает еще одну полную копию, а
+кодирование в байты - третью. Здесь JSON-обертка сериализуется без
+изображений, а base64 пишется в сокет кусками прямо из JPEG-байтов,
+поэтому пиковая память запроса почти не зависит от размера фото.
+"""
+
+import base64
+import json
+import re
+import secrets
+from aiohttp import payload
+
+try:
+    import orjson
+except ImportError:  # orjson необязателен
+    orjson = None
+
+# Кратно 3, чтобы куски base64 склеивались без паддинга внутри
+CHUNK_SIZE = 3 * 16 * 1024
+
+def json_loads(data):
+    """Разбор JSON-ответа: orjson, если установлен, иначе стандартный json"""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+class JPEGDataURL:
+    """JPEG-байты, которые в JSON станут строкой data:image/jpeg;base64,..."""
+
+    PREFIX = b'data:image/jpeg;base64,'
+
+    __slots__ = ('data',)
+
+    def __init__(self, data):
+        self.data = memoryview(data)
+
+    def encoded_size(self):
+        return len(self.PREFIX) + (len(self.data) + 2) // 3 * 4
+
+    def chunks(self):
+        yield self.PREFIX
+        for start in range(0, len(self.data), CHUNK_SIZE):
+            yield base64.b64encode(self.data[start:start + CHUNK_SIZE])
+
+class JSONImagePayload(payload.Payload):
+    """Тело запроса aiohttp: JSON-документ с JPEGDataURL внутри
+
+    Размер известен заранее, поэтому запрос уходит с Content-Length.
+    """
+
+    def __init__(self, document, **kwargs):
+        images = []
+        nonce = secrets.token_hex(8)
+
+        def placeholder(obj):
+            if isinstance(obj, JPEGDataURL):
+                images.append(obj)
+                return f"{nonce}:{len(images) - 1}"
+            raise TypeError(f"{type(obj).__name__} не сериализуется в JSON")
+
+        # ensure_ascii=False: русский промпт в UTF-8 втрое короче, чем в виде \uXXXX
+        envelope = json.dumps(document, ensure_ascii=False, separators=(',', ':'), default=placeholder)
+        self._segments = [segment.encode() for segment in re.split(f"{nonce}:\\d+", envelope)]
+        self._images = images
+        super().__init__(document, content_type='application/json', **kwargs)
+        self._size = sum(map(len, self._segments)) + sum(image.encoded_size() for image in images)
+
+    async def write(self, writer):
+        for segment, image in zip(self._segments, self._images):
+            await writer.write(segment)
+            for chunk in image.chunks():
+                await writer.write(chunk)
+        await writer.write(self._segments[-1])
@@ -1,6 +1,12 @@
+from functools import lru_cache
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardMarkup, KeyboardButton, WebAppInfo
 import config
 
+# Объекты клавиатур в python-telegram-bot неизменяемы, поэтому каждая
+# клавиатура строится один раз и переиспользуется во всех ответах.
+# Клавиатуры, зависящие от параметров, кешируются по этим параметрам.
+
+@lru_cache(maxsize=None)
 def get_main_keyboard():
     """Главная клавиатура бота"""
     keyboard = [
@@ -11,6 +17,7 @@ def get_main_keyboard():
     ]
     return ReplyKeyboardMarkup(keyboard, resize_keyboard=True, one_time_keyboard=False)
 
+@lru_cache(maxsize=None)
 def get_help_keyboard():
     """Клавиатура помощи"""
     keyboard = [
@@ -21,6 +28,7 @@ def get_help_keyboard():
     ]
     return InlineKeyboardMarkup(keyboard)
 
+@lru_cache(maxsize=None)
 def get_about_keyboard():
     """Клавиатура информации о боте"""
     keyboard = [
@@ -39,6 +47,11 @@ def get_feedback_keyboard():
     else:
         admin_url = f"tg://user?id={config.ADMIN_ID}"
     
+    return _build_feedback_keyboard(admin_url)
+
+@lru_cache(maxsize=None)
+def _build_feedback_keyboard(admin_url):
+    """Клавиатура обратной связи для конкретной ссылки на администратора"""
     keyboard = [
         [InlineKeyboardButton("⭐ Оценить бота", url=admin_url)],
         [InlineKeyboardButton("💬 Предложить улучшение", url=admin_url)],
@@ -50,6 +63,7 @@ def get_feedback_keyboard():
     ]
     return InlineKeyboardMarkup(keyboard)
 
+@lru_cache(maxsize=None)
 def get_photo_tips_keyboard():
     """Клавиатура с советами по фото"""
     keyboard = [
@@ -58,11 +72,13 @@ def get_photo_tips_keyboard():
     ]
     return InlineKeyboardMarkup(keyboard)
 
+@lru_cache(maxsize=None)
 def get_main_menu_inline():
     """Инлайн кнопка возврата в главное меню"""
     keyboard = [[InlineKeyboardButton("🏠 Главное меню", callback_data="main_menu")]]
     return InlineKeyboardMarkup(keyboard)
 
+@lru_cache(maxsize=None)
 def get_expert_mode_keyboard():
     """Клавиатура для экспертного режима"""
     keyboard = [
@@ -72,6 +88,19 @@ def get_expert_mode_keyboard():
     ]
     return InlineKeyboardMarkup(keyboard)
 
+@lru_cache(maxsize=None)
+def get_expert_actions_keyboard(has_description=False):
+    """Клавиатура управления собранными данными экспертного режима"""
+    keyboard = [
+        [InlineKeyboardButton("📸 Добавить еще фото", callback_data="add_more_photos")],
+        [InlineKeyboardButton("✍️ Изменить описание" if has_description else "✍️ Добавить описание", callback_data="add_description")],
+        [InlineKeyboardButton("🧬 Начать анализ", callback_data="start_expert_analysis_now")],
+        [InlineKeyboardButton("🗑️ Очистить все", callback_data="clear_expert_data")],
+        [InlineKeyboardButton("🏠 Главное меню", callback_data="main_menu")]
+    ]
+    return InlineKeyboardMarkup(keyboard)
+
+@lru_cache(maxsize=None)
 def get_main_keyboard_inline():
     """Главная инлайн клавиатура для callback'ов"""
     keyboard = [
@@ -84,6 +113,7 @@ def get_main_keyboard_inline():
     ]
     return InlineKeyboardMarkup(keyboard)
 
+@lru_cache(maxsize=None)
 def get_restart_keyboard():
     """Клавиатура для перезапуска бота"""
     keyboard = [
@@ -92,6 +122,7 @@ def get_restart_keyboard():
     ]
     return InlineKeyboardMarkup(keyboard)
 
+@lru_cache(maxsize=None)
 def get_flower_test_keyboard():
     """Клавиатура для цветочного теста Люшера"""
     keyboard = [
@@ -100,6 +131,7 @@ def get_flower_test_keyboard():
     ]
     return InlineKeyboardMarkup(keyboard)
 
+@lru_cache(maxsize=None)
 def get_lessons_unsubscribed_keyboard():
     """Клавиатура для неподписанных пользователей на уроки биологии"""
     keyboard = [
@@ -109,6 +141,7 @@ def get_lessons_unsubscribed_keyboard():
     ]
     return InlineKeyboardMarkup(keyboard)
 
+@lru_cache(maxsize=None)
 def get_lessons_subscribed_keyboard():
     """Клавиатура для подписанных пользователей на уроки биологии"""
     keyboard = [
@@ -118,6 +151,7 @@ def get_lessons_subscribed_keyboard():
     ]
     return InlineKeyboardMarkup(keyboard)
 
+@lru_cache(maxsize=None)
 def get_lessons_after_sample_keyboard(is_subscribed):
     """Клавиатура после получения пробного урока"""
     if is_subscribed:
@@ -0,0 +1,171 @@
+"""Каталог ежедневных уроков биологии
+
+Каждый урок рендерится в итоговый Markdown один раз при загрузке каталога
+и проверяется на соответствие правилам разметки Telegram, поэтому рассылка
+и пробные уроки просто переиспользуют готовые строки.
+
+Уроки берутся из config.BIOLOGY_LESSONS или из JSON-файла config.LESSONS_FILE
+(список объектов с полями title, content, fact, question). Файл можно
+перечитать без перезапуска бота - см. LessonCatalogue.reload().
+"""
+
+import json
+import logging
+import os
+import config
+
+logger = logging.getLogger(__name__)
+
+# Максимальная длина сообщения Telegram (в UTF-16 символах)
+TELEGRAM_MESSAGE_LIMIT = 4096
+
+LESSON_FIELDS = ('title', 'content', 'fact', 'question')
+
+class LessonValidationError(ValueError):
+    """Урок не проходит проверку перед отправкой в Telegram"""
+
+def render_lesson(lesson):
+    """Форматирует урок биологии для отправки"""
+    return f"""🧬 **Ежедневный урок биологии**
+
+📚 **{lesson['title']}**
+
+{lesson['content']}
+
+💡 **Интересный факт:**
+{lesson['fact']}
+
+🔬 **Подумай над этим:**
+{lesson['question']}
+
+---
+💚 *Надеюсь, урок был интересным! Завтра тебя ждет новая тема!*
+
+🔕 Чтобы отписаться от уроков, используй команду /lessons"""
+
+def validate_markdown(text):
+    """Проверяет текст по правилам parse_mode='Markdown' (legacy) в Telegram
+
+    Возвращает список найденных проблем (пустой, если текст корректен).
+    """
+    problems = []
+    
+    length = len(text.encode('utf-16-le')) // 2
+    if length > TELEGRAM_MESSAGE_LIMIT:
+        problems.append(f"длина {length} больше лимита {TELEGRAM_MESSAGE_LIMIT}")
+    
+    position = 0
+    while position < len(text):
+        char = text[position]
+        if char == '\\':
+            position += 2
+            continue
+        if text.startswith('```', position):
+            end = text.find('```', position + 3)
+            if end == -1:
+                problems.append(f"незакрытый блок ``` с позиции {position}")
+                break
+            position = end + 3
+            continue
+        if char in '*_`':
+            end = text.find(char, position + 1)
+            if end == -1:
+                problems.append(f"незакрытая сущность {char} с позиции {position}")
+                break
+            position = end + 1
+            continue
+        if char == '[':
+            end = text.find('](', position + 1)
+            close = text.find(')', end + 2) if end != -1 else -1
+            if close == -1:
+                problems.append(f"некорректная ссылка с позиции {position}")
+                break
+            position = close + 1
+            continue
+        position += 1
+    
+    return problems
+
+class LessonCatalogue:
+    """Набор уроков с заранее отрендеренным текстом"""
+    
+    def __init__(self, lessons, source_path=None):
+        self.source_path = source_path
+        self._source_mtime = None
+        self._lessons = ()
+        self._rendered = ()
+        self.load(lessons)
+    
+    @classmethod
+    def from_config(cls):
+        """Каталог из LESSONS_FILE, если он задан, иначе из config.BIOLOGY_LESSONS"""
+        catalogue = cls(config.BIOLOGY_LESSONS, source_path=config.LESSONS_FILE)
+        if catalogue.source_path and not catalogue.reload(force=True):
+            logger.warning("Используются встроенные уроки из config.BIOLOGY_LESSONS")
+        return catalogue
+    
+    def load(self, lessons):
+        """Проверяет и рендерит уроки; при ошибке текущий набор не меняется"""
+        if not isinstance(lessons, (list, tuple)):
+            raise LessonValidationError(f"Ожидался список уроков, получено {type(lessons).__name__}")
+        if not lessons:
+            raise LessonValidationError("Каталог уроков пуст")
+        for index, lesson in enumerate(lessons):
+            if not isinstance(lesson, dict):
+                raise LessonValidationError(f"Урок #{index + 1}: ожидался объект, получено {type(lesson).__name__}")
+            missing = [field for field in LESSON_FIELDS
+                       if not isinstance(lesson.get(field), str) or not lesson[field].strip()]
+            if missing:
+                raise LessonValidationError(f"Урок #{index + 1}: нет полей {', '.join(missing)}")
+        
+        lessons = tuple(dict(lesson) for lesson in lessons)
+        rendered = []
+        for index, lesson in enumerate(lessons):
+            text = render_lesson(lesson)
+            problems = validate_markdown(text)
+            if problems:
+                raise LessonValidationError(f"Урок #{index + 1} ({lesson['title']}): {'; '.join(problems)}")
+            rendered.append(text)
+        
+        self._lessons = lessons
+        self._rendered = tuple(rendered)
+    
+    def _load_file(self):
+        mtime = os.path.getmtime(self.source_path)
+        with open(self.source_path, encoding='utf-8') as lessons_file:
+            self.load(json.load(lessons_file))
+        self._source_mtime = mtime
+    
+    def reload(self, force=False):
+        """Перечитывает файл уроков, если он изменился
+
+        Returns:
+            bool: True, если каталог обновлен
+        """
+        if not self.source_path:
+            return False
+        
+        try:
+            if not force and os.path.getmtime(self.source_path) == self._source_mtime:
+                return False
+            self._load_file()
+        except (OSError, ValueError) as e:
+            logger.error(f"Не удалось перезагрузить уроки из {self.source_path}: {e}")
+            return False
+        
+        logger.info(f"Загружено {len(self)} уроков из {self.source_path}")
+        return True
+    
+    def __len__(self):
+        return len(self._lessons)
+    
+    def lesson(self, index):
+        """Исходные данные урока (индекс берется по модулю размера каталога)"""
+        return self._lessons[index % len(self._lessons)]
+    
+    def rendered(self, index):
+        """Готовый Markdown урока (индекс берется по модулю размера каталога)"""
+        return self._rendered[index % len(self._rendered)]
+
+# Каталог рендерится один раз при запуске бота
+catalogue = LessonCatalogue.from_config()
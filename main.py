@@ -6,6 +6,10 @@ from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQu
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from apscheduler.triggers.cron import CronTrigger
 import config
+import image_proxy
+import recognition_workers
+import sharding
+import utils
 from handlers import *
 
 # Настройка логирования
@@ -19,6 +23,17 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+async def post_init(application):
+    """Запуск фоновых служб после инициализации бота"""
+    await image_proxy.start(application)
+    # Незавершенные распознавания до перезапуска
+    await replay_recognition_jobs(application)
+
+async def post_shutdown(application):
+    await image_proxy.stop(application)
+    await recognition_workers.shutdown(application)
+    await utils.close_http_session(application)
+
 def main():
     """Главная функция запуска бота"""
     logger.info("Запуск бота распознавания растений...")
@@ -32,17 +47,41 @@ def main():
         logger.error("OPENROUTER_API_KEY не найден в переменных окружения!")
         return
     
-    # Создаем приложение
-    application = Application.builder().token(config.BOT_TOKEN).build()
+    if sharding.is_sharded() and not config.WEBHOOK_URL:
+        logger.error("Для SHARD_COUNT > 1 нужен WEBHOOK_URL - публичный адрес диспетчера!")
+        return
+    
+    # Создаем приложение. Обновления обрабатываются параллельно, чтобы новое
+    # действие пользователя могло отменить его незавершенное распознавание
+    builder = (
+        Application.builder()
+        .token(config.BOT_TOKEN)
+        .concurrent_updates(True)
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+    )
+    if config.BOT_API_URL:
+        # Собственный сервер Bot API: файлы до 2 ГБ, в режиме --local - чтение с диска
+        logger.info(f"Используется сервер Bot API {config.BOT_API_URL} (local_mode={config.BOT_API_LOCAL_MODE})")
+        builder = (
+            builder
+            .base_url(f"{config.BOT_API_URL.rstrip('/')}/bot")
+            .base_file_url(f"{config.BOT_API_URL.rstrip('/')}/file/bot")
+            .local_mode(config.BOT_API_LOCAL_MODE)
+        )
+    application = builder.build()
     
     # Добавляем хендлеры команд
     application.add_handler(CommandHandler("start", start_command))
     application.add_handler(CommandHandler("help", help_command))
     application.add_handler(CommandHandler("about", about_command))
     application.add_handler(CommandHandler("lessons", lessons_command))
+    application.add_handler(CommandHandler("reload_lessons", reload_lessons_command))
+    application.add_handler(CommandHandler("tokens", tokens_command))
     
     # Добавляем хендлеры сообщений
     application.add_handler(MessageHandler(filters.PHOTO, handle_photo))
+    application.add_handler(MessageHandler(filters.Document.IMAGE, handle_document))
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_text))
     
     # Добавляем хендлер callback запросов
@@ -76,10 +115,23 @@ def main():
     logger.info("Планировщик ежедневных уроков биологии активирован (10:00 каждый день)")
     
     # Запускаем бота
-    application.run_polling(
-        allowed_updates=Update.ALL_TYPES,
-        drop_pending_updates=True
-    )
+    if sharding.is_sharded():
+        # Обновления приходят от диспетчера (sharding.py); все шарды
+        # регистрируют в Telegram один и тот же публичный адрес диспетчера
+        logger.info(f"Шард {config.SHARD_INDEX} из {config.SHARD_COUNT} на {config.SHARD_LISTEN}:{config.SHARD_PORT}")
+        application.run_webhook(
+            listen=config.SHARD_LISTEN,
+            port=config.SHARD_PORT,
+            url_path='webhook',
+            secret_token=config.WEBHOOK_SECRET,
+            webhook_url=config.WEBHOOK_URL,
+            allowed_updates=Update.ALL_TYPES
+        )
+    else:
+        application.run_polling(
+            allowed_updates=Update.ALL_TYPES,
+            drop_pending_updates=True
+        )
 
 if __name__ == "__main__":
     try:
@@ -0,0 +1,26 @@
+"""Простые счетчики работы бота
+
+Счетчики живут в памяти процесса и сбрасываются при перезапуске.
+Используются для наблюдения за отказами, деградацией и экономией запросов к API.
+"""
+
+from collections import defaultdict
+
+counters = defaultdict(int)
+
+def increment(name, value=1):
+    """Увеличивает счетчик name на value"""
+    counters[name] += value
+
+def get(name):
+    """Текущее значение счетчика"""
+    return counters.get(name, 0)
+
+def average(total_name, count_name):
+    """Среднее значение: счетчик total_name на одно событие count_name"""
+    count = get(count_name)
+    return get(total_name) / count if count else 0.0
+
+def snapshot():
+    """Копия всех счетчиков"""
+    return dict(counters)
@@ -0,0 +1,205 @@
+"""Ограничение частоты запросов к каждой модели OpenRouter
+
+Бесплатные модели OpenRouter ограничивают число запросов в минуту.
+Раньше после 429 или 5xx бот сразу шел к следующей модели, а со
+следующим запросом снова стучался в ту же. Теперь по каждой модели:
+
+    - 429 и заголовок Retry-After (или X-RateLimit-Reset) закрывают
+      модель до указанного времени, X-RateLimit-Remaining: 0 - тоже;
+    - X-RateLimit-Limit задает token bucket модели (MODEL_RATE_WINDOW),
+      а MODEL_RATE_PER_MINUTE - начальный лимит до первых заголовков;
+    - временные ошибки (408, 5xx, обрыв соединения) закрывают модель на
+      экспоненциально растущий интервал со случайным разбросом (full jitter);
+    - ошибки запроса (400, 401, 403, 404, ...) повторять бесполезно.
+
+Если модель освободится не позже MODEL_MAX_WAIT секунд, запрос ее
+дожидается, иначе перебор сразу переходит к следующей модели.
+Состояние свое в каждом процессе.
+"""
+
+import asyncio
+import email.utils
+import logging
+import random
+import time
+import config
+import metrics
+from throttling import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+# Ошибки, после которых запрос к той же модели имеет смысл повторить
+RETRYABLE_STATUSES = frozenset({408, 425, 429, 500, 502, 503, 504, 520, 522, 524})
+
+def is_retryable(status):
+    """Временная ли ошибка (None - обрыв соединения или таймаут)"""
+    return status is None or status in RETRYABLE_STATUSES
+
+def parse_retry_after(value, now=None):
+    """Секунды из заголовка Retry-After (число или HTTP-дата), None если не разобрать"""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        moment = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, moment.timestamp() - (now or time.time()))
+
+class ModelRateLimited(Exception):
+    """Модель закрыта дольше, чем имеет смысл ждать"""
+
+    def __init__(self, model, retry_after):
+        super().__init__(f"модель ограничена еще {retry_after:.0f} с")
+        self.model = model
+        self.retry_after = retry_after
+
+class _ModelState:
+    __slots__ = ('bucket', 'blocked_until', 'failures')
+
+    def __init__(self, bucket):
+        self.bucket = bucket
+        self.blocked_until = 0.0
+        self.failures = 0
+
+class ModelLimiter:
+    """Состояние лимитов по моделям"""
+
+    def __init__(self, rate_per_minute=0, burst=3, window=60, max_wait=5.0, backoff_base=1.0,
+                 backoff_max=60.0, default_cooldown=30.0, clock=time.monotonic, wall_clock=time.time,
+                 sleep=asyncio.sleep, rng=None):
+        """
+        Args:
+            rate_per_minute: Начальный лимит запросов в минуту на модель (0 - без лимита)
+            burst: Емкость token bucket модели
+            window: Окно X-RateLimit-Limit (сек)
+            max_wait: Дольше этого модель не ждем, а переходим к следующей (сек)
+            backoff_base: Первая пауза после временной ошибки (сек)
+            backoff_max: Предел паузы (сек)
+            default_cooldown: Пауза после 429 без Retry-After (сек)
+            clock: Монотонные часы (для тестов)
+            wall_clock: Время UNIX - для X-RateLimit-Reset и HTTP-дат
+            sleep: Функция ожидания (для тестов)
+            rng: Источник случайности для разброса пауз
+        """
+        self.rate_per_minute = rate_per_minute
+        self.burst = burst
+        self.window = window
+        self.max_wait = max_wait
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.default_cooldown = default_cooldown
+        self._clock = clock
+        self._wall_clock = wall_clock
+        self._sleep = sleep
+        self._rng = rng or random.Random()
+        self._models = {}
+
+    @classmethod
+    def from_config(cls):
+        return cls(
+            rate_per_minute=config.MODEL_RATE_PER_MINUTE,
+            burst=config.MODEL_RATE_BURST,
+            window=config.MODEL_RATE_WINDOW,
+            max_wait=config.MODEL_MAX_WAIT,
+            backoff_base=config.MODEL_BACKOFF_BASE,
+            backoff_max=config.MODEL_BACKOFF_MAX,
+            default_cooldown=config.MODEL_RATE_LIMIT_COOLDOWN
+        )
+
+    def _state(self, model):
+        state = self._models.get(model)
+        if state is None:
+            bucket = TokenBucket(self.rate_per_minute / 60, self.burst, self._clock) if self.rate_per_minute else None
+            state = self._models[model] = _ModelState(bucket)
+        return state
+
+    def wait_time(self, model):
+        """Через сколько секунд к модели можно отправить запрос"""
+        state = self._state(model)
+        wait = max(0.0, state.blocked_until - self._clock())
+        if state.bucket is not None:
+            wait = max(wait, state.bucket.retry_after())
+        return wait
+
+    async def acquire(self, model):
+        """Дожидается разрешения на запрос к модели
+
+        Raises:
+            ModelRateLimited: Модель закрыта дольше MODEL_MAX_WAIT
+        """
+        wait = self.wait_time(model)
+        if wait > self.max_wait:
+            metrics.increment('model_limiter_skipped')
+            raise ModelRateLimited(model, wait)
+        if wait > 0:
+            metrics.increment('model_limiter_waits')
+            metrics.increment('model_limiter_wait_seconds', wait)
+            await self._sleep(wait)
+        state = self._state(model)
+        if state.bucket is not None:
+            state.bucket.consume()
+
+    def backoff_delay(self, failures):
+        """Пауза после failures временных ошибок подряд: full jitter"""
+        ceiling = min(self.backoff_max, self.backoff_base * 2 ** (failures - 1))
+        return self._rng.uniform(0, ceiling)
+
+    def observe(self, model, status, headers=None):
+        """Учитывает ответ модели (status None - обрыв соединения или таймаут)"""
+        state = self._state(model)
+        headers = headers or {}
+        self._learn_limit(model, state, headers)
+
+        if status == 200:
+            state.failures = 0
+            if headers.get('X-RateLimit-Remaining') == '0':
+                # Квота окна исчерпана - не ждем 429
+                self._block(model, state, self._reset_delay(headers), 'квота исчерпана')
+            return
+
+        if status == 429:
+            metrics.increment('model_rate_limited')
+            delay = parse_retry_after(headers.get('Retry-After'), self._wall_clock())
+            if delay is None:
+                delay = self._reset_delay(headers)
+            self._block(model, state, self.default_cooldown if delay is None else delay, '429')
+            return
+
+        if is_retryable(status):
+            state.failures += 1
+            metrics.increment('model_transient_errors')
+            self._block(model, state, self.backoff_delay(state.failures), f'ошибка {status}')
+
+    def _reset_delay(self, headers):
+        # OpenRouter присылает X-RateLimit-Reset в миллисекундах UNIX-времени
+        try:
+            reset = float(headers['X-RateLimit-Reset'])
+        except (KeyError, TypeError, ValueError):
+            return None
+        if reset > 1e11:
+            reset /= 1000
+        return max(0.0, reset - self._wall_clock())
+
+    def _block(self, model, state, delay, reason):
+        if delay is None:
+            return
+        until = self._clock() + delay
+        if until > state.blocked_until:
+            state.blocked_until = until
+            logger.warning(f"Модель {model} закрыта на {delay:.1f} с: {reason}")
+
+    def _learn_limit(self, model, state, headers):
+        try:
+            limit = float(headers['X-RateLimit-Limit'])
+        except (KeyError, TypeError, ValueError):
+            return
+        rate = limit / self.window
+        if limit > 0 and (state.bucket is None or state.bucket.rate != rate):
+            state.bucket = TokenBucket(rate, min(self.burst, limit), self._clock)
+            logger.info(f"Лимит модели {model}: {limit:.0f} запросов за {self.window} с")
+
+limiter = ModelLimiter.from_config()
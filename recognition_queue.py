@@ -0,0 +1,261 @@
+"""Планировщик запросов на распознавание
+
+Все обращения к моделям проходят через ограниченный пул воркеров.
+Быстрые запросы (plant) и экспертные (expert) стоят в разных полосах,
+которые обслуживаются взвешенным циклическим перебором (smooth weighted
+round-robin). Внутри полосы у каждого пользователя своя очередь, и
+пользователи обслуживаются по кругу, чтобы один человек с пачкой фото
+не задерживал остальных. Экспертным задачам никогда не отдаются все
+воркеры сразу, поэтому всплеск экспертных анализов не блокирует быстрые
+определения.
+"""
+
+import asyncio
+import itertools
+import logging
+from collections import OrderedDict, deque
+import config
+import metrics
+
+logger = logging.getLogger(__name__)
+
+class QueueFullError(Exception):
+    """Очередь распознавания переполнена"""
+
+class _Job:
+    __slots__ = ('lane', 'user_id', 'factory', 'on_position', 'future', 'task', 'position', 'seq', 'cancelled')
+    
+    def __init__(self, lane, user_id, factory, on_position, seq):
+        self.lane = lane
+        self.user_id = user_id
+        self.factory = factory
+        self.on_position = on_position
+        self.future = asyncio.get_running_loop().create_future()
+        self.task = None
+        self.position = None
+        self.seq = seq
+        self.cancelled = False  # Отменена через RecognitionScheduler.cancel
+
+class _Lane:
+    """Полоса: очереди пользователей, обслуживаемые по кругу"""
+    
+    def __init__(self, name, weight, max_running):
+        self.name = name
+        self.weight = weight
+        self.max_running = max_running
+        self.current_weight = 0
+        self.running = 0
+        self.users = OrderedDict()
+    
+    def __len__(self):
+        return sum(len(jobs) for jobs in self.users.values())
+    
+    def push(self, job):
+        self.users.setdefault(job.user_id, deque()).append(job)
+    
+    def pop(self):
+        """Берет задачу первого пользователя и переносит его в конец круга"""
+        user_id, jobs = next(iter(self.users.items()))
+        job = jobs.popleft()
+        del self.users[user_id]
+        if jobs:
+            self.users[user_id] = jobs
+        return job
+    
+    def remove(self, job):
+        jobs = self.users.get(job.user_id)
+        if jobs and job in jobs:
+            jobs.remove(job)
+            if not jobs:
+                del self.users[job.user_id]
+            return True
+        return False
+    
+    def can_run(self):
+        return bool(self.users) and self.running < self.max_running
+
+class RecognitionScheduler:
+    """Пул воркеров с взвешенными полосами и честной очередью пользователей"""
+    
+    def __init__(self, workers, lane_weights, lane_limits=None, max_queued=100):
+        """
+        Args:
+            workers: Количество одновременных запросов к моделям
+            lane_weights: {полоса: вес} - доля выдачи при конкуренции полос
+            lane_limits: {полоса: максимум одновременно выполняемых задач}
+            max_queued: Максимум ожидающих задач, после него submit() отказывает
+        """
+        lane_limits = lane_limits or {}
+        self.workers = workers
+        self.max_queued = max_queued
+        self.lanes = OrderedDict(
+            (name, _Lane(name, weight, lane_limits.get(name, workers)))
+            for name, weight in lane_weights.items()
+        )
+        self._seq = itertools.count()
+        self._loop = None
+        self._wakeup = None
+        self._worker_tasks = []
+    
+    @classmethod
+    def from_config(cls):
+        return cls(
+            workers=config.RECOGNITION_WORKERS,
+            lane_weights={'plant': config.PLANT_LANE_WEIGHT, 'expert': config.EXPERT_LANE_WEIGHT},
+            lane_limits={'expert': max(1, config.RECOGNITION_WORKERS - 1)},
+            max_queued=config.RECOGNITION_QUEUE_LIMIT
+        )
+    
+    def depth(self, lane=None):
+        """Сколько задач ждет в очереди (во всех полосах или в одной)"""
+        if lane:
+            return len(self.lanes[lane])
+        return sum(len(l) for l in self.lanes.values())
+    
+    def running(self):
+        """Сколько задач выполняется прямо сейчас"""
+        return sum(l.running for l in self.lanes.values())
+    
+    def _ensure_started(self):
+        loop = asyncio.get_running_loop()
+        if self._loop is loop:
+            return
+        self._loop = loop
+        self._wakeup = asyncio.Condition()
+        self._worker_tasks = [asyncio.ensure_future(self._worker()) for _ in range(self.workers)]
+    
+    async def submit(self, lane, user_id, factory, on_position=None):
+        """Ставит задачу в очередь и ждет ее результат
+
+        Args:
+            lane: Полоса ('plant' или 'expert')
+            user_id: ID пользователя (для честной очереди)
+            factory: Функция без аргументов, возвращающая корутину запроса
+            on_position: async-функция (позиция), вызывается при смене позиции
+                в очереди; 0 означает, что задача начала выполняться
+
+        Raises:
+            QueueFullError: Если очередь переполнена
+        """
+        self._ensure_started()
+        if self.depth() >= self.max_queued:
+            metrics.increment('queue_rejected_full')
+            raise QueueFullError()
+        
+        job = _Job(lane, user_id, factory, on_position, next(self._seq))
+        self.lanes[lane].push(job)
+        metrics.increment(f'queue_submitted_{lane}')
+        
+        async with self._wakeup:
+            self._wakeup.notify()
+        self._publish_positions()
+        
+        try:
+            return await job.future
+        except asyncio.CancelledError:
+            self.cancel(job)
+            raise
+    
+    def cancel(self, job):
+        """Убирает задачу из очереди или прерывает ее выполнение"""
+        job.cancelled = True
+        if self.lanes[job.lane].remove(job):
+            self._publish_positions()
+        elif job.task and not job.task.done():
+            job.task.cancel()
+        if not job.future.done():
+            job.future.cancel()
+    
+    def _pick_lane(self, lanes=None):
+        """Smooth weighted round-robin среди полос, которым можно выдать задачу"""
+        lanes = lanes if lanes is not None else self.lanes
+        ready = [lane for lane in lanes.values() if lane.can_run()]
+        if not ready:
+            return None
+        total = sum(lane.weight for lane in ready)
+        for lane in ready:
+            lane.current_weight += lane.weight
+        chosen = max(ready, key=lambda lane: lane.current_weight)
+        chosen.current_weight -= total
+        return chosen
+    
+    def _dispatch_order(self):
+        """Порядок, в котором будут выданы ожидающие задачи (без учета лимитов)"""
+        order = []
+        users = {name: OrderedDict((uid, deque(jobs)) for uid, jobs in lane.users.items())
+                 for name, lane in self.lanes.items()}
+        weights = {name: lane.current_weight for name, lane in self.lanes.items()}
+        while any(users.values()):
+            ready = [name for name in users if users[name]]
+            total = sum(self.lanes[name].weight for name in ready)
+            for name in ready:
+                weights[name] += self.lanes[name].weight
+            chosen = max(ready, key=lambda name: weights[name])
+            weights[chosen] -= total
+            user_id, jobs = next(iter(users[chosen].items()))
+            order.append(jobs.popleft())
+            del users[chosen][user_id]
+            if jobs:
+                users[chosen][user_id] = jobs
+        return order
+    
+    def _publish_positions(self):
+        """Сообщает ожидающим задачам их новую позицию в очереди"""
+        # Задачи, которые сразу заберут свободные воркеры, позицию не получают
+        idle = self.workers - self.running()
+        starting = {name: 0 for name in self.lanes}
+        position = 0
+        for job in self._dispatch_order():
+            lane = self.lanes[job.lane]
+            if idle > 0 and lane.running + starting[job.lane] < lane.max_running:
+                idle -= 1
+                starting[job.lane] += 1
+                continue
+            position += 1
+            self._notify_position(job, position)
+    
+    def _notify_position(self, job, position):
+        if job.on_position is None or job.position == position:
+            return
+        job.position = position
+        asyncio.ensure_future(self._safe_position_callback(job, position))
+    
+    @staticmethod
+    async def _safe_position_callback(job, position):
+        try:
+            await job.on_position(position)
+        except Exception as e:
+            logger.debug(f"Не удалось обновить позицию в очереди: {e}")
+    
+    async def _worker(self):
+        while True:
+            async with self._wakeup:
+                lane = self._pick_lane()
+                while lane is None:
+                    await self._wakeup.wait()
+                    lane = self._pick_lane()
+                job = lane.pop()
+                lane.running += 1
+            
+            self._publish_positions()
+            self._notify_position(job, 0)
+            try:
+                job.task = asyncio.ensure_future(job.factory())
+                result = await job.task
+                if not job.future.done():
+                    job.future.set_result(result)
+            except asyncio.CancelledError:
+                if not job.future.done():
+                    job.future.cancel()
+                if not job.cancelled:
+                    # Отменен сам обработчик очереди, а не задача
+                    raise
+            except Exception as e:
+                if not job.future.done():
+                    job.future.set_exception(e)
+            finally:
+                lane.running -= 1
+                async with self._wakeup:
+                    self._wakeup.notify_all()
+
+scheduler = RecognitionScheduler.from_config()
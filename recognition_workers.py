@@ -0,0 +1,279 @@
+"""Распознавание в отдельных процессах
+
+По умолчанию подготовка изображений, кодирование многомегабайтных JSON
+и запросы к моделям выполняются в процессе бота и конкурируют с
+обработкой обновлений Telegram за GIL. При RECOGNITION_PROCESSES > 0
+процесс бота только принимает обновления, а распознавание уходит в
+N процессов-воркеров через очереди multiprocessing:
+
+    - у каждого воркера не больше RECOGNITION_PROCESS_CONCURRENCY задач,
+      лишние задачи ждут свободного места в процессе бота (backpressure);
+    - воркеры присылают сигнал жизни, зависший или упавший воркер
+      перезапускается, а его задачи завершаются ошибкой;
+    - решение о деградации принимается в процессе бота и передается
+      вместе с задачей, задержки моделей и расход токенов возвращаются
+      обратно.
+"""
+
+import asyncio
+import itertools
+import logging
+import multiprocessing
+import threading
+import time
+import config
+import degradation
+import imaging
+import metrics
+import token_ledger
+import utils
+
+logger = logging.getLogger(__name__)
+
+WORKER_LOST_ERROR = "Обработчик распознавания перезапущен. Попробуйте отправить фото еще раз."
+
+def _failure(kind, error):
+    """Результат задачи, которая не выполнилась
+
+    Проверка качества при ошибке пропускает фото дальше (None), как и
+    imaging.photo_quality_issue для неразборчивого файла.
+    """
+    return None if kind == 'quality' else (None, error)
+
+async def recognize_in_process(kind, photos, additional_text='', plan=None, user_id=None):
+    """Распознавание в текущем процессе"""
+    if kind == 'quality':
+        # Локальная проверка качества фото, без обращения к модели
+        return await asyncio.get_running_loop().run_in_executor(None, imaging.photo_quality_issue, bytes(photos[0]))
+    # Без готового решения о деградации его принимает сама функция распознавания
+    options = {'plan': plan} if plan else {}
+    with token_ledger.attributed_to(user_id):
+        if kind == 'expert':
+            return await utils.recognize_plant_expert_mode(photos, additional_text, **options)
+        return await utils.recognize_plant_with_qwen(photos[0], **options)
+
+async def _worker_loop(index, tasks, results, heartbeat_interval):
+    loop = asyncio.get_running_loop()
+    running = {}
+
+    async def heartbeat():
+        while True:
+            results.put(('heartbeat', index, None, None))
+            await asyncio.sleep(heartbeat_interval)
+
+    async def run(job_id, kind, photos, additional_text, plan, user_id):
+        try:
+            result = await recognize_in_process(kind, photos, additional_text, plan, user_id)
+        except asyncio.CancelledError:
+            return
+        except Exception as e:
+            result = _failure(kind, f"Ошибка распознавания: {e}")
+        finally:
+            running.pop(job_id, None)
+        results.put(('result', index, job_id,
+                     (result, degradation.controller.take_latencies(), token_ledger.ledger.take_records())))
+
+    beat = asyncio.ensure_future(heartbeat())
+    while True:
+        command, job_id, payload = await loop.run_in_executor(None, tasks.get)
+        if command == 'stop':
+            break
+        if command == 'cancel':
+            task = running.get(job_id)
+            if task:
+                task.cancel()
+            continue
+        running[job_id] = asyncio.ensure_future(run(job_id, *payload))
+
+    beat.cancel()
+    for task in list(running.values()):
+        task.cancel()
+    await utils.close_http_session()
+
+def _worker_main(index, tasks, results, heartbeat_interval):
+    """Точка входа процесса-воркера"""
+    try:
+        asyncio.run(_worker_loop(index, tasks, results, heartbeat_interval))
+    except KeyboardInterrupt:
+        pass
+
+class _Worker:
+    __slots__ = ('index', 'process', 'tasks', 'inflight', 'last_seen')
+
+    def __init__(self, index, process, tasks):
+        self.index = index
+        self.process = process
+        self.tasks = tasks
+        self.inflight = {}
+        self.last_seen = time.monotonic()
+
+class ProcessRecognitionPool:
+    """Пул процессов-воркеров для распознавания"""
+
+    def __init__(self, processes, concurrency=2, heartbeat_interval=5.0, heartbeat_timeout=30.0):
+        """
+        Args:
+            processes: Количество процессов-воркеров
+            concurrency: Одновременных задач на один процесс
+            heartbeat_interval: Как часто воркер сообщает, что жив (сек)
+            heartbeat_timeout: Через сколько секунд без сигнала воркер перезапускается
+        """
+        self.processes = processes
+        self.concurrency = concurrency
+        self.heartbeat_interval = heartbeat_interval
+        self.heartbeat_timeout = heartbeat_timeout
+        self._ctx = multiprocessing.get_context('spawn')
+        self._ids = itertools.count()
+        self._loop = None
+        self._workers = []
+        self._slots = None
+        self._results = None
+        self._reader = None
+        self._monitor = None
+
+    @classmethod
+    def from_config(cls):
+        return cls(
+            config.RECOGNITION_PROCESSES,
+            concurrency=config.RECOGNITION_PROCESS_CONCURRENCY,
+            heartbeat_interval=config.RECOGNITION_HEARTBEAT_INTERVAL,
+            heartbeat_timeout=config.RECOGNITION_HEARTBEAT_TIMEOUT
+        )
+
+    def inflight(self):
+        """Сколько задач сейчас выполняется в воркерах"""
+        return sum(len(worker.inflight) for worker in self._workers)
+
+    def _ensure_started(self):
+        loop = asyncio.get_running_loop()
+        if self._loop is loop:
+            return
+        self._loop = loop
+        self._slots = asyncio.Semaphore(self.processes * self.concurrency)
+        self._results = self._ctx.Queue()
+        self._workers = [self._spawn(i) for i in range(self.processes)]
+        self._reader = threading.Thread(target=self._read_results, name='recognition-results', daemon=True)
+        self._reader.start()
+        self._monitor = asyncio.ensure_future(self._monitor_loop())
+        logger.info(f"Запущено процессов распознавания: {self.processes}")
+
+    def _spawn(self, index):
+        tasks = self._ctx.Queue()
+        process = self._ctx.Process(
+            target=_worker_main,
+            args=(index, tasks, self._results, self.heartbeat_interval),
+            name=f'recognition-worker-{index}',
+            daemon=True
+        )
+        process.start()
+        return _Worker(index, process, tasks)
+
+    async def recognize(self, kind, photos, additional_text='', user_id=None):
+        """Распознает фото в одном из воркеров
+
+        Returns:
+            tuple: (результат, ошибка), как у utils.recognize_plant_with_qwen
+        """
+        self._ensure_started()
+        # В процесс-воркер передаются только байты
+        photos = [await photo.read() if hasattr(photo, 'read') else photo for photo in photos]
+        async with self._slots:
+            worker = min(self._workers, key=lambda w: len(w.inflight))
+            job_id = next(self._ids)
+            future = self._loop.create_future()
+            worker.inflight[job_id] = (kind, future)
+            plan = degradation.controller.plan(kind) if kind != 'quality' else None
+            worker.tasks.put(('run', job_id, (kind, [bytes(photo) for photo in photos], additional_text, plan, user_id)))
+            try:
+                return await future
+            except asyncio.CancelledError:
+                # Прерываем запрос к модели и в воркере
+                if worker.inflight.pop(job_id, None) is not None:
+                    worker.tasks.put(('cancel', job_id, None))
+                raise
+
+    def _read_results(self):
+        while True:
+            message = self._results.get()
+            if message is None:
+                return
+            self._loop.call_soon_threadsafe(self._on_message, message)
+
+    def _on_message(self, message):
+        kind, index, job_id, payload = message
+        if index >= len(self._workers):
+            return
+        worker = self._workers[index]
+        worker.last_seen = time.monotonic()
+        if kind != 'result':
+            return
+
+        result, latencies, records = payload
+        for seconds in latencies:
+            degradation.controller.observe_latency(seconds)
+        token_ledger.ledger.merge(records)
+        entry = worker.inflight.pop(job_id, None)
+        if entry is not None and not entry[1].done():
+            entry[1].set_result(result)
+
+    async def _monitor_loop(self):
+        while True:
+            await asyncio.sleep(self.heartbeat_interval)
+            now = time.monotonic()
+            for worker in list(self._workers):
+                if not worker.process.is_alive():
+                    self._restart(worker, "процесс завершился")
+                elif now - worker.last_seen > self.heartbeat_timeout:
+                    self._restart(worker, f"нет сигнала {now - worker.last_seen:.0f} с")
+
+    def _restart(self, worker, reason):
+        logger.error(f"Перезапуск воркера распознавания {worker.index}: {reason}")
+        metrics.increment('recognition_worker_restarts')
+        if worker.process.is_alive():
+            worker.process.kill()
+        worker.process.join(timeout=1)
+
+        for kind, future in worker.inflight.values():
+            if not future.done():
+                future.set_result(_failure(kind, WORKER_LOST_ERROR))
+        worker.inflight.clear()
+        self._workers[worker.index] = self._spawn(worker.index)
+
+    async def close(self):
+        """Останавливает воркеры"""
+        if self._loop is None:
+            return
+        self._monitor.cancel()
+        for worker in self._workers:
+            worker.tasks.put(('stop', None, None))
+        for worker in self._workers:
+            await asyncio.get_running_loop().run_in_executor(None, worker.process.join, 5)
+            if worker.process.is_alive():
+                worker.process.kill()
+        self._results.put(None)
+        self._loop = None
+        self._workers = []
+
+pool = ProcessRecognitionPool.from_config() if config.RECOGNITION_PROCESSES > 0 else None
+
+async def recognize(kind, photos, additional_text='', user_id=None):
+    """Распознает фото в процессе-воркере, если они включены, иначе в процессе бота
+
+    Args:
+        kind: 'plant', 'expert' или 'quality' (проверка качества фото)
+        photos: Список байтов изображений (для 'plant' используется первое)
+        additional_text: Описание пользователя для экспертного анализа
+        user_id: На кого записывать расход токенов (token_ledger)
+    """
+    if pool is None:
+        return await recognize_in_process(kind, photos, additional_text, user_id=user_id)
+    return await pool.recognize(kind, photos, additional_text, user_id)
+
+async def check_quality(photo):
+    """Проверяет качество фото в процессе-воркере (см. imaging.photo_quality_issue)"""
+    return await recognize('quality', [photo])
+
+async def shutdown(application=None):
+    """Останавливает процессы распознавания при остановке бота"""
+    if pool is not None:
+        await pool.close()
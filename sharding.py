@@ -0,0 +1,155 @@
+"""Шардирование бота по пользователям
+
+Несколько экземпляров бота работают за легким диспетчером вебхуков.
+Диспетчер принимает обновления от Telegram и пересылает каждое в шард,
+выбранный консистентным хешированием user_id. Все обновления одного
+пользователя попадают в один шард, поэтому состояние в памяти
+(экспертный режим, подписки, очередь распознавания) остается локальным
+для шарда. Ежедневная рассылка в каждом шарде идет только своим
+пользователям.
+
+Запуск диспетчера:
+    python sharding.py
+"""
+
+import asyncio
+import bisect
+import hashlib
+import json
+import logging
+import os
+import aiohttp
+from aiohttp import web
+import config
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Поля обновления, в которых Telegram передает автора
+_UPDATE_USER_FIELDS = (
+    'message', 'edited_message', 'callback_query', 'inline_query',
+    'chosen_inline_result', 'shipping_query', 'pre_checkout_query',
+    'poll_answer', 'my_chat_member', 'chat_member', 'chat_join_request'
+)
+
+def _hash(key):
+    return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), 'big')
+
+class ConsistentHashRing:
+    """Кольцо консистентного хеширования с виртуальными узлами
+
+    При добавлении шарда переезжает примерно 1/N пользователей,
+    остальные остаются на своих шардах.
+    """
+
+    def __init__(self, shard_count, replicas=100):
+        self.shard_count = shard_count
+        points = sorted(
+            (_hash(f"shard-{shard}#{replica}"), shard)
+            for shard in range(shard_count)
+            for replica in range(replicas)
+        )
+        self._keys = [key for key, _ in points]
+        self._shards = [shard for _, shard in points]
+
+    def shard_for(self, user_id):
+        """Номер шарда, который обслуживает пользователя"""
+        if self.shard_count == 1:
+            return 0
+        index = bisect.bisect(self._keys, _hash(str(user_id))) % len(self._keys)
+        return self._shards[index]
+
+ring = ConsistentHashRing(config.SHARD_COUNT)
+
+def is_sharded():
+    return config.SHARD_COUNT > 1
+
+def owns_user(user_id):
+    """Обслуживает ли текущий экземпляр бота этого пользователя"""
+    return ring.shard_for(user_id) == config.SHARD_INDEX
+
+def local_path(path):
+    """Путь к файлу состояния, уникальный для шарда
+
+    recognition_jobs.db -> recognition_jobs.shard1.db
+    """
+    if not is_sharded():
+        return path
+    root, ext = os.path.splitext(path)
+    return f"{root}.shard{config.SHARD_INDEX}{ext}"
+
+def update_user_id(update):
+    """ID автора необработанного обновления Telegram (dict) или None"""
+    for field in _UPDATE_USER_FIELDS:
+        payload = update.get(field)
+        if not payload:
+            continue
+        user = payload.get('from') or payload.get('user')
+        if user:
+            return user.get('id')
+        chat = payload.get('chat')
+        if chat:
+            return chat.get('id')
+    return None
+
+def create_dispatcher_app(shard_urls, secret=None):
+    """Веб-приложение диспетчера, пересылающее обновления в шарды
+
+    Args:
+        shard_urls: Адреса вебхуков шардов, по порядку номеров
+        secret: Секрет вебхука (X-Telegram-Bot-Api-Secret-Token)
+    """
+    shard_ring = ConsistentHashRing(len(shard_urls))
+
+    async def http_session(app):
+        app['session'] = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=10))
+        yield
+        await app['session'].close()
+
+    async def dispatch(request):
+        if secret and request.headers.get('X-Telegram-Bot-Api-Secret-Token') != secret:
+            return web.Response(status=403)
+
+        body = await request.read()
+        try:
+            user_id = update_user_id(json.loads(body))
+        except ValueError:
+            return web.Response(status=400)
+
+        # Обновления без автора обслуживает нулевой шард
+        shard = shard_ring.shard_for(user_id) if user_id is not None else 0
+        headers = {'Content-Type': 'application/json'}
+        if secret:
+            headers['X-Telegram-Bot-Api-Secret-Token'] = secret
+
+        try:
+            async with request.app['session'].post(shard_urls[shard], data=body, headers=headers) as response:
+                metrics.increment(f'shard_{shard}_updates')
+                # Ошибка шарда возвращается Telegram, и он повторит доставку
+                return web.Response(status=response.status)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logger.error(f"Шард {shard} недоступен: {e}")
+            metrics.increment(f'shard_{shard}_unavailable')
+            return web.Response(status=502)
+
+    app = web.Application()
+    app.cleanup_ctx.append(http_session)
+    app.router.add_post('/webhook', dispatch)
+    return app
+
+def run_dispatcher():
+    """Запускает диспетчер вебхуков"""
+    if len(config.SHARD_URLS) != config.SHARD_COUNT:
+        raise SystemExit(f"SHARD_URLS содержит {len(config.SHARD_URLS)} адресов, а SHARD_COUNT={config.SHARD_COUNT}")
+    logger.info(f"Диспетчер вебхуков на {config.DISPATCHER_HOST}:{config.DISPATCHER_PORT}, шардов: {config.SHARD_COUNT}")
+    web.run_app(
+        create_dispatcher_app(config.SHARD_URLS, config.WEBHOOK_SECRET),
+        host=config.DISPATCHER_HOST, port=config.DISPATCHER_PORT
+    )
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+        level=logging.INFO
+    )
+    run_dispatcher()
@@ -0,0 +1,156 @@
+"""Кеш описаний видов растений
+
+Описательная часть ответа (внешний вид, факты, где растет, цветение,
+выращивание дома) одинакова для всех фото одного вида. Модель по фото
+только определяет вид с маленьким max_tokens, а описание берется из
+SQLite и генерируется текстовым запросом лишь при промахе кеша.
+
+Бот обращается к базе через get_async, put_async и stats_async: запросы
+к SQLite выполняются в отдельном потоке, как в job_store.
+"""
+
+import asyncio
+import functools
+import logging
+import re
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+import config
+import metrics
+
+logger = logging.getLogger(__name__)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS species (
+    key TEXT PRIMARY KEY,
+    name TEXT NOT NULL,
+    latin TEXT NOT NULL,
+    description TEXT NOT NULL,
+    tokens INTEGER NOT NULL,
+    created_at REAL NOT NULL,
+    hits INTEGER NOT NULL DEFAULT 0
+);
+"""
+
+def species_key(identification):
+    """Ключ вида: латинское название, а без него - русское"""
+    name = identification['latin'] or identification['name']
+    return re.sub(r'\s+', ' ', name).strip().lower()
+
+class SpeciesCache:
+    """Описания видов в SQLite"""
+
+    def __init__(self, path, max_age=30 * 86400, clock=time.time):
+        """
+        Args:
+            path: Путь к файлу базы (':memory:' для тестов)
+            max_age: Описания старше N секунд генерируются заново
+            clock: Источник времени (для тестов)
+        """
+        self.path = path
+        self.max_age = max_age
+        self.clock = clock
+        self._conn = None
+        self._executor = None
+
+    @classmethod
+    def from_config(cls):
+        return cls(config.SPECIES_CACHE_PATH, max_age=config.SPECIES_CACHE_MAX_AGE)
+
+    @property
+    def conn(self):
+        # База открывается при первом обращении, а не при импорте модуля
+        if self._conn is None:
+            # Соединение используется и из потока базы (см. _in_thread)
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.executescript(_SCHEMA)
+        return self._conn
+
+    def get(self, identification):
+        """Сохраненное описание вида или None
+
+        Попадания и сэкономленные токены ответа считаются в metrics.
+        """
+        return self._count(self._lookup(species_key(identification)))
+
+    def _lookup(self, key):
+        row = self.conn.execute(
+            "SELECT description, tokens FROM species WHERE key = ? AND created_at >= ?",
+            (key, self.clock() - self.max_age)
+        ).fetchone()
+        if row is not None:
+            with self.conn:
+                self.conn.execute("UPDATE species SET hits = hits + 1 WHERE key = ?", (key,))
+        return row
+
+    def _count(self, row):
+        # Счетчики metrics меняются только в потоке цикла событий
+        metrics.increment('species_cache_lookups')
+        if row is None:
+            metrics.increment('species_cache_misses')
+            return None
+        description, tokens = row
+        metrics.increment('species_cache_hits')
+        metrics.increment('species_cache_tokens_saved', tokens)
+        return description
+
+    def put(self, identification, description, tokens):
+        """Сохраняет описание вида
+
+        Args:
+            tokens: Сколько токенов ответа стоила генерация описания
+        """
+        with self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO species (key, name, latin, description, tokens, created_at)"
+                " VALUES (?, ?, ?, ?, ?, ?)",
+                (species_key(identification), identification['name'], identification['latin'],
+                 description, tokens, self.clock())
+            )
+
+    def stats(self):
+        """Число видов в кеше, доля попаданий и сэкономленные токены"""
+        return self._stats(self._species_count())
+
+    def _species_count(self):
+        return self.conn.execute("SELECT COUNT(*) FROM species").fetchone()[0]
+
+    def _stats(self, species):
+        return {
+            'species': species,
+            'hit_rate': metrics.average('species_cache_hits', 'species_cache_lookups'),
+            'tokens_saved': metrics.get('species_cache_tokens_saved')
+        }
+
+    async def _in_thread(self, method, *args, **kwargs):
+        # Один поток: операции с базой выполняются по очереди
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='species-cache')
+        return await asyncio.get_running_loop().run_in_executor(
+            self._executor, functools.partial(method, *args, **kwargs)
+        )
+
+    async def get_async(self, identification):
+        """get() с запросом к базе в потоке базы"""
+        return self._count(await self._in_thread(self._lookup, species_key(identification)))
+
+    async def put_async(self, identification, description, tokens):
+        """put() в потоке базы"""
+        await self._in_thread(self.put, identification, description, tokens)
+
+    async def stats_async(self):
+        """stats() с запросом к базе в потоке базы"""
+        return self._stats(await self._in_thread(self._species_count))
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+cache = SpeciesCache.from_config()
@@ -74,6 +74,26 @@ async def test_keyboards():
         about_kb = keyboards.get_about_keyboard()
         print("✅ Клавиатура информации создана")
         
+        # Неизменяемые клавиатуры строятся один раз и переиспользуются
+        assert keyboards.get_main_keyboard() is main_kb
+        assert keyboards.get_lessons_after_sample_keyboard(True) is keyboards.get_lessons_after_sample_keyboard(True)
+        assert keyboards.get_lessons_after_sample_keyboard(True) != keyboards.get_lessons_after_sample_keyboard(False)
+        print("✅ Клавиатуры кешируются")
+        
+        # Клавиатура обратной связи следует за настройками администратора
+        import config
+        saved_username = config.ADMIN_USERNAME
+        try:
+            config.ADMIN_USERNAME = "@first_admin"
+            first_kb = keyboards.get_feedback_keyboard()
+            config.ADMIN_USERNAME = "second_admin"
+            second_kb = keyboards.get_feedback_keyboard()
+            assert first_kb.inline_keyboard[0][0].url == "https://t.me/first_admin"
+            assert second_kb.inline_keyboard[0][0].url == "https://t.me/second_admin"
+        finally:
+            config.ADMIN_USERNAME = saved_username
+        print("✅ Клавиатура обратной связи кешируется по ссылке администратора")
+        
         return True
         
     except Exception as e:
@@ -107,6 +127,1696 @@ async def test_handlers():
         print(f"❌ Ошибка в handlers.py: {e}")
         return False
 
+async def test_callback_dispatch():
+    """Тестирует таблицу диспетчеризации callback-запросов"""
+    print("\n🔧 Тестирование диспетчеризации callback...")
+    
+    try:
+        import handlers
+        import keyboards
+        
+        # Каждая кнопка всех клавиатур должна вести к зарегистрированному обработчику
+        markups = [
+            keyboards.get_help_keyboard(), keyboards.get_about_keyboard(),
+            keyboards.get_feedback_keyboard(), keyboards.get_photo_tips_keyboard(),
+            keyboards.get_main_menu_inline(), keyboards.get_expert_mode_keyboard(),
+            keyboards.get_main_keyboard_inline(), keyboards.get_restart_keyboard(),
+            keyboards.get_flower_test_keyboard(), keyboards.get_lessons_unsubscribed_keyboard(),
+            keyboards.get_lessons_subscribed_keyboard(),
+            keyboards.get_lessons_after_sample_keyboard(True),
+            keyboards.get_lessons_after_sample_keyboard(False)
+        ]
+        for markup in markups:
+            for row in markup.inline_keyboard:
+                for button in row:
+                    if button.callback_data:
+                        handler, _ = handlers.resolve_callback(button.callback_data)
+                        assert handler is not None, f"Нет обработчика для {button.callback_data}"
+        print("✅ Все кнопки клавиатур имеют обработчики")
+        
+        # Параметризованные callback_data передают остаток как payload
+        @handlers.callback_handler(prefix="test_prefix:")
+        async def prefix_handler(update, context, payload):
+            pass
+        try:
+            handler, payload = handlers.resolve_callback("test_prefix:42")
+            assert handler is prefix_handler and payload == "42"
+            assert handlers.resolve_callback("unknown_callback") == (None, None)
+        finally:
+            handlers.CALLBACK_PREFIX_HANDLERS.remove(("test_prefix:", prefix_handler))
+        print("✅ Префиксные callback_data работают")
+        
+        return True
+        
+    except Exception as e:
+        print(f"❌ Ошибка диспетчеризации callback: {e}")
+        return False
+
+async def test_lessons():
+    """Тестирует каталог уроков биологии"""
+    print("\n🔧 Тестирование каталога уроков...")
+    
+    try:
+        import json
+        import tempfile
+        import config
+        import lessons
+        
+        catalogue = lessons.LessonCatalogue(config.BIOLOGY_LESSONS)
+        assert len(catalogue) == len(config.BIOLOGY_LESSONS)
+        for index, lesson in enumerate(config.BIOLOGY_LESSONS):
+            assert catalogue.rendered(index) == lessons.render_lesson(lesson)
+        print(f"✅ Уроки отрендерены заранее: {len(catalogue)} шт.")
+        
+        assert lessons.validate_markdown("**жирный** и _курсив_ и [ссылка](https://t.me)") == []
+        assert lessons.validate_markdown("незакрытый *жирный")
+        assert lessons.validate_markdown("x" * (lessons.TELEGRAM_MESSAGE_LIMIT + 1))
+        print("✅ Проверка разметки Telegram работает")
+        
+        lesson = dict(config.BIOLOGY_LESSONS[0])
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, 'lessons.json')
+            with open(path, 'w', encoding='utf-8') as f:
+                json.dump([lesson], f, ensure_ascii=False)
+            file_catalogue = lessons.LessonCatalogue(config.BIOLOGY_LESSONS, source_path=path)
+            assert file_catalogue.reload(force=True) and len(file_catalogue) == 1
+            
+            # Сломанный, пустой или не того формата каталог не заменяет рабочий набор
+            broken = [
+                [lesson, dict(lesson, fact="незакрытый _курсив")],
+                [],
+                {'title': lesson['title']},
+                [lesson, "урок"],
+                [dict(lesson, question=None)],
+            ]
+            for catalogue_data in broken:
+                with open(path, 'w', encoding='utf-8') as f:
+                    json.dump(catalogue_data, f, ensure_ascii=False)
+                assert not file_catalogue.reload(force=True) and len(file_catalogue) == 1, catalogue_data
+            try:
+                lessons.LessonCatalogue([])
+                assert False, "пустой каталог принят"
+            except lessons.LessonValidationError:
+                pass
+            
+            with open(path, 'w', encoding='utf-8') as f:
+                json.dump([lesson, lesson], f, ensure_ascii=False)
+            assert file_catalogue.reload(force=True) and len(file_catalogue) == 2
+        print("✅ Уроки перезагружаются из файла без перезапуска")
+        
+        return True
+        
+    except Exception as e:
+        print(f"❌ Ошибка каталога уроков: {e}")
+        return False
+
+class FakeClock:
+    """Управляемые часы для тестов лимитов и таймаутов"""
+    def __init__(self):
+        self.now = 1000.0
+    
+    def __call__(self):
+        return self.now
+
+def sample_jpeg(size=(64, 48)):
+    """Небольшой JPEG для тестов запросов к моделям"""
+    import io
+    from PIL import Image
+    
+    buffer = io.BytesIO()
+    Image.new('RGB', size, 'green').save(buffer, format='JPEG')
+    return buffer.getvalue()
+
+async def test_throttling():
+    """Тестирует ограничение частоты запросов на распознавание"""
+    print("\n🔧 Тестирование ограничения частоты...")
+    
+    try:
+        import metrics
+        import throttling
+        
+        clock = FakeClock()
+        bucket = throttling.TokenBucket(rate=1, capacity=2, clock=clock)
+        assert bucket.try_acquire() and bucket.try_acquire() and not bucket.try_acquire()
+        assert bucket.retry_after() == 1
+        clock.now += 1
+        assert bucket.try_acquire()
+        print("✅ Token bucket пополняется со временем")
+        
+        throttle = throttling.RecognitionThrottle(
+            user_rate=1 / 60, user_burst=2, global_rate=1, global_burst=3,
+            duplicate_window=60, clock=clock
+        )
+        rejected_before = metrics.get('throttle_rejected_duplicate')
+        assert throttle.admit(1, "photo-a")[0]
+        assert throttle.admit(1, "photo-a")[1] == 'duplicate'
+        assert metrics.get('throttle_rejected_duplicate') == rejected_before + 1
+        throttle.forget(1, "photo-a")
+        assert throttle.admit(1, "photo-a")[0]
+        allowed, reason, retry_after = throttle.admit(1, "photo-b")
+        assert not allowed and reason == 'user_rate' and retry_after > 0
+        print("✅ Повторы фото и персональный лимит отсекаются")
+        
+        assert throttle.admit(2, "photo-c")[0]
+        assert throttle.admit(3, "photo-d")[1] == 'global_rate'
+        clock.now += 61
+        assert throttle.admit(3, "photo-d")[0] and throttle.admit(1, "photo-a")[0]
+        print("✅ Глобальный лимит защищает квоту API")
+        
+        return True
+        
+    except Exception as e:
+        print(f"❌ Ошибка ограничения частоты: {e}")
+        return False
+
+async def test_recognition_queue():
+    """Тестирует планировщик очереди распознавания"""
+    print("\n🔧 Тестирование очереди распознавания...")
+    
+    try:
+        import recognition_queue
+        
+        scheduler = recognition_queue.RecognitionScheduler(
+            workers=2, lane_weights={'plant': 3, 'expert': 1},
+            lane_limits={'expert': 1}, max_queued=20
+        )
+        started = []
+        positions = {}
+        
+        async def job(name, delay):
+            started.append(name)
+            await asyncio.sleep(delay)
+            return name
+        
+        def tracker(name):
+            async def on_position(position):
+                positions.setdefault(name, []).append(position)
+            return on_position
+        
+        # Всплеск экспертных задач, затем быстрые определения от разных пользователей
+        tasks = [
+            asyncio.ensure_future(scheduler.submit('expert', 1, lambda i=i: job(f"e{i}", 0.02), tracker(f"e{i}")))
+            for i in range(5)
+        ]
+        await asyncio.sleep(0)
+        tasks += [
+            asyncio.ensure_future(scheduler.submit('plant', 10 + i, lambda i=i: job(f"p{i}", 0.005)))
+            for i in range(3)
+        ]
+        results = await asyncio.gather(*tasks)
+        assert sorted(results) == sorted(started)
+        assert started.index("p2") < started.index("e1"), started
+        assert positions["e4"][0] == 4 and positions["e4"][-1] == 0, positions["e4"]
+        print("✅ Экспертные задачи не блокируют быстрые определения")
+        
+        # Пользователи обслуживаются по кругу внутри полосы
+        started.clear()
+        single = recognition_queue.RecognitionScheduler(workers=1, lane_weights={'plant': 1})
+        blocker = asyncio.ensure_future(single.submit('plant', 0, lambda: job("blocker", 0.01)))
+        await asyncio.sleep(0)
+        tasks = [asyncio.ensure_future(single.submit('plant', 1, lambda i=i: job(f"a{i}", 0))) for i in range(3)]
+        tasks.append(asyncio.ensure_future(single.submit('plant', 2, lambda: job("b0", 0))))
+        await asyncio.gather(blocker, *tasks)
+        assert started.index("b0") < started.index("a1"), started
+        print("✅ Очередь честная между пользователями")
+        
+        full = recognition_queue.RecognitionScheduler(workers=1, lane_weights={'plant': 1}, max_queued=1)
+        blocker = asyncio.ensure_future(full.submit('plant', 0, lambda: job("blocker", 0.01)))
+        await asyncio.sleep(0)
+        waiting = asyncio.ensure_future(full.submit('plant', 1, lambda: job("waiting", 0)))
+        await asyncio.sleep(0)
+        try:
+            await full.submit('plant', 2, lambda: job("overflow", 0))
+            raise AssertionError("ожидалась QueueFullError")
+        except recognition_queue.QueueFullError:
+            pass
+        await asyncio.gather(blocker, waiting)
+        print("✅ Переполненная очередь отказывает сразу")
+        
+        return True
+        
+    except Exception as e:
+        print(f"❌ Ошибка очереди распознавания: {e}")
+        return False
+
+async def test_recognition_cancellation():
+    """Тестирует отмену устаревших распознаваний"""
+    print("\n🔧 Тестирование отмены распознаваний...")
+    
+    try:
+        import recognition_queue
+        import utils
+        
+        scheduler = recognition_queue.RecognitionScheduler(workers=1, lane_weights={'plant': 1})
+        interrupted = []
+        
+        async def slow_request(name):
+            try:
+                await asyncio.sleep(10)
+                return name, None
+            except asyncio.CancelledError:
+                interrupted.append(name)
+                raise
+        
+        # Новое распознавание того же пользователя отменяет предыдущее
+        old = asyncio.ensure_future(utils.run_recognition(
+            42, scheduler.submit('plant', 42, lambda: slow_request("old"))))
+        await asyncio.sleep(0.01)
+        assert scheduler.running() == 1
+        new = asyncio.ensure_future(utils.run_recognition(
+            42, scheduler.submit('plant', 42, lambda: asyncio.sleep(0, result=("new", None)))))
+        assert await old is None
+        assert await new == ("new", None)
+        assert interrupted == ["old"], interrupted
+        assert scheduler.running() == 0 and 42 not in utils.active_recognitions
+        print("✅ Новое фото отменяет предыдущий запрос к модели")
+        
+        # Отмена по действию пользователя (главное меню, очистка данных)
+        pending = asyncio.ensure_future(utils.run_recognition(
+            7, scheduler.submit('plant', 7, lambda: slow_request("menu"))))
+        await asyncio.sleep(0.01)
+        assert utils.cancel_recognition(7)
+        assert await pending is None
+        assert not utils.cancel_recognition(7)
+        assert interrupted == ["old", "menu"], interrupted
+        print("✅ Действие пользователя отменяет распознавание")
+        
+        # Отмена самого обработчика не маскируется
+        handler = asyncio.ensure_future(utils.run_recognition(
+            8, scheduler.submit('plant', 8, lambda: slow_request("handler"))))
+        await asyncio.sleep(0.01)
+        handler.cancel()
+        try:
+            await handler
+            raise AssertionError("ожидалась CancelledError")
+        except asyncio.CancelledError:
+            pass
+        assert "handler" in interrupted
+        print("✅ Отмена обработчика пробрасывается дальше")
+        
+        # Отмена обработчика очереди во время задачи останавливает его
+        pending = asyncio.ensure_future(scheduler.submit('plant', 9, lambda: slow_request("worker")))
+        await asyncio.sleep(0.01)
+        worker = scheduler._worker_tasks[0]
+        worker.cancel()
+        await asyncio.sleep(0.01)
+        assert worker.done() and worker.cancelled()
+        assert pending.cancelled() and "worker" in interrupted
+        print("✅ Обработчик очереди останавливается при отмене")
+        
+        return True
+        
+    except Exception as e:
+        print(f"❌ Ошибка отмены распознаваний: {e}")
+        return False
+
+async def test_job_store():
+    """Тестирует долговременную очередь задач распознавания"""
+    print("\n🔧 Тестирование долговременной очереди...")
+    
+    try:
+        import handlers
+        import job_store
+        import utils
+        
+        clock = FakeClock()
+        store = job_store.JobStore(':memory:', max_attempts=2, max_age=600, clock=clock)
+        done = store.add('plant', 1, 100, [b'photo'], status_message_id=5, reply_to_message_id=4)
+        kept = store.add('expert', 2, 200, [b'a', bytearray(b'b')], status_message_id=9, additional_text='лес')
+        store.complete(done)
+        
+        jobs = store.pending()
+        assert [job['id'] for job in jobs] == [kept]
+        assert jobs[0]['photos'] == [b'a', b'b'] and jobs[0]['additional_text'] == 'лес'
+        assert jobs[0]['chat_id'] == 200 and jobs[0]['status_message_id'] == 9
+        print("✅ Незавершенные задачи сохраняются вместе с фото")
+        
+        # Задача, роняющая бота, не повторяется бесконечно
+        assert len(store.pending()) == 1
+        assert store.pending() == []
+        store.add('plant', 3, 300, [b'old'])
+        clock.now += 601
+        assert store.pending() == []
+        print("✅ Устаревшие и исчерпавшие попытки задачи отбрасываются")
+        
+        # Повтор после перезапуска отвечает в исходный чат
+        class FakeBot:
+            def __init__(self):
+                self.calls = []
+            
+            async def send_message(self, chat_id, text, **kwargs):
+                self.calls.append(('send', chat_id, kwargs.get('reply_to_message_id')))
+            
+            async def edit_message_text(self, text, chat_id=None, message_id=None, **kwargs):
+                self.calls.append(('edit', chat_id, message_id))
+            
+            async def delete_message(self, chat_id, message_id):
+                self.calls.append(('delete', chat_id, message_id))
+        
+        async def fake_recognition(image_bytes):
+            return f"Растение {len(image_bytes)}", None
+        
+        original_store, original_recognize = job_store.store, utils.recognize_plant_with_qwen
+        job_store.store = job_store.JobStore(':memory:')
+        utils.recognize_plant_with_qwen = fake_recognition
+        try:
+            store = job_store.store
+            # Обработчики пишут в базу из отдельного потока
+            await store.add_async('plant', 4, 400, [b'rose'], status_message_id=41, reply_to_message_id=40)
+            job = (await store.pending_async())[0]
+            assert job['photos'] == [b'rose']
+            bot = FakeBot()
+            await handlers.replay_recognition_job(bot, job)
+            assert bot.calls == [('send', 400, 40), ('delete', 400, 41)], bot.calls
+            assert store.pending() == []
+        finally:
+            job_store.store.close()
+            job_store.store, utils.recognize_plant_with_qwen = original_store, original_recognize
+        print("✅ Прерванное распознавание повторяется с ответом в исходный чат")
+        
+        return True
+        
+    except Exception as e:
+        print(f"❌ Ошибка долговременной очереди: {e}")
+        return False
+
+async def test_recognition_workers():
+    """Тестирует распознавание в отдельных процессах"""
+    print("\n🔧 Тестирование процессов распознавания...")
+    
+    server = None
+    pool = None
+    try:
+        import io
+        from PIL import Image
+        import fake_openrouter
+        import recognition_workers
+        
+        server = fake_openrouter.FakeOpenRouter(content="Роза", delay=0.05)
+        await server.start()
+        buffer = io.BytesIO()
+        Image.new('RGB', (64, 64), 'green').save(buffer, format='JPEG')
+        photo = buffer.getvalue()
+        
+        pool = recognition_workers.ProcessRecognitionPool(
+            2, concurrency=1, heartbeat_interval=0.2, heartbeat_timeout=10
+        )
+        results = await asyncio.gather(*[pool.recognize('plant', [photo]) for _ in range(4)])
+        assert results == [("Роза", None)] * 4, results
+        assert pool.inflight() == 0
+        print("✅ Задачи выполняются в процессах-воркерах")
+        
+        # Отмена доходит до запроса в воркере
+        server.delay = 5
+        task = asyncio.ensure_future(pool.recognize('plant', [photo]))
+        await asyncio.sleep(0.5)
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+        assert pool.inflight() == 0
+        print("✅ Отмена передается в воркер")
+        
+        # Упавший воркер перезапускается, его задача завершается ошибкой
+        task = asyncio.ensure_future(pool.recognize('expert', [photo, photo], "лес"))
+        await asyncio.sleep(0.5)
+        busy = next(worker for worker in pool._workers if worker.inflight)
+        busy.process.kill()
+        assert await task == (None, recognition_workers.WORKER_LOST_ERROR)
+        server.delay = 0
+        assert await pool.recognize('plant', [photo]) == ("Роза", None)
+        assert all(worker.process.is_alive() for worker in pool._workers)
+        print("✅ Упавший воркер перезапускается")
+        
+        # Неудачная или потерянная проверка качества пропускает фото дальше
+        buffer = io.BytesIO()
+        Image.new('RGB', (640, 640), 'green').save(buffer, format='JPEG')
+        truncated = buffer.getvalue()[:len(buffer.getvalue()) // 2]
+        assert await pool.recognize('quality', [truncated]) is None
+        task = asyncio.ensure_future(pool.recognize('quality', [photo]))
+        await asyncio.sleep(0)
+        busy = next(worker for worker in pool._workers if worker.inflight)
+        pool._restart(busy, "тест")
+        assert await task is None
+        assert pool.inflight() == 0
+        print("✅ Ошибка проверки качества не блокирует распознавание")
+        
+        return True
+        
+    except Exception as e:
+        print(f"❌ Ошибка процессов распознавания: {e}")
+        return False
+    
+    finally:
+        if pool is not None:
+            await pool.close()
+        if server is not None:
+            await server.stop()
+
+async def test_sharding():
+    """Тестирует шардирование по пользователям"""
+    print("\n🔧 Тестирование шардирования...")
+    
+    runners = []
+    try:
+        import json
+        import aiohttp
+        from aiohttp import web
+        import config
+        import sharding
+        
+        users = range(1, 20001)
+        ring = sharding.ConsistentHashRing(4)
+        owners = {user_id: ring.shard_for(user_id) for user_id in users}
+        assert all(ring.shard_for(user_id) == owners[user_id] for user_id in range(1, 101))
+        counts = [list(owners.values()).count(shard) for shard in range(4)]
+        assert min(counts) > len(users) / 4 * 0.7, counts
+        print(f"✅ Пользователи распределены по шардам: {counts}")
+        
+        # При добавлении шарда переезжает примерно пятая часть пользователей
+        grown = sharding.ConsistentHashRing(5)
+        moved = sum(1 for user_id in users if grown.shard_for(user_id) != owners[user_id])
+        assert moved < len(users) * 0.3, moved
+        assert all(grown.shard_for(user_id) in (owners[user_id], 4) for user_id in users)
+        print(f"✅ Новый шард забирает {moved / len(users):.0%} пользователей")
+        
+        assert sharding.update_user_id({'message': {'from': {'id': 5}, 'chat': {'id': 6}}}) == 5
+        assert sharding.update_user_id({'callback_query': {'from': {'id': 7}}}) == 7
+        assert sharding.update_user_id({'my_chat_member': {'chat': {'id': 8}, 'from': {'id': 9}}}) == 9
+        assert sharding.update_user_id({'update_id': 1}) is None
+        
+        # Диспетчер пересылает обновление в шард пользователя
+        received = {}
+        
+        async def start(app):
+            runner = web.AppRunner(app, access_log=None)
+            await runner.setup()
+            site = web.TCPSite(runner, '127.0.0.1', 0)
+            await site.start()
+            runners.append(runner)
+            return f"http://127.0.0.1:{site._server.sockets[0].getsockname()[1]}"
+        
+        def shard_app(shard):
+            async def webhook(request):
+                assert request.headers['X-Telegram-Bot-Api-Secret-Token'] == 'shard-secret'
+                received.setdefault(shard, []).append(sharding.update_user_id(await request.json()))
+                return web.Response()
+            app = web.Application()
+            app.router.add_post('/webhook', webhook)
+            return app
+        
+        shard_urls = [await start(shard_app(shard)) + '/webhook' for shard in range(3)]
+        secret = 'shard-secret'
+        dispatcher = await start(sharding.create_dispatcher_app(shard_urls, secret))
+        routing = sharding.ConsistentHashRing(3)
+        async with aiohttp.ClientSession() as session:
+            for user_id in range(1, 31):
+                update = json.dumps({'update_id': user_id, 'message': {'from': {'id': user_id}}})
+                async with session.post(dispatcher + '/webhook', data=update,
+                                        headers={'X-Telegram-Bot-Api-Secret-Token': secret}) as response:
+                    assert response.status == 200
+            async with session.post(dispatcher + '/webhook', data='{}') as response:
+                assert response.status == 403
+        for shard, user_ids in received.items():
+            assert all(routing.shard_for(user_id) == shard for user_id in user_ids)
+        assert sum(len(user_ids) for user_ids in received.values()) == 30
+        print("✅ Диспетчер пересылает обновления в шард пользователя")
+        
+        # Каждый подписчик получает урок ровно от одного шарда
+        original_count, original_index, original_ring = config.SHARD_COUNT, config.SHARD_INDEX, sharding.ring
+        try:
+            config.SHARD_COUNT = 3
+            sharding.ring = sharding.ConsistentHashRing(3)
+            recipients = []
+            for shard in range(3):
+                config.SHARD_INDEX = shard
+                recipients += [user_id for user_id in users if sharding.owns_user(user_id)]
+            assert sorted(recipients) == list(users)
+            assert sharding.local_path('jobs.db') == 'jobs.shard2.db'
+        finally:
+            config.SHARD_COUNT, config.SHARD_INDEX, sharding.ring = original_count, original_index, original_ring
+        print("✅ Рассылка уроков делится между шардами без повторов")
+        
+        return True
+        
+    except Exception as e:
+        print(f"❌ Ошибка шардирования: {e}")
+        return False
+    
+    finally:
+        for runner in runners:
+            await runner.cleanup()
+
+async def test_json_body():
+    """Тестирует потоковое тело запроса с изображениями"""
+    print("\n🔧 Тестирование потокового тела запроса...")
+    
+    try:
+        import base64
+        import json
+        import os
+        import json_body
+        
+        class FakeWriter:
+            def __init__(self):
+                self.chunks = []
+            
+            async def write(self, chunk):
+                self.chunks.append(bytes(chunk))
+        
+        images = [os.urandom(size) for size in (0, 1, 2, json_body.CHUNK_SIZE * 2 + 1)]
+        document = {
+            "model": "test",
+            "messages": [{"role": "user", "content": [{"type": "text", "text": "Что за растение? \"🌿\""}] + [
+                {"type": "image_url", "image_url": {"url": json_body.JPEGDataURL(image)}} for image in images
+            ]}],
+            "max_tokens": 10
+        }
+        body = json_body.JSONImagePayload(document)
+        writer = FakeWriter()
+        await body.write(writer)
+        raw = b"".join(writer.chunks)
+        assert body.size == len(raw)
+        assert max(map(len, writer.chunks)) <= json_body.CHUNK_SIZE // 3 * 4
+        
+        parsed = json_body.json_loads(raw)
+        urls = [part["image_url"]["url"] for part in parsed["messages"][0]["content"][1:]]
+        assert [base64.b64decode(url.split(",", 1)[1]) for url in urls] == images
+        assert parsed["messages"][0]["content"][0]["text"] == "Что за растение? \"🌿\""
+        assert json.loads(raw) == parsed
+        print("✅ JSON с base64 изображений собирается кусками без ошибок")
+        
+        return True
+        
+    except Exception as e:
+        print(f"❌ Ошибка потокового тела запроса: {e}")
+        return False
+
+async def test_image_urls():
+    """Тестирует передачу фото моделям по подписанным ссылкам"""
+    print("\n🔧 Тестирование ссылок на фото...")
+    
+    server = None
+    runner = None
+    saved = None
+    try:
+        import io
+        import aiohttp
+        from aiohttp import web
+        from PIL import Image
+        import config
+        import fake_openrouter
+        import image_proxy
+        import utils
+        
+        saved = {name: getattr(config, name) for name in (
+            'IMAGE_URL_MODE', 'IMAGE_PROXY_PUBLIC_URL', 'IMAGE_PROXY_SECRET', 'OPENROUTER_BASE_URL', 'FALLBACK_MODELS')}
+        config.IMAGE_URL_MODE = True
+        config.IMAGE_PROXY_SECRET = 'test-secret'
+        config.IMAGE_PROXY_PUBLIC_URL = 'http://127.0.0.1:1'
+        
+        url = image_proxy.signed_url('AgAD', now=1000)
+        query = dict(part.split('=') for part in url.split('?')[1].split('&'))
+        assert image_proxy.verify('AgAD', query['expires'], query['signature'], now=1000)
+        assert not image_proxy.verify('AgAE', query['expires'], query['signature'], now=1000)
+        assert not image_proxy.verify('AgAD', query['expires'], query['signature'], now=1000 + config.IMAGE_URL_TTL + 1)
+        print("✅ Ссылки подписаны и ограничены по времени")
+        
+        buffer = io.BytesIO()
+        Image.new('RGB', (32, 32), 'green').save(buffer, format='JPEG')
+        photo = buffer.getvalue()
+        downloads = []
+        
+        class FakeFile:
+            async def download_as_bytearray(self):
+                downloads.append(len(photo))
+                return bytearray(photo)
+        
+        class FakeBot:
+            async def get_file(self, file_id):
+                assert file_id == 'AgAD'
+                return FakeFile()
+        
+        # Прокси отдает фото только по действующей подписи
+        runner = web.AppRunner(image_proxy.create_image_proxy_app(FakeBot()), access_log=None)
+        await runner.setup()
+        site = web.TCPSite(runner, '127.0.0.1', 0)
+        await site.start()
+        config.IMAGE_PROXY_PUBLIC_URL = f"http://127.0.0.1:{site._server.sockets[0].getsockname()[1]}"
+        async with aiohttp.ClientSession() as session:
+            async with session.get(image_proxy.signed_url('AgAD')) as response:
+                assert response.status == 200 and await response.read() == photo
+            async with session.get(image_proxy.signed_url('AgAD').replace('signature=', 'signature=0')) as response:
+                assert response.status == 403
+        print("✅ Прокси отдает фото по подписанной ссылке")
+        
+        # Модель получает ссылку, фото бот не скачивает
+        server = fake_openrouter.FakeOpenRouter(content="Роза")
+        config.OPENROUTER_BASE_URL = await server.start()
+        config.FALLBACK_MODELS = ['qwen_7b']
+        downloads.clear()
+        image_proxy.url_rejected_models.clear()
+        result = await utils.recognize_with_fallback(image_proxy.RemoteImage('AgAD', FakeBot()), "Что это?")
+        assert result == ("Роза", None)
+        sent_url = server.last_body['messages'][0]['content'][1]['image_url']['url']
+        assert sent_url.startswith(config.IMAGE_PROXY_PUBLIC_URL) and 'test-secret' not in sent_url
+        assert downloads == []
+        print("✅ Модель получает ссылку вместо байтов")
+        
+        # Модель, отклонившая ссылку, получает байты
+        server.reject_image_urls = True
+        result = await utils.recognize_with_fallback(image_proxy.RemoteImage('AgAD', FakeBot()), "Что это?")
+        assert result == ("Роза", None)
+        assert server.last_body['messages'][0]['content'][1]['image_url']['url'].startswith('data:image/jpeg;base64,')
+        assert downloads == [len(photo)] and 'qwen_7b' in image_proxy.url_rejected_models
+        print("✅ При отказе от ссылки фото отправляется байтами")
+        
+        return True
+        
+    except Exception as e:
+        print(f"❌ Ошибка ссылок на фото: {e}")
+        return False
+    
+    finally:
+        if saved:
+            for name, value in saved.items():
+                setattr(config, name, value)
+        image_proxy.url_rejected_models.clear()
+        if runner is not None:
+            await runner.cleanup()
+        if server is not None:
+            await server.stop()
+
+async def test_local_bot_api():
+    """Тестирует чтение файлов с локального сервера Bot API"""
+    print("\n🔧 Тестирование локального сервера Bot API...")
+    
+    runner = None
+    saved = None
+    try:
+        import tempfile
+        from aiohttp import web
+        from telegram import Bot
+        import config
+        import utils
+        
+        token = "123456:TEST"
+        files_dir = tempfile.mkdtemp()
+        photo = os.urandom(4096)
+        with open(os.path.join(files_dir, "file_0.jpg"), "wb") as f:
+            f.write(photo)
+        http_downloads = []
+        served = {}
+        
+        # Заменитель telegram-bot-api: в режиме --local отдает путь на диске
+        async def get_me(request):
+            return web.json_response({"ok": True, "result": {
+                "id": 123456, "is_bot": True, "first_name": "Test", "username": "test_bot"}})
+        
+        async def get_file(request):
+            file_path = served['file_path']
+            return web.json_response({"ok": True, "result": {
+                "file_id": "AgAD", "file_unique_id": "u1", "file_size": len(photo), "file_path": file_path}})
+        
+        async def download(request):
+            http_downloads.append(request.match_info['path'])
+            return web.Response(body=photo)
+        
+        app = web.Application()
+        app.router.add_post(f"/bot{token}/getMe", get_me)
+        app.router.add_post(f"/bot{token}/getFile", get_file)
+        app.router.add_get("/file/{bot}/{path:.*}", download)
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+        site = web.TCPSite(runner, '127.0.0.1', 0)
+        await site.start()
+        base = f"http://127.0.0.1:{site._server.sockets[0].getsockname()[1]}"
+        
+        saved = (config.BOT_API_LOCAL_MODE, config.BOT_API_PATH_MAP)
+        config.BOT_API_LOCAL_MODE = True
+        config.BOT_API_PATH_MAP = f"/var/lib/telegram-bot-api:{files_dir}"
+        served['file_path'] = "/var/lib/telegram-bot-api/photos/../file_0.jpg"
+        async with Bot(token, base_url=f"{base}/bot", base_file_url=f"{base}/file/bot", local_mode=True) as bot:
+            assert bytes(await utils.download_photo(bot, "AgAD")) == photo
+        assert http_downloads == []
+        print("✅ В режиме --local фото читается с диска без HTTP")
+        
+        config.BOT_API_LOCAL_MODE = False
+        served['file_path'] = "photos/file_0.jpg"
+        async with Bot(token, base_url=f"{base}/bot", base_file_url=f"{base}/file/bot") as bot:
+            assert bytes(await utils.download_photo(bot, "AgAD")) == photo
+        assert http_downloads == ["photos/file_0.jpg"]
+        print("✅ Без --local фото скачивается с сервера Bot API")
+        
+        return True
+        
+    except Exception as e:
+        print(f"❌ Ошибка локального сервера Bot API: {e}")
+        return False
+    
+    finally:
+        if saved:
+            config.BOT_API_LOCAL_MODE, config.BOT_API_PATH_MAP = saved
+        if runner is not None:
+            await runner.cleanup()
+
+async def test_photo_sizes():
+    """Тестирует выбор размера фото под бюджет пикселей модели"""
+    print("\n🔧 Тестирование выбора размера фото...")
+    
+    saved = None
+    try:
+        from telegram import PhotoSize
+        import config
+        import handlers
+        import job_store
+        import metrics
+        import utils
+        
+        sizes = [
+            PhotoSize(f"size{width}", f"u{width}", width, width * 3 // 4)
+            for width in (90, 320, 800, 1280, 2560)
+        ]
+        assert utils.select_photo_size(sizes, 1280 * 28 * 28).width == 1280
+        assert utils.select_photo_size(sizes, 320 * 240).width == 320
+        assert utils.select_photo_size(sizes, 4000 * 3000).width == 2560
+        assert utils.select_photo_size(list(reversed(sizes)), 500 * 400).width == 800
+        print("✅ Выбирается наименьший размер, покрывающий бюджет")
+        
+        assert utils.is_low_confidence("Растение плохо видно, пришлите более четкое фото")
+        assert not utils.is_low_confidence("🌿 Это роза (Rosa)")
+        print("✅ Неуверенные ответы распознаются")
+        
+        saved = (config.PHOTO_PIXEL_BUDGET, config.DUPLICATE_REQUESTS, job_store.store, utils.recognize_plant_with_qwen)
+        config.PHOTO_PIXEL_BUDGET = 320 * 240
+        config.DUPLICATE_REQUESTS = False
+        job_store.store = job_store.JobStore(':memory:')
+        downloads = []
+        replies = []
+        answers = {}
+        
+        async def fake_recognize(image_bytes, plan=None):
+            return answers[len(image_bytes)], None
+        
+        utils.recognize_plant_with_qwen = fake_recognize
+        
+        class FakeFile:
+            def __init__(self, file_id):
+                self.file_id = file_id
+            
+            async def download_as_bytearray(self):
+                downloads.append(self.file_id)
+                return bytearray(int(self.file_id[4:]))
+        
+        class FakeBot:
+            async def get_file(self, file_id):
+                return FakeFile(file_id)
+        
+        class FakeStatus:
+            message_id = 2
+            
+            async def edit_text(self, text, **kwargs):
+                pass
+            
+            async def delete(self):
+                pass
+        
+        class FakeMessage:
+            chat_id = 100
+            message_id = 1
+            photo = sizes
+            
+            async def reply_text(self, text, **kwargs):
+                replies.append(text)
+                return FakeStatus()
+        
+        class FakeUser:
+            id = 4242
+            first_name = "Тест"
+            username = None
+        
+        class FakeUpdate:
+            effective_user = FakeUser()
+            message = FakeMessage()
+        
+        class FakeContext:
+            bot = FakeBot()
+        
+        recognitions = metrics.get('plant_recognitions')
+        download_bytes = metrics.get('plant_download_bytes')
+        answers.update({320: "🌿 Это роза (Rosa)"})
+        await handlers.handle_photo(FakeUpdate(), FakeContext())
+        assert downloads == ["size320"], downloads
+        assert "Rosa" in replies[-1]
+        assert metrics.get('plant_recognitions') == recognitions + 1
+        assert metrics.get('plant_download_bytes') == download_bytes + 320
+        print("✅ Для распознавания скачивается уменьшенное фото")
+        
+        # Неуверенный ответ - повтор по фото в полном размере
+        # (другой пользователь: повтор того же фото отсекается как дубликат)
+        downloads.clear()
+        FakeUser.id = 4343
+        answers.update({320: "Плохо видно, пришлите фото получше", 2560: "🌿 Это шиповник (Rosa canina)"})
+        retries = metrics.get('plant_full_size_retries')
+        await handlers.handle_photo(FakeUpdate(), FakeContext())
+        assert downloads == ["size320", "size2560"], downloads
+        assert "canina" in replies[-1]
+        assert metrics.get('plant_full_size_retries') == retries + 1
+        assert not job_store.store.pending()
+        print("✅ При неуверенном ответе фото распознается в полном размере")
+        
+        # Остановка бота посреди распознавания оставляет задачу для повтора
+        async def hanging_recognize(image_bytes, plan=None):
+            await asyncio.sleep(10)
+        
+        utils.recognize_plant_with_qwen = hanging_recognize
+        FakeUser.id = 4444
+        handler = asyncio.ensure_future(handlers.handle_photo(FakeUpdate(), FakeContext()))
+        await asyncio.sleep(0.05)
+        handler.cancel()
+        try:
+            await handler
+            raise AssertionError("ожидалась CancelledError")
+        except asyncio.CancelledError:
+            pass
+        assert len(job_store.store.pending()) == 1
+        print("✅ Прерванная остановкой задача остается в базе")
+        
+        return True
+        
+    except Exception as e:
+        print(f"❌ Ошибка выбора размера фото: {e}")
+        return False
+    
+    finally:
+        if saved:
+            job_store.store.close()
+            config.PHOTO_PIXEL_BUDGET, config.DUPLICATE_REQUESTS, job_store.store, utils.recognize_plant_with_qwen = saved
+
+async def test_image_documents():
+    """Тестирует изображения, присланные файлом"""
+    print("\n🔧 Тестирование изображений-документов...")
+    
+    runner = None
+    saved = None
+    try:
+        import io
+        from aiohttp import web
+        from PIL import Image
+        from telegram import Document
+        import config
+        import imaging
+        
+        def encode(image, image_format):
+            buffer = io.BytesIO()
+            image.save(buffer, format=image_format)
+            return buffer.getvalue()
+        
+        original = Image.linear_gradient('L').resize((6000, 4000)).convert('RGB')
+        files = {
+            'big.jpg': encode(original, 'JPEG'),
+            'big.png': encode(original.resize((3000, 2000)), 'PNG'),
+            'anim.gif': encode(original.resize((60, 40)), 'GIF'),
+        }
+        
+        async def download(request):
+            return web.Response(body=files[request.match_info['name']])
+        
+        app = web.Application()
+        app.router.add_get('/file/{name}', download)
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+        site = web.TCPSite(runner, '127.0.0.1', 0)
+        await site.start()
+        base = f"http://127.0.0.1:{site._server.sockets[0].getsockname()[1]}/file"
+        
+        class FakeFile:
+            def __init__(self, file_path):
+                self.file_path = file_path
+        
+        class FakeBot:
+            async def get_file(self, file_id):
+                return FakeFile(f"{base}/{file_id}")
+        
+        def document(name, file_size=None):
+            return Document(name, f"u-{name}", file_size=file_size)
+        
+        saved = (config.BOT_API_LOCAL_MODE, config.DOCUMENT_MAX_BYTES, config.DOCUMENT_SPOOL_MEMORY, config.IMAGE_MAX_DECODE_PIXELS)
+        config.BOT_API_LOCAL_MODE = False
+        config.DOCUMENT_SPOOL_MEMORY = 64 * 1024
+        config.IMAGE_MAX_DECODE_PIXELS = 2_000_000
+        
+        # 24 Мп JPEG декодируется в уменьшенном масштабе и укладывается в предел пикселей
+        data = await imaging.load_document(FakeBot(), document('big.jpg'), 1280 * 28 * 28)
+        with Image.open(io.BytesIO(data)) as image:
+            assert image.format == 'JPEG' and image.width * image.height <= 1280 * 28 * 28
+            assert abs(image.width / image.height - 1.5) < 0.01
+        print("✅ Большой JPEG уменьшается при декодировании")
+        
+        # PNG уменьшить при декодировании нельзя - срабатывает предел пикселей
+        for name, message in (('big.png', 'слишком большое'), ('anim.gif', 'не поддерживается')):
+            try:
+                await imaging.load_document(FakeBot(), document(name), 1280 * 28 * 28)
+                raise AssertionError(f"{name} должен быть отклонен")
+            except imaging.ImageRejectedError as e:
+                assert message in str(e), str(e)
+        print("✅ Неподдерживаемые и слишком большие файлы отклоняются")
+        
+        # Предел размера файла - по сообщению и во время скачивания
+        config.DOCUMENT_MAX_BYTES = len(files['big.jpg']) - 1
+        for file_size in (len(files['big.jpg']), None):
+            try:
+                await imaging.load_document(FakeBot(), document('big.jpg', file_size), 1280 * 28 * 28)
+                raise AssertionError("файл больше предела должен быть отклонен")
+            except imaging.ImageRejectedError as e:
+                assert "МБ" in str(e)
+        print("✅ Слишком большие файлы не скачиваются целиком")
+        
+        return True
+        
+    except Exception as e:
+        print(f"❌ Ошибка изображений-документов: {e}")
+        return False
+    
+    finally:
+        if saved:
+            config.BOT_API_LOCAL_MODE, config.DOCUMENT_MAX_BYTES, config.DOCUMENT_SPOOL_MEMORY, config.IMAGE_MAX_DECODE_PIXELS = saved
+        if runner is not None:
+            await runner.cleanup()
+
+async def test_quality_gate():
+    """Тестирует локальную проверку качества фото"""
+    print("\n🔧 Тестирование проверки качества фото...")
+    
+    try:
+        import io
+        import random
+        from PIL import Image, ImageFilter
+        import imaging
+        import recognition_workers
+        
+        def encode(image):
+            buffer = io.BytesIO()
+            image.save(buffer, format='JPEG', quality=90)
+            return buffer.getvalue()
+        
+        noise = random.Random(0)
+        texture = Image.frombytes('L', (800, 600), bytes(noise.randrange(256) for _ in range(800 * 600)))
+        texture = texture.filter(ImageFilter.GaussianBlur(2)).convert('RGB')
+        
+        assert imaging.photo_quality_issue(encode(texture)) is None
+        assert imaging.photo_quality_issue(encode(texture.filter(ImageFilter.GaussianBlur(8)))) == 'blurry'
+        assert imaging.photo_quality_issue(encode(texture.point(lambda v: v // 10))) == 'dark'
+        assert imaging.photo_quality_issue(encode(texture.point(lambda v: 235 + v // 20))) == 'bright'
+        assert imaging.photo_quality_issue(encode(texture.resize((150, 100)))) == 'small'
+        print("✅ Размытые, темные, пересвеченные и маленькие фото отклоняются")
+        
+        # Нераспознанный формат не блокирует запрос к модели
+        assert imaging.photo_quality_issue(b'not an image') is None
+        assert await recognition_workers.check_quality(encode(texture.filter(ImageFilter.GaussianBlur(8)))) == 'blurry'
+        print("✅ Проверка выполняется через пул распознавания")
+        
+        return True
+        
+    except Exception as e:
+        print(f"❌ Ошибка проверки качества фото: {e}")
+        return False
+
+async def test_salient_crop():
+    """Тестирует обрезку фото по области растения"""
+    print("\n🔧 Тестирование обрезки по растению...")
+    
+    try:
+        import io
+        import random
+        from PIL import Image, ImageDraw, ImageFilter
+        import imaging
+        import utils
+        
+        noise = random.Random(1)
+        
+        def textured(size, color, blur, weight):
+            pattern = Image.frombytes('RGB', size, bytes(noise.randrange(256) for _ in range(size[0] * size[1] * 3)))
+            return Image.blend(pattern.filter(ImageFilter.GaussianBlur(blur)), Image.new('RGB', size, color), weight)
+        
+        # Небольшое растение на однотонном фоне в правой нижней части кадра
+        scene = textured((160, 120), (150, 130, 110), 3, 0.7).resize((1280, 960))
+        mask = Image.new('L', (300, 300))
+        ImageDraw.Draw(mask).ellipse((0, 0, 299, 299), fill=255)
+        scene.paste(textured((300, 300), (40, 150, 40), 1, 0.6), (700, 400), mask)
+        
+        box = imaging.salient_crop_box(scene)
+        assert box is not None
+        left, top, right, bottom = box
+        assert left <= 700 and top <= 400 and right >= 1000 and bottom >= 700, box
+        assert (right - left) * (bottom - top) < 0.2 * 1280 * 960, box
+        print("✅ Рамка охватывает растение с запасом")
+        
+        # Растение на весь кадр - обрезать нечего
+        assert imaging.salient_crop_box(textured((320, 240), (40, 150, 40), 1, 0.3).resize((1280, 960))) is None
+        print("✅ Без выраженного растения кадр не обрезается")
+        
+        buffer = io.BytesIO()
+        scene.save(buffer, format='JPEG', quality=90)
+        full = await utils.encode_image_to_jpeg(buffer.getvalue())
+        cropped = await utils.encode_image_to_jpeg(buffer.getvalue(), crop=True)
+        resized = await utils.encode_image_to_jpeg(buffer.getvalue(), pixel_budget=640 * 480)
+        assert len(cropped) < len(full) / 2
+        with Image.open(io.BytesIO(resized)) as image:
+            assert image.size == (640, 480)
+        print(f"✅ Тело изображения: {len(full) // 1024} КБ -> {len(cropped) // 1024} КБ после обрезки")
+        
+        return True
+        
+    except Exception as e:
+        print(f"❌ Ошибка обрезки по растению: {e}")
+        return False
+
+async def test_model_cascade():
+    """Тестирует каскад быстрой и крупных моделей"""
+    print("\n🔧 Тестирование каскада моделей...")
+    
+    server = None
+    saved = None
+    try:
+        import json
+        import config
+        import degradation
+        import fake_openrouter
+        import metrics
+        import utils
+        
+        assert utils.parse_identification('Ответ: {"name": "Роза", "latin": "Rosa", "confidence": 0.9}')['confidence'] == 90
+        assert utils.parse_identification("Это роза") is None
+        assert utils.escalation_reason({'name': "Роза", 'latin': "", 'confidence': 92, 'alternative_confidence': 40}) is None
+        assert utils.escalation_reason({'name': "Роза", 'latin': "", 'confidence': 60, 'alternative_confidence': 0})
+        assert utils.escalation_reason({'name': "Роза", 'latin': "", 'confidence': 85, 'alternative_confidence': 80})
+        print("✅ Уверенность и неоднозначность определяются по JSON")
+        
+        identification = {}
+        
+        def respond(body):
+            content = body['messages'][0]['content']
+            prompt = content[0]['text']
+            if prompt == config.PLANT_IDENTIFY_PROMPT:
+                return json.dumps(identification, ensure_ascii=False)
+            if len(content) == 1:
+                return f"Описание: {prompt.splitlines()[0]}"
+            return "Полный ответ крупной модели"
+        
+        server = fake_openrouter.FakeOpenRouter(content=respond)
+        saved = (config.OPENROUTER_BASE_URL, config.CASCADE_MODE, config.FALLBACK_MODELS)
+        config.OPENROUTER_BASE_URL = await server.start()
+        config.CASCADE_MODE = True
+        config.FALLBACK_MODELS = ['qwen_32b', 'qwen_7b']
+        plan = degradation.DegradationController(lambda: 0, [5, 15, 30], [20, 40, 60]).plan("plant")
+        photo = sample_jpeg()
+        
+        # Уверенное определение: фото видит только быстрая модель
+        identification.update(name="Роза", latin="Rosa", confidence=95, alternatives=[])
+        accepted = metrics.get('cascade_accepted')
+        text, error = await utils.recognize_plant_with_qwen(photo, plan)
+        assert "Роза (Rosa)" in text and error is None, text
+        assert server.models == [config.AVAILABLE_MODELS['qwen_7b']] * 2
+        assert metrics.get('cascade_accepted') == accepted + 1
+        print("✅ Уверенный ответ быстрой модели описывается без крупных моделей")
+        
+        # Сомнение - эскалация к крупной модели с полным промптом
+        server.models.clear()
+        identification.update(confidence=55)
+        escalations = metrics.get('cascade_escalations')
+        text, error = await utils.recognize_plant_with_qwen(photo, plan)
+        assert text == "Полный ответ крупной модели"
+        assert server.models == [config.AVAILABLE_MODELS['qwen_7b'], config.AVAILABLE_MODELS['qwen_32b']]
+        assert server.last_body['messages'][0]['content'][0]['text'] == config.PLANT_RECOGNITION_PROMPT
+        assert metrics.get('cascade_escalations') == escalations + 1
+        print("✅ Неуверенный ответ передается крупной модели")
+        
+        return True
+        
+    except Exception as e:
+        print(f"❌ Ошибка каскада моделей: {e}")
+        return False
+    
+    finally:
+        if saved:
+            config.OPENROUTER_BASE_URL, config.CASCADE_MODE, config.FALLBACK_MODELS = saved
+        if server is not None:
+            await server.stop()
+
+async def test_species_cache():
+    """Тестирует кеш описаний видов"""
+    print("\n🔧 Тестирование кеша описаний видов...")
+    
+    server = None
+    saved = None
+    try:
+        import json
+        import config
+        import degradation
+        import fake_openrouter
+        import metrics
+        import species_cache
+        import utils
+        
+        clock = FakeClock()
+        cache = species_cache.SpeciesCache(':memory:', max_age=100, clock=clock)
+        rose = {'name': "Роза", 'latin': "Rosa  Canina", 'confidence': 95, 'alternative_confidence': 0}
+        assert cache.get(rose) is None
+        cache.put(rose, "Описание розы", 300)
+        assert cache.get({'name': "Шиповник", 'latin': "rosa canina"}) == "Описание розы"
+        clock.now += 101
+        assert cache.get(rose) is None
+        print("✅ Описания хранятся по виду и устаревают")
+        
+        def respond(body):
+            content = body['messages'][0]['content']
+            if content[0]['text'] == config.PLANT_IDENTIFY_PROMPT:
+                assert body['max_tokens'] == config.CASCADE_IDENTIFY_MAX_TOKENS
+                return json.dumps({"name": "Роза", "latin": "Rosa", "confidence": 93, "alternatives": []})
+            return "🌿 Роза - " + "королева цветов. " * 20
+        
+        server = fake_openrouter.FakeOpenRouter(content=respond)
+        saved = (config.OPENROUTER_BASE_URL, config.SPECIES_CACHE, config.CASCADE_MODE, config.FALLBACK_MODELS, species_cache.cache)
+        config.OPENROUTER_BASE_URL = await server.start()
+        config.SPECIES_CACHE = True
+        config.CASCADE_MODE = False
+        config.FALLBACK_MODELS = ['qwen_32b']
+        species_cache.cache = species_cache.SpeciesCache(':memory:')
+        plan = degradation.DegradationController(lambda: 0, [5, 15, 30], [20, 40, 60]).plan("plant")
+        
+        first, _ = await utils.recognize_plant_with_qwen(sample_jpeg(), plan)
+        assert len(server.models) == 2
+        hits = metrics.get('species_cache_hits')
+        saved_tokens = metrics.get('species_cache_tokens_saved')
+        second, _ = await utils.recognize_plant_with_qwen(sample_jpeg(), plan)
+        assert second == first and len(server.models) == 3
+        assert metrics.get('species_cache_hits') == hits + 1
+        assert metrics.get('species_cache_tokens_saved') > saved_tokens
+        stats = await species_cache.cache.stats_async()
+        assert stats['species'] == 1 and stats['hit_rate'] > 0
+        print("✅ Повторный вид описывается из кеша, модель только определяет его")
+        
+        return True
+        
+    except Exception as e:
+        print(f"❌ Ошибка кеша описаний видов: {e}")
+        return False
+    
+    finally:
+        if saved:
+            species_cache.cache.close()
+            config.OPENROUTER_BASE_URL, config.SPECIES_CACHE, config.CASCADE_MODE, config.FALLBACK_MODELS, species_cache.cache = saved
+        if server is not None:
+            await server.stop()
+
+async def test_followups():
+    """Тестирует уточняющие вопросы о распознанном растении"""
+    print("\n🔧 Тестирование уточняющих вопросов...")
+    
+    server = None
+    saved = None
+    try:
+        import config
+        import conversation
+        import fake_openrouter
+        import handlers
+        import metrics
+        import utils
+        
+        clock = FakeClock()
+        store = conversation.ConversationStore(ttl=60, max_turns=2, max_answer_chars=10, clock=clock)
+        store.start(1, "🌿 Это роза (Rosa canina)")
+        assert store.get(1).answer == "🌿 Это роза"
+        for i in range(3):
+            store.add_turn(1, f"вопрос {i}", f"ответ {i}")
+        assert [q for q, _ in store.get(1).turns] == ["вопрос 1", "вопрос 2"]
+        clock.now += 61
+        assert store.get(1) is None and len(store) == 0
+        print("✅ Контекст ограничен по истории и забывается по TTL")
+        
+        server = fake_openrouter.FakeOpenRouter(content="🐱 Роза не ядовита для кошек, но шипы колючие.")
+        saved = (config.OPENROUTER_BASE_URL, config.DUPLICATE_REQUESTS, conversation.store)
+        config.OPENROUTER_BASE_URL = await server.start()
+        config.DUPLICATE_REQUESTS = False
+        conversation.store = conversation.ConversationStore()
+        conversation.store.start(5151, "🌿 Это роза (Rosa canina)")
+        replies = []
+        
+        class FakeMessage:
+            text = "А она ядовита для кошек?"
+            
+            async def reply_text(self, text, **kwargs):
+                replies.append(text)
+        
+        class FakeUser:
+            id = 5151
+            first_name = "Тест"
+            username = None
+        
+        class FakeUpdate:
+            effective_user = FakeUser()
+            message = FakeMessage()
+        
+        questions = metrics.get('followup_questions')
+        await handlers.handle_text(FakeUpdate(), None)
+        assert "не ядовита" in replies[-1], replies
+        assert metrics.get('followup_questions') == questions + 1
+        content = server.last_body['messages'][0]['content']
+        assert [part['type'] for part in content] == ['text']
+        assert "Rosa canina" in content[0]['text'] and "кошек" in content[0]['text']
+        assert server.last_body['max_tokens'] == config.FOLLOWUP_MAX_TOKENS
+        assert len(conversation.store.get(5151).turns) == 1
+        print("✅ Вопрос отправляется текстом с ответом о растении, без фото")
+        
+        # Сессия другого цикла событий закрывается при замене
+        async def other_loop_session():
+            return utils.http_session()
+        
+        stale = await asyncio.get_running_loop().run_in_executor(None, asyncio.run, other_loop_session())
+        assert utils.http_session() is not stale
+        await asyncio.sleep(0)
+        assert stale.closed
+        print("✅ Сессия сменившегося цикла событий закрывается")
+        
+        return True
+        
+    except Exception as e:
+        print(f"❌ Ошибка уточняющих вопросов: {e}")
+        return False
+    
+    finally:
+        if saved:
+            config.OPENROUTER_BASE_URL, config.DUPLICATE_REQUESTS, conversation.store = saved
+        if server is not None:
+            await server.stop()
+
+async def test_expert_map_reduce():
+    """Тестирует экспертный анализ map-reduce"""
+    print("\n🔧 Тестирование экспертного анализа map-reduce...")
+    
+    server = None
+    saved = None
+    try:
+        import time
+        import config
+        import degradation
+        import fake_openrouter
+        import utils
+        
+        def image_count(body):
+            return sum(1 for part in body['messages'][0]['content'] if part['type'] == 'image_url')
+        
+        def respond(body):
+            if image_count(body):
+                if body['max_tokens'] == config.EXPERT_OBSERVATION_MAX_TOKENS:
+                    assert image_count(body) == 1
+                    return "Листья перистые, цветки белые"
+                return "🎯 Рябина по одному фото"
+            return "🎯 Рябина обыкновенная (Sorbus aucuparia)"
+        
+        server = fake_openrouter.FakeOpenRouter(
+            content=respond, delay=lambda body: 0.3 if image_count(body) else 0.0)
+        saved = (config.OPENROUTER_BASE_URL, config.EXPERT_MAP_REDUCE)
+        config.OPENROUTER_BASE_URL = await server.start()
+        config.EXPERT_MAP_REDUCE = True
+        plan = degradation.DegradationController(lambda: 0, [5, 15, 30], [20, 40, 60]).plan("expert")
+        
+        started = time.monotonic()
+        text, error = await utils.recognize_plant_expert_mode([sample_jpeg()] * 3, "Растет у дороги", plan)
+        elapsed = time.monotonic() - started
+        assert "Sorbus" in text, (text, error)
+        assert len(server.models) == 4
+        assert elapsed < 0.8, elapsed
+        prompt = server.last_body['messages'][0]['content']
+        assert [part['type'] for part in prompt] == ['text']
+        assert "Растет у дороги" in prompt[0]['text'] and prompt[0]['text'].count("цветки белые") == 3
+        print("✅ Фото описываются параллельно, сводный анализ - текстом без фото")
+        
+        # Одно фото - обычный запрос
+        await utils.recognize_plant_expert_mode([sample_jpeg()], "", plan)
+        assert len(server.models) == 5 and image_count(server.last_body) == 1
+        print("✅ С одним фото анализ идет одним запросом")
+        
+        return True
+        
+    except Exception as e:
+        print(f"❌ Ошибка экспертного анализа map-reduce: {e}")
+        return False
+    
+    finally:
+        if saved:
+            config.OPENROUTER_BASE_URL, config.EXPERT_MAP_REDUCE = saved
+        if server is not None:
+            await server.stop()
+
+async def test_contact_sheet():
+    """Тестирует сетку фото для экспертного анализа"""
+    print("\n🔧 Тестирование сетки фото...")
+    
+    server = None
+    saved = None
+    try:
+        import base64
+        import io
+        from PIL import Image
+        import config
+        import degradation
+        import fake_openrouter
+        import imaging
+        import metrics
+        import utils
+        
+        sheet = imaging.contact_sheet([sample_jpeg((400, 300))] * 3 + [b"not an image"], 200 * 150 * 4)
+        image = Image.open(io.BytesIO(sheet))
+        assert image.width * image.height <= 200 * 150 * 4
+        assert image.width > image.height  # плитки в пропорциях фото, сетка 2×2
+        assert imaging.contact_sheet([b"not an image"], 200 * 150 * 4) is None
+        # Обрезанное фото открывается, но не декодируется - оно пропускается
+        truncated = sample_jpeg((400, 300))[:len(sample_jpeg((400, 300))) // 3]
+        assert imaging.contact_sheet([sample_jpeg((400, 300)), truncated], 200 * 150 * 4)
+        assert imaging.contact_sheet([truncated], 200 * 150 * 4) is None
+        print("✅ Фото собираются в сетку в пределах бюджета пикселей")
+        
+        server = fake_openrouter.FakeOpenRouter(content="🧬 Клен остролистный (Acer platanoides)")
+        saved = (config.OPENROUTER_BASE_URL, config.EXPERT_CONTACT_SHEET, config.CONTACT_SHEET_PIXEL_BUDGET)
+        config.OPENROUTER_BASE_URL = await server.start()
+        config.EXPERT_CONTACT_SHEET = True
+        config.CONTACT_SHEET_PIXEL_BUDGET = 320 * 240
+        plan = degradation.DegradationController(lambda: 0, [5, 15, 30], [20, 40, 60]).plan("expert")
+        
+        sheets = metrics.get('contact_sheets')
+        text, _ = await utils.recognize_plant_expert_mode([sample_jpeg()] * 3, "Листья пальчатые", plan)
+        assert "Acer" in text and metrics.get('contact_sheets') == sheets + 1
+        content = server.last_body['messages'][0]['content']
+        images = [part for part in content if part['type'] == 'image_url']
+        assert len(images) == 1
+        data = base64.b64decode(images[0]['image_url']['url'].split(',', 1)[1])
+        width, height = Image.open(io.BytesIO(data)).size
+        assert width * height <= 320 * 240
+        assert "1-3" in content[0]['text'] and "Листья пальчатые" in content[0]['text']
+        print("✅ Модель получает одно изображение-сетку с номерами фото")
+        
+        return True
+        
+    except Exception as e:
+        print(f"❌ Ошибка сетки фото: {e}")
+        return False
+    
+    finally:
+        if saved:
+            config.OPENROUTER_BASE_URL, config.EXPERT_CONTACT_SHEET, config.CONTACT_SHEET_PIXEL_BUDGET = saved
+        if server is not None:
+            await server.stop()
+
+async def test_token_ledger():
+    """Тестирует учет токенов и подбор max_tokens"""
+    print("\n🔧 Тестирование учета токенов...")
+    
+    server = None
+    saved = None
+    try:
+        import config
+        import degradation
+        import fake_openrouter
+        import handlers
+        import recognition_workers
+        import token_ledger
+        
+        ledger = token_ledger.TokenLedger(window=100, quantile=0.9, headroom=1.5, min_samples=20, floor=50, adaptive=True)
+        for tokens in range(1, 20):
+            ledger.record('m', 'plant', 500, tokens * 10, 1.0)
+        assert ledger.max_tokens('plant', 1000) == 1000
+        ledger.record('m', 'plant', 500, 200, 1.0)
+        assert ledger.max_tokens('plant', 1000) == 285  # p90 = 190, запас 1.5
+        assert ledger.max_tokens('plant', 100) == 100
+        ledger.record('m', 'plant', 500, 285, 1.0, truncated=True)
+        assert ledger.max_tokens('plant', 1000) == 1000
+        print("✅ max_tokens подбирается по длине ответов, при обрезке - базовый")
+        
+        server = fake_openrouter.FakeOpenRouter(content="🌿 Это роза. " * 10)
+        saved = (config.OPENROUTER_BASE_URL, token_ledger.ledger)
+        config.OPENROUTER_BASE_URL = await server.start()
+        token_ledger.ledger = token_ledger.TokenLedger(min_samples=1, floor=10, adaptive=True)
+        controller = degradation.DegradationController(lambda: 0, [5, 15, 30], [20, 40, 60])
+        assert controller.plan('plant')['max_tokens'] == degradation.BASE_MAX_TOKENS['plant']
+        
+        text, _ = await recognition_workers.recognize_in_process('plant', [sample_jpeg()], plan=controller.plan('plant'), user_id=77)
+        assert text
+        totals = token_ledger.ledger.by_user[77]
+        assert totals.requests == 1 and totals.prompt_tokens == server.requests[-1] // 4
+        assert token_ledger.ledger.by_task['plant'].completion_tokens == len(text.encode()) // 4
+        assert controller.plan('plant')['max_tokens'] < degradation.BASE_MAX_TOKENS['plant']
+        print("✅ usage ответа записывается по задаче и пользователю и сокращает max_tokens")
+        
+        # Записи из процесса-воркера сливаются в учет процесса бота
+        worker_ledger = token_ledger.TokenLedger()
+        worker_ledger.record('m', 'expert', 900, 300, 2.0, user_id=78)
+        token_ledger.ledger.merge(worker_ledger.take_records())
+        assert token_ledger.ledger.by_user[78].tokens == 1200 and not worker_ledger.take_records()
+        
+        replies = []
+        
+        class FakeMessage:
+            async def reply_text(self, text, **kwargs):
+                replies.append(text)
+        
+        class FakeUser:
+            id = config.ADMIN_ID
+        
+        class FakeUpdate:
+            effective_user = FakeUser()
+            message = FakeMessage()
+        
+        await handlers.tokens_command(FakeUpdate(), None)
+        assert "plant" in replies[-1] and "expert" in replies[-1] and "77" in replies[-1]
+        print("✅ Отчет /tokens по задачам, моделям и пользователям")
+        
+        return True
+        
+    except Exception as e:
+        print(f"❌ Ошибка учета токенов: {e}")
+        return False
+    
+    finally:
+        if saved:
+            config.OPENROUTER_BASE_URL, token_ledger.ledger = saved
+        if server is not None:
+            await server.stop()
+
+async def test_model_limiter():
+    """Тестирует лимиты запросов к моделям и повторы временных ошибок"""
+    print("\n🔧 Тестирование лимитов моделей...")
+    
+    server = None
+    saved = None
+    try:
+        import random
+        import config
+        import fake_openrouter
+        import model_limiter
+        import utils
+        
+        clock = FakeClock()
+        sleeps = []
+        
+        async def fake_sleep(seconds):
+            sleeps.append(seconds)
+            clock.now += seconds
+        
+        limiter = model_limiter.ModelLimiter(
+            max_wait=15, backoff_base=1, backoff_max=8, default_cooldown=30,
+            clock=clock, wall_clock=lambda: 1_700_000_000.0, sleep=fake_sleep, rng=random.Random(1))
+        assert model_limiter.parse_retry_after("7") == 7
+        assert model_limiter.parse_retry_after("Tue, 14 Nov 2023 22:13:30 GMT", now=1_700_000_000.0) == 10
+        assert model_limiter.is_retryable(503) and model_limiter.is_retryable(None)
+        assert not model_limiter.is_retryable(401) and not model_limiter.is_retryable(400)
+        
+        limiter.observe('m', 429, {'Retry-After': '3'})
+        await limiter.acquire('m')
+        assert sleeps == [3]
+        limiter.observe('m', 429, {'X-RateLimit-Reset': str((1_700_000_000 + 120) * 1000)})
+        try:
+            await limiter.acquire('m')
+            assert False, "модель должна быть пропущена"
+        except model_limiter.ModelRateLimited as e:
+            assert 119 < e.retry_after <= 120
+        print("✅ 429 закрывает модель по Retry-After и X-RateLimit-Reset")
+        
+        delays = []
+        for _ in range(5):
+            limiter.observe('flaky', 503)
+            delays.append(limiter.wait_time('flaky'))
+            clock.now += delays[-1]
+        assert all(0 <= delay <= min(8, 2 ** i) for i, delay in enumerate(delays)), delays
+        limiter.observe('flaky', 200)
+        limiter.observe('flaky', 503)
+        assert limiter.wait_time('flaky') <= 1
+        print("✅ Паузы после временных ошибок растут экспоненциально с разбросом")
+        
+        limiter.observe('limited', 200, {'X-RateLimit-Limit': '6', 'X-RateLimit-Remaining': '5'})
+        sleeps.clear()
+        for _ in range(4):
+            await limiter.acquire('limited')
+        assert len(sleeps) == 1 and 9 < sleeps[0] <= 10  # 6 запросов в минуту, 3 подряд
+        print("✅ Лимит модели берется из X-RateLimit-Limit")
+        
+        server = fake_openrouter.FakeOpenRouter(content="🌿 Роза", statuses=[503])
+        saved = (config.OPENROUTER_BASE_URL, config.MODEL_RETRIES, model_limiter.limiter)
+        config.OPENROUTER_BASE_URL = await server.start()
+        config.MODEL_RETRIES = 1
+        model_limiter.limiter = model_limiter.ModelLimiter(max_wait=1, backoff_base=0.05)
+        
+        # 503 - повтор на той же модели
+        text, _, _ = await utils.complete_text("Вопрос", 50, ['qwen_7b'])
+        assert text == "🌿 Роза" and server.models == [config.AVAILABLE_MODELS['qwen_7b']] * 2
+        
+        # 429 с долгим Retry-After - переход к следующей модели, и дальше модель не запрашивается
+        server.statuses = [(429, {'Retry-After': '3600'})]
+        text, _, _ = await utils.complete_text("Вопрос", 50, ['qwen_7b', 'mistral_small'])
+        assert text == "🌿 Роза" and server.models[2:] == [config.AVAILABLE_MODELS['qwen_7b'], config.AVAILABLE_MODELS['mistral_small']]
+        
+        # 401 - без повтора, сразу следующая модель
+        server.statuses = [401]
+        text, _, _ = await utils.complete_text("Вопрос", 50, ['qwen_7b', 'mistral_small', 'qwen_32b'])
+        assert text == "🌿 Роза"
+        assert server.models[4:] == [config.AVAILABLE_MODELS['mistral_small'], config.AVAILABLE_MODELS['qwen_32b']], server.models
+        print("✅ Временные ошибки повторяются, закрытые модели и ошибки запроса - к следующей модели")
+        
+        return True
+        
+    except Exception as e:
+        print(f"❌ Ошибка лимитов моделей: {e}")
+        return False
+    
+    finally:
+        if saved:
+            config.OPENROUTER_BASE_URL, config.MODEL_RETRIES, model_limiter.limiter = saved
+        if server is not None:
+            await server.stop()
+
+async def test_degradation():
+    """Тестирует деградацию запросов под нагрузкой"""
+    print("\n🔧 Тестирование деградации под нагрузкой...")
+    
+    try:
+        import config
+        import degradation
+        
+        clock = FakeClock()
+        depth = {'value': 0}
+        controller = degradation.DegradationController(
+            depth_source=lambda: depth['value'], queue_thresholds=[5, 15, 30],
+            latency_thresholds=[20, 40, 60], recovery_ratio=0.5, min_dwell=30, clock=clock
+        )
+        
+        normal = controller.plan('expert')
+        assert normal['level'] == 0 and normal['max_tokens'] == 1500 and not normal['short_prompt']
+        
+        depth['value'] = 16
+        degraded = controller.plan('expert')
+        assert degraded['level'] == 2 and degraded['short_prompt'] and degraded['max_tokens'] < 1500
+        assert degraded['models'][0] == config.FAST_MODELS[0]
+        
+        for _ in range(20):
+            controller.observe_latency(65)
+        assert controller.plan('expert')['task_type'] == 'plant'
+        print("✅ Под нагрузкой запросы упрощаются ступенчато")
+        
+        # Гистерезис: спуск только после паузы и ниже порога выхода
+        for _ in range(50):
+            controller.observe_latency(1)
+        depth['value'] = 10
+        assert controller.evaluate() == 3
+        clock.now += 31
+        assert controller.evaluate() == 2
+        clock.now += 31
+        assert controller.evaluate() == 2  # 10 выше порога выхода с уровня 2 (15 * 0.5)
+        depth['value'] = 6
+        assert controller.evaluate() == 1
+        clock.now += 10
+        depth['value'] = 2
+        assert controller.evaluate() == 1  # слишком рано для следующего шага
+        clock.now += 31
+        assert controller.evaluate() == 0
+        print("✅ Восстановление идет с гистерезисом")
+        
+        return True
+        
+    except Exception as e:
+        print(f"❌ Ошибка деградации: {e}")
+        return False
+
+def legacy_match_intent(text):
+    """Исходная цепочка if/elif из handle_text - эталон для регрессии маршрутизации"""
+    if "распознать растение" in text or "растение" in text:
+        return 'plant'
+    elif "экспертный режим" in text or "экспертный" in text:
+        return 'expert'
+    elif "цветочный тест люшера" in text or "цветочный тест" in text:
+        return 'flower_test'
+    elif "о боте" in text or "информация" in text:
+        return 'about'
+    elif "помощь" in text or "help" in text:
+        return 'help'
+    elif "обратная связь" in text or "отзыв" in text:
+        return 'feedback'
+    elif any(word in text for word in ["поддержка", "админ", "администратор", "связаться", "помощь с ботом"]):
+        return 'contact_admin'
+    elif any(word in text for word in ["заказать бота", "создать бота", "разработка", "бизнес"]):
+        return 'order_bot'
+    elif any(word in text for word in ["поддержать", "донат", "спасибо", "благодарность"]):
+        return 'support_project'
+    elif any(word in text for word in ["уроки биологии", "уроки", "биология", "ежедневные уроки"]):
+        return 'lessons'
+    return None
+
+# Таблица маршрутизации: текст кнопки или сообщения -> ожидаемое намерение
+INTENT_ROUTING_TABLE = [
+    ("🌿 распознать растение", 'plant'),
+    ("🧬 экспертный режим", 'expert'),
+    ("ℹ️ о боте", 'about'),
+    ("🌱 уроки биологии", 'lessons'),
+    ("🌸 цветочный тест люшера", 'flower_test'),
+    ("❓ помощь", 'help'),
+    ("💚 обратная связь", 'feedback'),
+    ("помощь с ботом", 'help'),
+    ("напишу админу", 'contact_admin'),
+    ("хочу заказать бота", 'order_bot'),
+    ("спасибо большое", 'support_project'),
+    ("биология это круто", 'lessons'),
+    ("что это за растение? спасибо", 'plant'),
+    ("уроки и бизнес", 'order_bot'),
+    ("привет", None),
+    ("", None),
+]
+
+async def test_intent_routing():
+    """Тестирует маршрутизацию текстовых сообщений по намерениям"""
+    print("\n🔧 Тестирование маршрутизации текста...")
+    
+    try:
+        import intents
+        
+        for text, expected in INTENT_ROUTING_TABLE:
+            assert intents.match_intent(text) == expected, f"{text!r} -> {intents.match_intent(text)}"
+        print(f"✅ Таблица маршрутизации: {len(INTENT_ROUTING_TABLE)} случаев")
+        
+        # Все ключевые слова по одному и попарно в обоих порядках
+        keywords = [word for _, words in intents.INTENT_KEYWORDS for word in words]
+        samples = [f"ну {word}!" for word in keywords]
+        samples += [f"{a} {b}" for a in keywords for b in keywords]
+        for text in samples:
+            assert intents.match_intent(text) == legacy_match_intent(text), text
+        print(f"✅ Совпадение с исходной цепочкой if/elif: {len(samples)} сообщений")
+        
+        return True
+        
+    except Exception as e:
+        print(f"❌ Ошибка маршрутизации текста: {e}")
+        return False
+
 async def test_imports():
     """Тестирует импорты всех модулей"""
     print("\n🔧 Тестирование импортов...")
@@ -135,7 +1845,31 @@ async def main():
         test_config,
         test_utils,
         test_keyboards,
-        test_handlers
+        test_handlers,
+        test_callback_dispatch,
+        test_intent_routing,
+        test_lessons,
+        test_throttling,
+        test_recognition_queue,
+        test_recognition_cancellation,
+        test_job_store,
+        test_recognition_workers,
+        test_sharding,
+        test_json_body,
+        test_image_urls,
+        test_local_bot_api,
+        test_photo_sizes,
+        test_image_documents,
+        test_quality_gate,
+        test_salient_crop,
+        test_model_cascade,
+        test_species_cache,
+        test_followups,
+        test_expert_map_reduce,
+        test_contact_sheet,
+        test_token_ledger,
+        test_model_limiter,
+        test_degradation
     ]
     
     passed = 0
@@ -148,6 +1882,10 @@ async def main():
         except Exception as e:
             print(f"❌ Критическая ошибка в тесте: {e}")
     
+    # Общая сессия OpenRouter закрывается, как при остановке бота
+    import utils
+    await utils.close_http_session()
+    
     print("\n" + "=" * 50)
     print(f"📊 Результаты тестирования: {passed}/{total} тестов пройдено")
     
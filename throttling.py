@@ -0,0 +1,148 @@
+"""Допуск запросов на распознавание до обращения к OpenRouter
+
+Каждый запрос должен пройти три проверки:
+• повторное одинаковое фото от того же пользователя в коротком окне отбрасывается;
+• персональный token bucket пользователя;
+• общий token bucket бота (защищает квоту бесплатного тарифа).
+Отказы считаются в metrics.
+"""
+
+import logging
+import time
+import config
+import metrics
+
+logger = logging.getLogger(__name__)
+
+class TokenBucket:
+    """Классический token bucket: rate токенов в секунду, не больше capacity"""
+    
+    def __init__(self, rate, capacity, clock=time.monotonic):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self._clock = clock
+        self._updated = clock()
+    
+    def _refill(self):
+        now = self._clock()
+        self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+    
+    def available(self):
+        """Сколько токенов доступно прямо сейчас"""
+        self._refill()
+        return self.tokens
+    
+    def consume(self, tokens=1):
+        """Списывает токены; вызывать после проверки available()"""
+        self._refill()
+        self.tokens -= tokens
+    
+    def try_acquire(self, tokens=1):
+        """Списывает токены, если их хватает"""
+        if self.available() < tokens:
+            return False
+        self.consume(tokens)
+        return True
+    
+    def retry_after(self, tokens=1):
+        """Через сколько секунд накопится нужное количество токенов"""
+        missing = tokens - self.available()
+        return max(0.0, missing / self.rate) if self.rate else float('inf')
+    
+    def is_full(self):
+        return self.available() >= self.capacity
+
+class RecognitionThrottle:
+    """Допуск запросов на распознавание по пользователю и глобально"""
+    
+    # Как часто чистить состояние неактивных пользователей
+    PRUNE_EVERY = 1000
+    
+    def __init__(self, user_rate, user_burst, global_rate, global_burst,
+                 duplicate_window, clock=time.monotonic):
+        self.user_rate = user_rate
+        self.user_burst = user_burst
+        self.duplicate_window = duplicate_window
+        self._clock = clock
+        self._global_bucket = TokenBucket(global_rate, global_burst, clock)
+        self._user_buckets = {}
+        self._recent_photos = {}
+        self._checks = 0
+    
+    @classmethod
+    def from_config(cls):
+        return cls(
+            user_rate=config.THROTTLE_USER_PER_MINUTE / 60,
+            user_burst=config.THROTTLE_USER_BURST,
+            # Общий лимит бота делится между шардами
+            global_rate=config.THROTTLE_GLOBAL_PER_MINUTE / 60 / config.SHARD_COUNT,
+            global_burst=max(1, config.THROTTLE_GLOBAL_BURST / config.SHARD_COUNT),
+            duplicate_window=config.DUPLICATE_PHOTO_WINDOW
+        )
+    
+    def _user_bucket(self, user_id):
+        bucket = self._user_buckets.get(user_id)
+        if bucket is None:
+            bucket = TokenBucket(self.user_rate, self.user_burst, self._clock)
+            self._user_buckets[user_id] = bucket
+        return bucket
+    
+    def admit(self, user_id, photo_key=None, cost=1):
+        """Решает, можно ли отправить запрос пользователя в модель
+
+        Args:
+            user_id: ID пользователя
+            photo_key: Идентификатор фото (file_unique_id) для отсева повторов
+            cost: Стоимость запроса в токенах (экспертный анализ дороже)
+
+        Returns:
+            tuple: (разрешено, причина отказа или None, через сколько секунд повторить)
+        """
+        now = self._clock()
+        self._checks += 1
+        if self._checks % self.PRUNE_EVERY == 0:
+            self._prune(now)
+        
+        recent = self._recent_photos.get(user_id)
+        if photo_key and recent and now - recent.get(photo_key, float('-inf')) < self.duplicate_window:
+            return self._reject(user_id, 'duplicate', 0.0)
+        
+        user_bucket = self._user_bucket(user_id)
+        if user_bucket.available() < cost:
+            return self._reject(user_id, 'user_rate', user_bucket.retry_after(cost))
+        
+        if self._global_bucket.available() < cost:
+            return self._reject(user_id, 'global_rate', self._global_bucket.retry_after(cost))
+        
+        user_bucket.consume(cost)
+        self._global_bucket.consume(cost)
+        if photo_key:
+            self._recent_photos.setdefault(user_id, {})[photo_key] = now
+        
+        metrics.increment('throttle_admitted')
+        return True, None, 0.0
+    
+    def forget(self, user_id, photo_key):
+        """Разрешает повторно отправить фото (например, после ошибки распознавания)"""
+        recent = self._recent_photos.get(user_id)
+        if recent:
+            recent.pop(photo_key, None)
+    
+    def _reject(self, user_id, reason, retry_after):
+        metrics.increment(f'throttle_rejected_{reason}')
+        logger.info(f"Запрос пользователя {user_id} отклонен ({reason}), повтор через {retry_after:.0f} с")
+        return False, reason, retry_after
+    
+    def _prune(self, now):
+        """Удаляет полные бакеты и устаревшие записи о фото"""
+        for user_id in [uid for uid, bucket in self._user_buckets.items() if bucket.is_full()]:
+            del self._user_buckets[user_id]
+        for user_id, recent in list(self._recent_photos.items()):
+            for photo_key in [key for key, seen in recent.items() if now - seen >= self.duplicate_window]:
+                del recent[photo_key]
+            if not recent:
+                del self._recent_photos[user_id]
+
+recognition_throttle = RecognitionThrottle.from_config()
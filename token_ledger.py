@@ -0,0 +1,191 @@
+"""Учет токенов и стоимости запросов к моделям
+
+Каждый успешный ответ OpenRouter записывается по модели, типу задачи и
+пользователю: токены промпта и ответа из блока usage, время ответа и
+стоимость (если OpenRouter ее вернул). Пользователь берется из
+контекста задачи (attributed_to), а из процессов-воркеров записи
+возвращаются в процесс бота вместе с результатом распознавания.
+
+По недавним длинам ответов для каждого типа задачи подбирается
+max_tokens (ADAPTIVE_MAX_TOKENS): квантиль длины ответа с запасом, но не
+больше базового лимита. Если ответы начинают обрезаться по лимиту,
+возвращается базовый лимит.
+"""
+
+import contextlib
+import contextvars
+import math
+from collections import defaultdict, deque
+import config
+
+# Пользователь, на которого записываются запросы текущей задачи
+current_user = contextvars.ContextVar('token_ledger_user', default=None)
+
+@contextlib.contextmanager
+def attributed_to(user_id):
+    """Записывать запросы внутри блока на пользователя user_id"""
+    token = current_user.set(user_id)
+    try:
+        yield
+    finally:
+        current_user.reset(token)
+
+class _Totals:
+    __slots__ = ('requests', 'prompt_tokens', 'completion_tokens', 'seconds', 'cost')
+
+    def __init__(self):
+        self.requests = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.seconds = 0.0
+        self.cost = 0.0
+
+    def add(self, prompt_tokens, completion_tokens, seconds, cost):
+        self.requests += 1
+        self.prompt_tokens += prompt_tokens
+        self.completion_tokens += completion_tokens
+        self.seconds += seconds
+        self.cost += cost
+
+    @property
+    def tokens(self):
+        return self.prompt_tokens + self.completion_tokens
+
+class TokenLedger:
+    """Счетчики токенов и распределение длины ответов в памяти процесса"""
+
+    def __init__(self, window=500, quantile=0.95, headroom=1.25, min_samples=50,
+                 floor=200, max_truncated=0.02, adaptive=False):
+        """
+        Args:
+            window: Сколько последних ответов каждого типа задачи учитывать
+            quantile: Квантиль длины ответа, под который подбирается max_tokens
+            headroom: Запас сверх квантиля
+            min_samples: Меньше ответов - используется базовый лимит
+            floor: Нижняя граница подобранного max_tokens
+            max_truncated: Доля обрезанных по лимиту ответов, выше которой - базовый лимит
+            adaptive: Подбирать ли max_tokens (иначе только учет)
+        """
+        self.window = window
+        self.quantile = quantile
+        self.headroom = headroom
+        self.min_samples = min_samples
+        self.floor = floor
+        self.max_truncated = max_truncated
+        self.adaptive = adaptive
+        self.total = _Totals()
+        self.by_model = defaultdict(_Totals)
+        self.by_task = defaultdict(_Totals)
+        self.by_user = defaultdict(_Totals)
+        self._completions = defaultdict(lambda: deque(maxlen=self.window))
+        # Записи для передачи из процесса-воркера в процесс бота
+        self._unsent = deque(maxlen=1000)
+
+    @classmethod
+    def from_config(cls):
+        return cls(
+            window=config.TOKEN_LEDGER_WINDOW,
+            quantile=config.ADAPTIVE_MAX_TOKENS_QUANTILE,
+            headroom=config.ADAPTIVE_MAX_TOKENS_HEADROOM,
+            min_samples=config.ADAPTIVE_MAX_TOKENS_MIN_SAMPLES,
+            floor=config.ADAPTIVE_MAX_TOKENS_FLOOR,
+            max_truncated=config.ADAPTIVE_MAX_TOKENS_MAX_TRUNCATED,
+            adaptive=config.ADAPTIVE_MAX_TOKENS
+        )
+
+    def record(self, model, task_type, prompt_tokens, completion_tokens, seconds,
+               truncated=False, cost=0.0, user_id=None):
+        """Записывает успешный ответ модели
+
+        Args:
+            truncated: Ответ обрезан по max_tokens (finish_reason == 'length')
+            user_id: Пользователь (по умолчанию - из attributed_to)
+        """
+        if user_id is None:
+            user_id = current_user.get()
+        entry = (model, task_type, prompt_tokens, completion_tokens, seconds, truncated, cost, user_id)
+        self._apply(entry)
+        self._unsent.append(entry)
+
+    def _apply(self, entry):
+        model, task_type, prompt_tokens, completion_tokens, seconds, truncated, cost, user_id = entry
+        for totals in (self.total, self.by_model[model], self.by_task[task_type]):
+            totals.add(prompt_tokens, completion_tokens, seconds, cost)
+        if user_id is not None:
+            self.by_user[user_id].add(prompt_tokens, completion_tokens, seconds, cost)
+        self._completions[task_type].append((completion_tokens, truncated))
+
+    def take_records(self):
+        """Забирает новые записи (для передачи из процесса-воркера)"""
+        taken = list(self._unsent)
+        self._unsent.clear()
+        return taken
+
+    def merge(self, entries):
+        """Добавляет записи, полученные из процесса-воркера"""
+        for entry in entries:
+            self._apply(entry)
+
+    def completion_quantile(self, task_type, quantile=None):
+        """Квантиль длины ответа по недавним ответам (None, если ответов нет)"""
+        samples = self._completions.get(task_type)
+        if not samples:
+            return None
+        ordered = sorted(tokens for tokens, _ in samples)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * (quantile or self.quantile)))]
+
+    def truncated_share(self, task_type):
+        samples = self._completions.get(task_type)
+        if not samples:
+            return 0.0
+        return sum(1 for _, truncated in samples if truncated) / len(samples)
+
+    def max_tokens(self, task_type, base):
+        """Лимит ответа для типа задачи
+
+        Args:
+            base: Базовый лимит; подобранный лимит никогда его не превышает
+        """
+        samples = self._completions.get(task_type)
+        if not self.adaptive or not samples or len(samples) < self.min_samples:
+            return base
+        if self.truncated_share(task_type) > self.max_truncated:
+            return base
+        fitted = math.ceil(self.completion_quantile(task_type) * self.headroom)
+        return min(base, max(self.floor, fitted))
+
+    def report(self, base_limits=None, top_users=5):
+        """Текст отчета для администратора"""
+        if not self.total.requests:
+            return "📊 Токены: запросов к моделям еще не было."
+
+        def line(name, totals):
+            text = (f"{name}: {totals.requests} запр., промпт {totals.prompt_tokens}, "
+                    f"ответ {totals.completion_tokens}, {totals.seconds / totals.requests:.1f} с/запр.")
+            if totals.cost:
+                text += f", ${totals.cost:.4f}"
+            return text
+
+        lines = ["📊 Токены с запуска", line("Всего", self.total), "", "По задачам:"]
+        for task_type, totals in sorted(self.by_task.items()):
+            lines.append("• " + line(task_type, totals))
+            p50 = self.completion_quantile(task_type, 0.5)
+            p95 = self.completion_quantile(task_type)
+            details = (f"  ответ p50 {p50}, p{self.quantile * 100:.0f} {p95}, "
+                       f"обрезано {self.truncated_share(task_type):.0%}")
+            base = (base_limits or {}).get(task_type)
+            if base:
+                details += f", max_tokens {self.max_tokens(task_type, base)} из {base}"
+            lines.append(details)
+
+        lines += ["", "По моделям:"]
+        lines += ["• " + line(model, totals) for model, totals in
+                  sorted(self.by_model.items(), key=lambda item: -item[1].tokens)]
+
+        if self.by_user:
+            lines += ["", f"Пользователи ({len(self.by_user)}), топ по токенам:"]
+            top = sorted(self.by_user.items(), key=lambda item: -item[1].tokens)[:top_users]
+            lines += [f"• {user_id}: {totals.tokens} ток., {totals.requests} запр." for user_id, totals in top]
+        return "\n".join(lines)
+
+ledger = TokenLedger.from_config()
@@ -2,8 +2,21 @@ import aiohttp
 import asyncio
 import base64
 import io
+import math
+import os
+import re
+import time
 from PIL import Image
 import config
+import degradation
+import image_proxy
+import imaging
+import json_body
+import lessons
+import metrics
+import model_limiter
+import species_cache
+import token_ledger
 from telegram import InputMediaPhoto
 import logging
 
@@ -13,10 +26,65 @@ user_request_count = {}
 # Кеш рабочих моделей для оптимизации fallback
 working_models_cache = {}
 
-async def recognize_with_fallback(image_data, prompt, task_type="plant"):
-    """Универсальная функция распознавания с поддержкой множественных изображений"""
+async def recognize_with_fallback(image_data, prompt, task_type="plant", max_tokens=None, models=None):
+    """Универсальная функция распознавания с поддержкой множественных изображений
     
-    for model_key in config.FALLBACK_MODELS:
+    Args:
+        image_data: Байты изображения или список изображений (байты, image_proxy.RemoteImage
+            или готовый json_body.JPEGDataURL)
+        prompt: Текст промпта
+        task_type: Тип задачи ('plant' или 'expert')
+        max_tokens: Лимит длины ответа (по умолчанию зависит от task_type)
+        models: Ключи моделей в порядке перебора (по умолчанию config.FALLBACK_MODELS)
+    """
+    if max_tokens is None:
+        max_tokens = 1500 if task_type == "expert" else 1000
+    
+    images = image_data if isinstance(image_data, list) else [image_data]
+    prompt_part = {"type": "text", "text": prompt}
+    
+    # Ссылки вместо байтов - только если все фото еще лежат в Telegram
+    url_parts = None
+    if image_proxy.enabled() and all(isinstance(image, image_proxy.RemoteImage) for image in images):
+        url_parts = [prompt_part] + [
+            {"type": "image_url", "image_url": {"url": image.url()}} for image in images
+        ]
+    
+    # Изображения перекодируются один раз, а не для каждой модели
+    byte_parts = None
+    if task_type == "expert":
+        encode_options = (config.EXPERT_PIXEL_BUDGET, False)
+    else:
+        encode_options = (photo_pixel_budget(task_type), config.SALIENT_CROP)
+    
+    async def inline_parts():
+        nonlocal byte_parts
+        if byte_parts is None:
+            byte_parts = [prompt_part]
+            for i, image in enumerate(images):
+                if isinstance(image, json_body.JPEGDataURL):
+                    # Готовый JPEG (например, сетка фото) уходит без перекодирования
+                    byte_parts.append({"type": "image_url", "image_url": {"url": image}})
+                    continue
+                if isinstance(image, image_proxy.RemoteImage):
+                    image = await image.read()
+                jpeg = await encode_image_to_jpeg(image, *encode_options)
+                if jpeg:
+                    byte_parts.append({
+                        "type": "image_url",
+                        "image_url": {
+                            "url": json_body.JPEGDataURL(jpeg)
+                        }
+                    })
+                    if isinstance(image_data, list):
+                        print(f"  📸 Изображение {i+1}/{len(images)} обработано")
+        return byte_parts
+    
+    if url_parts is None and len(await inline_parts()) == 1:  # Только текст, нет изображений
+        print("❌ Не удалось обработать изображения")
+        return None, "Все доступные модели недоступны. Попробуйте позже."
+    
+    for model_key in models or config.FALLBACK_MODELS:
         if model_key not in config.AVAILABLE_MODELS:
             continue
             
@@ -25,74 +93,35 @@ async def recognize_with_fallback(image_data, prompt, task_type="plant"):
         try:
             print(f"Пробуем модель: {model_name}")
             
-            # Подготавливаем изображения
-            content_parts = [{"type": "text", "text": prompt}]
-            
-            # Обрабатываем одно или несколько изображений
-            if isinstance(image_data, list):
-                # Множественные изображения
-                for i, image_bytes in enumerate(image_data):
-                    base64_image = await encode_image_to_base64(image_bytes)
-                    if base64_image:
-                        content_parts.append({
-                            "type": "image_url",
-                            "image_url": {
-                                "url": f"data:image/jpeg;base64,{base64_image}"
-                            }
-                        })
-                        print(f"  📸 Изображение {i+1}/{len(image_data)} обработано")
-            else:
-                # Одиночное изображение
-                base64_image = await encode_image_to_base64(image_data)
-                if base64_image:
-                    content_parts.append({
-                        "type": "image_url", 
-                        "image_url": {
-                            "url": f"data:image/jpeg;base64,{base64_image}"
-                        }
-                    })
-            
-            if len(content_parts) == 1:  # Только текст, нет изображений
-                print(f"❌ Не удалось обработать изображения для модели {model_name}")
+            use_urls = url_parts is not None and model_key not in image_proxy.url_rejected_models
+            content_parts = url_parts if use_urls else await inline_parts()
+            if len(content_parts) == 1:
                 continue
             
-            # Формируем запрос к OpenRouter API
-            headers = {
-                "Authorization": f"Bearer {config.OPENROUTER_API_KEY}",
-                "Content-Type": "application/json",
-                "HTTP-Referer": "https://github.com/plant-recognition-bot",
-                "X-Title": "Plant Recognition Bot - Expert Mode" if task_type == "expert" else "Plant Recognition Bot"
-            }
+            status, result = await _request_with_retries(model_name, content_parts, task_type, max_tokens)
             
-            payload = {
-                "model": model_name,
-                "messages": [
-                    {
-                        "role": "user", 
-                        "content": content_parts
-                    }
-                ],
-                "max_tokens": 1500 if task_type == "expert" else 1000,
-                "temperature": 0.7
-            }
+            if use_urls and status in image_proxy.URL_REJECTED_STATUSES:
+                # Модель не принимает ссылки - повторяем с байтами
+                print(f"⚠️ Модель {model_name} не приняла ссылку на изображение, отправляем байты")
+                image_proxy.url_rejected_models.add(model_key)
+                metrics.increment('image_url_rejected')
+                content_parts = await inline_parts()
+                if len(content_parts) == 1:
+                    continue
+                status, result = await _request_with_retries(model_name, content_parts, task_type, max_tokens)
             
-            async with aiohttp.ClientSession() as session:
-                async with session.post(config.OPENROUTER_BASE_URL + "/chat/completions", 
-                                      headers=headers, json=payload) as response:
+            if status == 200:
+                if 'choices' in result and result['choices']:
+                    recognition_text = result['choices'][0]['message']['content']
+                    print(f"✅ Модель {model_name} сработала успешно!")
                     
-                    if response.status == 200:
-                        result = await response.json()
-                        if 'choices' in result and result['choices']:
-                            recognition_text = result['choices'][0]['message']['content']
-                            print(f"✅ Модель {model_name} сработала успешно!")
-                            
-                            # Сохраняем рабочую модель в кеш
-                            working_models_cache[task_type] = model_key
-                            
-                            return recognition_text, None
-                    else:
-                        error_text = await response.text()
-                        print(f"❌ Модель {model_name} вернула ошибку {response.status}: {error_text}")
+                    # Сохраняем рабочую модель в кеш
+                    working_models_cache[task_type] = model_key
+                    metrics.increment('image_url_requests' if use_urls else 'image_inline_requests')
+                    
+                    return recognition_text, None
+            else:
+                print(f"❌ Модель {model_name} вернула ошибку {status}: {result}")
                         
         except Exception as e:
             print(f"❌ Ошибка с моделью {model_name}: {str(e)}")
@@ -100,6 +129,118 @@ async def recognize_with_fallback(image_data, prompt, task_type="plant"):
     
     return None, "Все доступные модели недоступны. Попробуйте позже."
 
+async def _request_completion(model_name, content_parts, task_type, max_tokens):
+    """Один запрос chat/completions к OpenRouter
+
+    Returns:
+        tuple: (HTTP-статус, разобранный JSON при 200 или текст ошибки)
+    """
+    headers = {
+        "Authorization": f"Bearer {config.OPENROUTER_API_KEY}",
+        "Content-Type": "application/json",
+        "HTTP-Referer": "https://github.com/plant-recognition-bot",
+        "X-Title": "Plant Recognition Bot - Expert Mode" if task_type == "expert" else "Plant Recognition Bot"
+    }
+    
+    payload = {
+        "model": model_name,
+        "messages": [
+            {
+                "role": "user", 
+                "content": content_parts
+            }
+        ],
+        "max_tokens": max_tokens,
+        "temperature": 0.7,
+        # OpenRouter добавит в usage стоимость запроса
+        "usage": {"include": True}
+    }
+    
+    started = time.monotonic()
+    # Тело пишется потоково, без base64-копий изображений в памяти
+    async with http_session().post(config.OPENROUTER_BASE_URL + "/chat/completions", 
+                                   headers=headers, data=json_body.JSONImagePayload(payload)) as response:
+        degradation.controller.observe_latency(time.monotonic() - started)
+        model_limiter.limiter.observe(model_name, response.status, response.headers)
+        
+        if response.status == 200:
+            result = json_body.json_loads(await response.read())
+            record_usage(model_name, task_type, result, time.monotonic() - started)
+            return response.status, result
+        return response.status, await response.text()
+
+async def _request_with_retries(model_name, content_parts, task_type, max_tokens):
+    """Запрос к модели с учетом ее лимитов и повтором временных ошибок
+    
+    Временные ошибки (429, 5xx, обрыв соединения) повторяются до
+    MODEL_RETRIES раз, если модель освободится не позже MODEL_MAX_WAIT.
+    Ошибки запроса возвращаются сразу.
+    
+    Raises:
+        model_limiter.ModelRateLimited: Модель закрыта надолго - пора к следующей
+    """
+    for attempt in range(config.MODEL_RETRIES + 1):
+        if attempt:
+            metrics.increment('model_retries')
+        await model_limiter.limiter.acquire(model_name)
+        try:
+            status, result = await _request_completion(model_name, content_parts, task_type, max_tokens)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            model_limiter.limiter.observe(model_name, None)
+            status, result = None, f"{type(e).__name__}: {e}"
+        if not model_limiter.is_retryable(status):
+            return status, result
+        print(f"⚠️ Модель {model_name}: временная ошибка {status}, попытка {attempt + 1}/{config.MODEL_RETRIES + 1}")
+    if status is None:
+        raise aiohttp.ClientError(result)
+    return status, result
+
+def record_usage(model_name, task_type, result, seconds):
+    """Записывает токены и стоимость ответа в token_ledger"""
+    usage = result.get('usage') or {}
+    choices = result.get('choices') or [{}]
+    token_ledger.ledger.record(
+        model_name, task_type,
+        usage.get('prompt_tokens', 0), usage.get('completion_tokens', 0), seconds,
+        truncated=choices[0].get('finish_reason') == 'length',
+        cost=usage.get('cost') or 0.0
+    )
+
+# Общая сессия с пулом соединений: (сессия, цикл событий, которому она принадлежит)
+_http_session = (None, None)
+# Закрытие сессий сменившихся циклов событий (ссылки, чтобы задачи не собрал GC)
+_closing_sessions = set()
+
+def _close_stale_session(session, loop):
+    """Закрывает сессию, созданную в другом цикле событий (тесты, бенчмарки)"""
+    if loop.is_running():
+        asyncio.run_coroutine_threadsafe(session.close(), loop)
+        return
+    # Цикл уже остановлен: коннектор освобождается из текущего цикла
+    task = asyncio.ensure_future(session.close())
+    _closing_sessions.add(task)
+    task.add_done_callback(_closing_sessions.discard)
+
+def http_session():
+    """Сессия aiohttp для запросов к OpenRouter, соединения переиспользуются"""
+    global _http_session
+    session, loop = _http_session
+    running_loop = asyncio.get_running_loop()
+    if session is None or session.closed or loop is not running_loop:
+        if session is not None and not session.closed:
+            _close_stale_session(session, loop)
+        session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=config.OPENROUTER_POOL_SIZE))
+        _http_session = (session, running_loop)
+    return session
+
+async def close_http_session(application=None):
+    """Закрывает общую сессию при остановке бота"""
+    global _http_session
+    session, loop = _http_session
+    if session is not None and not session.closed and loop is asyncio.get_running_loop():
+        await session.close()
+    _http_session = (None, None)
+
 # Словарь для отслеживания подписок на ежедневные уроки
 biology_subscriptions = set()
 
@@ -112,8 +253,91 @@ user_recognition_mode = {}
 # Словарь для хранения данных экспертного режима (множественные фото + текст)
 expert_mode_data = {}
 
+# Выполняющиеся распознавания пользователей {user_id: asyncio.Task}
+active_recognitions = {}
+
+# Задачи, отмененные более новым действием пользователя (cancel_recognition)
+superseded_recognitions = set()
+
+def local_bot_api_path(bot, file_path):
+    """Путь к файлу локального сервера Bot API в файловой системе бота
+
+    Returns:
+        str: Путь на диске или None, если файл нужно скачивать по HTTP
+    """
+    # Путь, которого нет у бота, python-telegram-bot превращает в URL
+    prefix = f"{bot.base_file_url}/"
+    if file_path.startswith(prefix):
+        file_path = file_path[len(prefix):]
+    if not os.path.isabs(file_path):
+        return None
+    file_path = os.path.normpath(file_path)
+    if config.BOT_API_PATH_MAP:
+        server_root, local_root = config.BOT_API_PATH_MAP.split(':', 1)
+        if file_path.startswith(server_root):
+            return local_root + file_path[len(server_root):]
+    return file_path
+
+def _read_file(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+def photo_pixel_budget(task_type="plant"):
+    """Сколько пикселей полезно модели, которая скорее всего ответит"""
+    if config.PHOTO_PIXEL_BUDGET:
+        return config.PHOTO_PIXEL_BUDGET
+    model_key = working_models_cache.get(task_type) or config.FALLBACK_MODELS[0]
+    return config.MODEL_PIXEL_BUDGETS.get(model_key, max(config.MODEL_PIXEL_BUDGETS.values()))
+
+def select_photo_size(sizes, pixel_budget):
+    """Наименьший из размеров фото Telegram, покрывающий бюджет пикселей
+
+    Если бюджет больше самого крупного размера, возвращается самый крупный.
+    """
+    ordered = sorted(sizes, key=lambda size: size.width * size.height)
+    for size in ordered:
+        if size.width * size.height >= pixel_budget:
+            return size
+    return ordered[-1]
+
+def is_low_confidence(recognition_text):
+    """Просит ли модель фото получше или сомневается в определении"""
+    text = recognition_text.lower()
+    return any(marker in text for marker in config.LOW_CONFIDENCE_MARKERS)
+
+async def download_photo(bot, file_id, kind=None):
+    """Скачивает фото из Telegram
+
+    С локальным сервером Bot API (--local) get_file возвращает путь в
+    файловой системе, и файл читается с диска без HTTP-запроса.
+
+    Args:
+        kind: Тип распознавания для счетчика {kind}_download_bytes
+    """
+    file = await bot.get_file(file_id)
+    local_path = local_bot_api_path(bot, file.file_path) if config.BOT_API_LOCAL_MODE and file.file_path else None
+    if local_path:
+        data = await asyncio.get_running_loop().run_in_executor(None, _read_file, local_path)
+        metrics.increment('telegram_local_reads')
+    else:
+        data = await file.download_as_bytearray()
+    metrics.increment('telegram_download_bytes', len(data))
+    if kind:
+        metrics.increment(f'{kind}_download_bytes', len(data))
+    return data
+
 async def encode_image_to_base64(image_bytes):
     """Кодирует изображение в base64 для отправки в API"""
+    jpeg = await encode_image_to_jpeg(image_bytes)
+    return base64.b64encode(jpeg).decode('utf-8') if jpeg else None
+
+async def encode_image_to_jpeg(image_bytes, pixel_budget=None, crop=False):
+    """Перекодирует изображение в JPEG для отправки в API
+    
+    Args:
+        pixel_budget: Уменьшить до этого числа пикселей (модель все равно уменьшит)
+        crop: Обрезать по области растения (imaging.salient_crop_box)
+    """
     try:
         # Открываем изображение с помощью PIL
         image = Image.open(io.BytesIO(image_bytes))
@@ -122,35 +346,280 @@ async def encode_image_to_base64(image_bytes):
         if image.mode != 'RGB':
             image = image.convert('RGB')
         
+        if crop:
+            box = imaging.salient_crop_box(image)
+            if box:
+                metrics.increment('salient_crops')
+                metrics.increment('salient_crop_pixels_saved',
+                                  image.width * image.height - (box[2] - box[0]) * (box[3] - box[1]))
+                image = image.crop(box)
+            else:
+                metrics.increment('salient_crop_skipped')
+        
+        if pixel_budget and image.width * image.height > pixel_budget:
+            scale = math.sqrt(pixel_budget / (image.width * image.height))
+            image.thumbnail((max(1, int(image.width * scale)), max(1, int(image.height * scale))))
+        
         # Сохраняем в буфер
         buffer = io.BytesIO()
         image.save(buffer, format='JPEG', quality=85)
-        buffer.seek(0)
-        
-        # Кодируем в base64
-        encoded_string = base64.b64encode(buffer.getvalue()).decode('utf-8')
-        return encoded_string
+        return buffer.getvalue()
     except Exception as e:
         print(f"Ошибка при кодировании изображения: {e}")
         return None
 
-async def recognize_plant_with_qwen(image_bytes):
-    """Распознает растение используя OpenRouter API с автоматическим fallback на резервные модели"""
-    return await recognize_with_fallback(image_bytes, config.PLANT_RECOGNITION_PROMPT, "plant")
+async def recognize_plant_with_qwen(image_bytes, plan=None):
+    """Распознает растение используя OpenRouter API с автоматическим fallback на резервные модели
 
-async def recognize_plant_expert_mode(image_data, additional_text=""):
+    Args:
+        plan: Готовое решение degradation.controller.plan() (из процесса бота)
+    """
+    plan = plan or degradation.controller.plan("plant")
+    if config.CASCADE_MODE or config.SPECIES_CACHE:
+        return await recognize_plant_cascade(image_bytes, plan)
+    prompt = config.PLANT_RECOGNITION_PROMPT_SHORT if plan['short_prompt'] else config.PLANT_RECOGNITION_PROMPT
+    return await recognize_with_fallback(image_bytes, prompt, "plant", plan['max_tokens'], plan['models'])
+
+def parse_identification(text):
+    """Разбирает JSON этапа определения вида
+
+    Returns:
+        dict: name, latin, confidence и confidence лучшей альтернативы (0-100) или None
+    """
+    match = re.search(r'\{.*\}', text or '', re.S)
+    if not match:
+        return None
+    try:
+        data = json_body.json_loads(match.group(0))
+        confidence = _percent(data.get('confidence'))
+        alternatives = [_percent(alt.get('confidence')) for alt in data.get('alternatives') or [] if isinstance(alt, dict)]
+    except (ValueError, TypeError, AttributeError):
+        return None
+    return {
+        'name': str(data.get('name') or '').strip(),
+        'latin': str(data.get('latin') or '').strip(),
+        'confidence': confidence,
+        'alternative_confidence': max(alternatives, default=0.0)
+    }
+
+def _percent(value):
+    value = float(value)
+    # Некоторые модели отвечают долей вместо процентов
+    return value * 100 if 0 < value <= 1 else value
+
+def escalation_reason(identification):
+    """Почему ответ быстрой модели нельзя принять, или None"""
+    if identification is None:
+        return "нет структурированного ответа"
+    if not identification['name']:
+        return "вид не определен"
+    if identification['confidence'] < config.CASCADE_CONFIDENCE_THRESHOLD:
+        return f"уверенность {identification['confidence']:.0f}"
+    if identification['confidence'] - identification['alternative_confidence'] < config.CASCADE_MIN_MARGIN:
+        return f"неоднозначно ({identification['confidence']:.0f} против {identification['alternative_confidence']:.0f})"
+    return None
+
+async def complete_text(prompt, max_tokens, models, task_type="plant"):
+    """Текстовый запрос без изображений с перебором моделей
+
+    Returns:
+        tuple: (текст ответа, ошибка, usage из ответа модели)
+    """
+    for model_key in models:
+        if model_key not in config.AVAILABLE_MODELS:
+            continue
+        model_name = config.AVAILABLE_MODELS[model_key]
+        try:
+            status, result = await _request_with_retries(model_name, [{"type": "text", "text": prompt}], task_type, max_tokens)
+            if status == 200 and result.get('choices'):
+                return result['choices'][0]['message']['content'], None, result.get('usage') or {}
+            print(f"❌ Модель {model_name} вернула ошибку {status}: {result}")
+        except Exception as e:
+            print(f"❌ Ошибка с моделью {model_name}: {str(e)}")
+    return None, "Все доступные модели недоступны. Попробуйте позже.", {}
+
+async def describe_species(identification, max_tokens, models):
+    """Описание определенного вида текстовым запросом, без фото
+
+    С включенным SPECIES_CACHE описание берется из кеша видов, а
+    сгенерированное сохраняется в него.
+    """
+    if config.SPECIES_CACHE:
+        description = await species_cache.cache.get_async(identification)
+        if description:
+            logger.info(
+                f"Описание вида {identification['name']} из кеша, "
+                f"доля попаданий {metrics.average('species_cache_hits', 'species_cache_lookups'):.0%}"
+            )
+            return description, None
+    
+    prompt = config.PLANT_DESCRIPTION_PROMPT.format(
+        name=identification['name'], latin=identification['latin'] or "латинское название неизвестно")
+    # Описание из кеша показывается и без нагрузки, поэтому генерируется полным
+    if config.SPECIES_CACHE:
+        max_tokens = max(max_tokens, degradation.BASE_MAX_TOKENS['plant'])
+    description, error, usage = await complete_text(prompt, max_tokens, models)
+    if description and config.SPECIES_CACHE:
+        await species_cache.cache.put_async(identification, description, usage.get('completion_tokens', 0))
+    return description, error
+
+async def recognize_plant_cascade(image_bytes, plan):
+    """Каскад моделей для обычного распознавания
+
+    1. Быстрая модель по фото возвращает вид и уверенность (короткий JSON).
+    2. Уверенно определенный вид описывается текстовым запросом без фото
+       (или из кеша видов).
+    3. Сомнительные случаи уходят крупным моделям с полным промптом.
+
+    Только с кешем видов (без CASCADE_MODE) вид определяют обычные модели.
+    """
+    if config.CASCADE_MODE:
+        fast_models = [key for key in config.CASCADE_FAST_MODELS if key in config.AVAILABLE_MODELS]
+    else:
+        fast_models = []
+    metrics.increment('cascade_requests')
+    
+    started = time.monotonic()
+    # Отдельный тип задачи: короткие JSON не смешиваются с длиной обычных ответов
+    text, _ = await recognize_with_fallback(
+        image_bytes, config.PLANT_IDENTIFY_PROMPT, "identify", config.CASCADE_IDENTIFY_MAX_TOKENS,
+        fast_models or plan['models'])
+    identify_seconds = time.monotonic() - started
+    metrics.increment('cascade_identify_seconds', identify_seconds)
+    
+    identification = parse_identification(text)
+    reason = escalation_reason(identification)
+    if reason is None:
+        started = time.monotonic()
+        description_models = fast_models + [key for key in plan['models'] if key not in fast_models]
+        description, _ = await describe_species(identification, plan['max_tokens'], description_models)
+        describe_seconds = time.monotonic() - started
+        if description:
+            metrics.increment('cascade_accepted')
+            metrics.increment('cascade_describe_seconds', describe_seconds)
+            logger.info(
+                f"Каскад: {identification['name']} ({identification['confidence']:.0f}), "
+                f"определение {identify_seconds:.1f} с, описание {describe_seconds:.1f} с"
+            )
+            return description, None
+        reason = "описание не получено"
+    
+    # Сомнительный случай - фото и полный промпт крупным моделям
+    metrics.increment('cascade_escalations')
+    models = [key for key in plan['models'] if key not in fast_models] or plan['models']
+    prompt = config.PLANT_RECOGNITION_PROMPT_SHORT if plan['short_prompt'] else config.PLANT_RECOGNITION_PROMPT
+    started = time.monotonic()
+    result = await recognize_with_fallback(image_bytes, prompt, "plant", plan['max_tokens'], models)
+    escalate_seconds = time.monotonic() - started
+    metrics.increment('cascade_escalate_seconds', escalate_seconds)
+    logger.info(
+        f"Каскад: эскалация ({reason}), определение {identify_seconds:.1f} с, крупная модель {escalate_seconds:.1f} с; "
+        f"доля эскалаций {metrics.average('cascade_escalations', 'cascade_requests'):.0%}"
+    )
+    return result
+
+async def recognize_plant_expert_mode(image_data, additional_text="", plan=None):
     """Экспертное распознавание растения с поддержкой множественных фото и дополнительного текста"""
+    plan = plan or degradation.controller.plan("expert")
+    
+    if plan['task_type'] == "plant":
+        # Под высокой нагрузкой вместо экспертного анализа делаем быстрое определение по первому фото
+        first_image = image_data[0] if isinstance(image_data, list) else image_data
+        prompt = config.PLANT_RECOGNITION_PROMPT_SHORT
+        if additional_text:
+            prompt += f"\n\nДополнительная информация от пользователя:\n{additional_text}"
+        return await recognize_with_fallback(first_image, prompt, "plant", plan['max_tokens'], plan['models'])
     
+    images = image_data if isinstance(image_data, list) else [image_data]
+    if config.EXPERT_MAP_REDUCE and len(images) >= config.EXPERT_MAP_MIN_PHOTOS:
+        return await recognize_plant_expert_map_reduce(images, additional_text, plan)
+    
+    if config.EXPERT_CONTACT_SHEET and len(images) >= config.CONTACT_SHEET_MIN_PHOTOS:
+        return await recognize_plant_expert_contact_sheet(images, additional_text, plan)
+    
+    expert_prompt = build_expert_prompt(additional_text, len(images), plan['short_prompt'])
+    return await recognize_with_fallback(image_data, expert_prompt, "expert", plan['max_tokens'], plan['models'])
+
+async def recognize_plant_expert_contact_sheet(images, additional_text, plan):
+    """Экспертный анализ по одной сетке из всех фото (imaging.contact_sheet)
+    
+    Сетка строится один раз на анализ - в процессе-воркере, если они
+    включены, и в отдельном потоке - и уходит всем моделям перебора
+    без перекодирования.
+    """
+    photos = [await image.read() if isinstance(image, image_proxy.RemoteImage) else bytes(image) for image in images]
+    pixel_budget = config.CONTACT_SHEET_PIXEL_BUDGET or photo_pixel_budget("expert")
+    sheet = await asyncio.get_running_loop().run_in_executor(None, imaging.contact_sheet, photos, pixel_budget)
+    if sheet is None:
+        expert_prompt = build_expert_prompt(additional_text, len(images), plan['short_prompt'])
+        return await recognize_with_fallback(images, expert_prompt, "expert", plan['max_tokens'], plan['models'])
+    
+    metrics.increment('contact_sheets')
+    metrics.increment('contact_sheet_photos', len(photos))
+    metrics.increment('contact_sheet_bytes', len(sheet))
+    expert_prompt = build_expert_prompt(additional_text, 1, plan['short_prompt']) + config.CONTACT_SHEET_PROMPT.format(count=len(photos))
+    return await recognize_with_fallback(
+        [json_body.JPEGDataURL(sheet)], expert_prompt, "expert", plan['max_tokens'], plan['models'])
+
+def build_expert_prompt(additional_text, photo_count, short_prompt=False):
+    """Промпт экспертного анализа с учетом описания пользователя и числа фото"""
     # Формируем расширенный промпт с учетом дополнительного текста
-    expert_prompt = config.EXPERT_RECOGNITION_PROMPT
+    expert_prompt = config.EXPERT_RECOGNITION_PROMPT_SHORT if short_prompt else config.EXPERT_RECOGNITION_PROMPT
     
     if additional_text:
         expert_prompt += f"\n\n🗨️ ДОПОЛНИТЕЛЬНАЯ ИНФОРМАЦИЯ ОТ ПОЛЬЗОВАТЕЛЯ:\n{additional_text}\n\nОБЯЗАТЕЛЬНО учти эту информацию в анализе!"
     
-    if isinstance(image_data, list) and len(image_data) > 1:
-        expert_prompt += f"\n\n📸 ПОЛУЧЕНО {len(image_data)} ФОТОГРАФИЙ: Проанализируй все изображения в комплексе и сопоставь данные для максимально точного определения."
+    if photo_count > 1:
+        expert_prompt += f"\n\n📸 ПОЛУЧЕНО {photo_count} ФОТОГРАФИЙ: Проанализируй все изображения в комплексе и сопоставь данные для максимально точного определения."
+    
+    return expert_prompt
+
+async def recognize_plant_expert_map_reduce(images, additional_text, plan):
+    """Экспертный анализ в два этапа вместо одного запроса со всеми фото
+    
+    1. Каждое фото отдельно и параллельно описывает быстрая модель:
+       короткие наблюдения по органам растения.
+    2. Наблюдения вместе с описанием пользователя сводит в экспертное
+       определение текстовый запрос без изображений.
+    
+    Параллельные запросы идут через общий пул соединений (OPENROUTER_POOL_SIZE),
+    а на один анализ их не больше EXPERT_MAP_CONCURRENCY.
+    """
+    models = [key for key in config.EXPERT_MAP_MODELS if key in config.AVAILABLE_MODELS] or plan['models']
+    slots = asyncio.Semaphore(config.EXPERT_MAP_CONCURRENCY)
     
-    return await recognize_with_fallback(image_data, expert_prompt, "expert")
+    async def observe(image):
+        async with slots:
+            return await recognize_with_fallback(
+                image, config.EXPERT_OBSERVATION_PROMPT, "observation", config.EXPERT_OBSERVATION_MAX_TOKENS, models)
+    
+    metrics.increment('expert_map_reduce_requests')
+    started = time.monotonic()
+    results = await asyncio.gather(*[observe(image) for image in images])
+    map_seconds = time.monotonic() - started
+    metrics.increment('expert_map_seconds', map_seconds)
+    
+    observations = [(number, text) for number, (text, _) in enumerate(results, 1) if text]
+    metrics.increment('expert_map_failed_photos', len(images) - len(observations))
+    if not observations:
+        # Наблюдений нет - прежний путь, все фото одним запросом
+        logger.warning("Map-reduce: ни одно фото не описано, анализ одним запросом")
+        prompt = build_expert_prompt(additional_text, len(images), plan['short_prompt'])
+        return await recognize_with_fallback(images, prompt, "expert", plan['max_tokens'], plan['models'])
+    
+    prompt = build_expert_prompt(additional_text, 1, plan['short_prompt']) + config.EXPERT_SYNTHESIS_PROMPT.format(
+        count=len(observations),
+        observations="\n\n".join(f"📸 Фото {number}:\n{text.strip()}" for number, text in observations)
+    )
+    started = time.monotonic()
+    text, error, _ = await complete_text(prompt, plan['max_tokens'], plan['models'], "expert")
+    reduce_seconds = time.monotonic() - started
+    metrics.increment('expert_reduce_seconds', reduce_seconds)
+    logger.info(
+        f"Map-reduce: {len(observations)}/{len(images)} фото описано за {map_seconds:.1f} с, "
+        f"сводный анализ {reduce_seconds:.1f} с"
+    )
+    return text, error
 
 def get_random_message(messages_list):
     """Возвращает случайное сообщение из списка"""
@@ -301,42 +770,29 @@ def get_subscribed_users():
     """Возвращает список всех подписанных пользователей"""
     return list(biology_subscriptions)
 
-def get_next_lesson_for_user(user_id):
-    """Возвращает следующий урок для пользователя"""
+def _next_lesson_index(user_id):
+    """Возвращает индекс следующего урока и сдвигает указатель пользователя"""
     if user_id not in user_lesson_index:
         user_lesson_index[user_id] = 0
     
-    # Импортируем уроки здесь, чтобы избежать циклических импортов
-    from config import BIOLOGY_LESSONS
-    
     current_index = user_lesson_index[user_id]
-    lesson = BIOLOGY_LESSONS[current_index % len(BIOLOGY_LESSONS)]
     
     # Увеличиваем индекс для следующего раза
-    user_lesson_index[user_id] = (current_index + 1) % len(BIOLOGY_LESSONS)
+    user_lesson_index[user_id] = (current_index + 1) % len(lessons.catalogue)
     
-    return lesson
-
-def format_biology_lesson(lesson):
-    """Форматирует урок биологии для отправки"""
-    formatted_lesson = f"""🧬 **Ежедневный урок биологии**
-
-📚 **{lesson['title']}**
-
-{lesson['content']}
-
-💡 **Интересный факт:**
-{lesson['fact']}
+    return current_index
 
-🔬 **Подумай над этим:**
-{lesson['question']}
+def get_next_lesson_for_user(user_id):
+    """Возвращает следующий урок для пользователя"""
+    return lessons.catalogue.lesson(_next_lesson_index(user_id))
 
----
-💚 *Надеюсь, урок был интересным! Завтра тебя ждет новая тема!*
+def get_next_lesson_text(user_id):
+    """Возвращает готовый текст следующего урока для пользователя"""
+    return lessons.catalogue.rendered(_next_lesson_index(user_id))
 
-🔕 Чтобы отписаться от уроков, используй команду /lessons"""
-    
-    return formatted_lesson
+def format_biology_lesson(lesson):
+    """Форматирует урок биологии для отправки"""
+    return lessons.render_lesson(lesson)
 
 def set_user_recognition_mode(user_id, mode):
     """Устанавливает режим распознавания для пользователя (plant/expert)"""
@@ -394,6 +850,45 @@ def clear_user_recognition_mode(user_id):
     global user_recognition_mode
     user_recognition_mode.pop(user_id, None)
 
+def cancel_recognition(user_id):
+    """Отменяет выполняющееся распознавание пользователя, если оно есть
+
+    Returns:
+        bool: True, если распознавание было отменено
+    """
+    task = active_recognitions.pop(user_id, None)
+    if task is None or task.done():
+        return False
+    # Отмену по новому действию run_recognition отличает от остановки обработчика
+    superseded_recognitions.add(task)
+    task.cancel()
+    metrics.increment('recognitions_superseded')
+    return True
+
+async def run_recognition(user_id, coro):
+    """Выполняет распознавание как отменяемую задачу пользователя
+
+    Новое распознавание того же пользователя отменяет предыдущее.
+    Отмена доходит до запроса к модели, и HTTP-соединение освобождается.
+
+    Returns:
+        Результат coro или None, если распознавание отменено более новым действием
+    """
+    task = asyncio.ensure_future(coro)
+    cancel_recognition(user_id)
+    active_recognitions[user_id] = task
+    try:
+        return await task
+    except asyncio.CancelledError:
+        # Отменили сам обработчик, а не только распознавание
+        if task not in superseded_recognitions:
+            raise
+        return None
+    finally:
+        superseded_recognitions.discard(task)
+        if active_recognitions.get(user_id) is task:
+            del active_recognitions[user_id]
+
 # Настройка логирования для дублирования
 logger = logging.getLogger(__name__)
 